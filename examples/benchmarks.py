@@ -1,11 +1,16 @@
 #! /usr/bin/env python
 import gc
 import sys
-from timeit import repeat
+from timeit import repeat, default_timer
+
+import six
 
 from fastidious.parser import FastidiousParser, BaseParser, Parser
 from fastidious.fastidious_compiler import FastidiousCompiler
 from fastidious.bootstrap import _FastidiousParserBootstraper
+from fastidious.parser_base import MemoBudget
+
+from examples.json import JSON
 
 grammar = '\n'.join(
     [l.strip() for l in FastidiousParser.__grammar__.splitlines()])
@@ -27,6 +32,21 @@ class NoCodeGen(BaseParser):
     __grammar__ = grammar
 
 
+class Closures(BaseParser):
+    p_compiler = FastidiousCompiler(backend="closures")
+    __grammar__ = grammar
+
+
+class VM(BaseParser):
+    p_compiler = FastidiousCompiler(backend="vm")
+    __grammar__ = grammar
+
+
+class Tiered(BaseParser):
+    p_compiler = FastidiousCompiler(backend="tiered")
+    __grammar__ = grammar
+
+
 class NotJSONParser(Parser):
     __grammar__ = r"""
         value <- _ (string / number / object / array / true_false_null) _
@@ -56,9 +76,15 @@ class NotJSONParser(Parser):
 
 
 if "--json-code" in sys.argv:
+    total = 0
     for r in NotJSONParser.__rules__:
+        size = len(six.get_function_code(getattr(NotJSONParser,
+                                                 r.name)).co_code)
+        total += size
         print(r._py_code)
+        print("# bytecode size: %d bytes" % size)
         print("")
+    print("# total bytecode size: %d bytes" % total)
     sys.exit(0)
 
 
@@ -68,11 +94,155 @@ class NotJSONNoCodeGenParser(BaseParser):
     __grammar__ = NotJSONParser.__grammar__
 
 
+class NotJSONClosuresParser(BaseParser):
+    p_compiler = FastidiousCompiler(backend="closures")
+    __grammar__ = NotJSONParser.__grammar__
+
+
+class NotJSONVMParser(BaseParser):
+    p_compiler = FastidiousCompiler(backend="vm")
+    __grammar__ = NotJSONParser.__grammar__
+
+
+class NotJSONTieredParser(BaseParser):
+    p_compiler = FastidiousCompiler(backend="tiered")
+    __grammar__ = NotJSONParser.__grammar__
+
+
 class NotJSONNoMemoizedParser(Parser):
     p_compiler = FastidiousCompiler(memoize=False)
     __grammar__ = NotJSONParser.__grammar__
 
 
+class NotJSONOptimizedParser(Parser):
+    p_compiler = FastidiousCompiler(optimize=2)
+    __grammar__ = NotJSONParser.__grammar__
+
+
+class NotJSONLRUParser(NotJSONParser):
+    __memo_budget__ = MemoBudget(entries=1000)
+
+
+class NotJSONWindowParser(NotJSONParser):
+    __memo_budget__ = MemoBudget(window=256)
+
+
+class NestedListsJSON(JSON):
+    # the lists of the JSON example without the separated repetitions: the
+    # actions unpick the nested lists
+    __grammar__ = r"""
+        members <- (first:member rest:("," member)*)? {on_elements}
+        elements <- (first:value rest:("," value)*)?
+    """
+
+    def on_elements(self, value, first, rest):
+        return [first] + [i[1] for i in rest]
+
+
+class LinesParser(Parser):
+    # whitespace-separated records matched by regexes only: parse time must
+    # stay linear in the input size
+    __grammar__ = r"""
+        lines <- ( _ line )* _
+        line <- ~"[^\n]+"
+        _ <- ~"\\s*"
+    """
+
+
+class FoldedCalculator(Parser):
+    # the operators are left-associative: the repetitions are folded by the
+    # actions
+    __grammar__ = r"""
+        expr <- first:term rest:( _ [-+] _ term )* {on_fold}
+        term <- first:factor rest:( _ [*/] _ factor )* {on_fold}
+        factor <- ( "(" _ fact:expr _ ")" ) / fact:number {@fact}
+        number <- [0-9]+ {int(value)}
+        _ <- " "*
+    """
+
+    def on_fold(self, value, first, rest):
+        for r in rest:
+            first = apply_op(r[1], first, r[3])
+        return first
+
+
+class LeftRecursiveCalculator(Parser):
+    # the same language, the left recursion builds the left-associative tree
+    # while parsing
+    __grammar__ = r"""
+        expr <- l:expr _ op:[-+] _ r:term / term {on_binop}
+        term <- l:term _ op:[*/] _ r:factor / factor {on_binop}
+        factor <- ( "(" _ fact:expr _ ")" ) / fact:number {@fact}
+        number <- [0-9]+ {int(value)}
+        _ <- " "*
+    """
+
+    def on_binop(self, value, l=None, op=None, r=None):
+        if op is None:
+            return value
+        return apply_op(op, l, r)
+
+
+class PrecedenceCalculator(Parser):
+    # the same language, the operators are declared by precedence level: the
+    # operand is matched once, whatever the number of levels
+    __grammar__ = r"""
+        expr <- factor
+            %left _ [-+] _
+            %left _ [*/] _ {on_node}
+        factor <- ( "(" _ fact:expr _ ")" ) / fact:number {@fact}
+        number <- [0-9]+ {int(value)}
+        _ <- " "*
+    """
+
+    def on_node(self, value, l, op, r):
+        return apply_op(op[1], l, r)
+
+
+KEYWORDS = ("and as assert break class continue def del elif else except "
+            "finally for from global if import in is lambda not or pass "
+            "raise return try while with yield").split()
+
+
+class LiteralKeywordsTokenizer(Parser):
+    # the reserved words are a choice of literals guarded by the end of the
+    # identifier
+    __grammar__ = r"""
+        tokens <- ( _ token )* _
+        token <- keyword / identifier
+        keyword <- ( %s ) !identifier_part
+        identifier <- [A-Za-z_] identifier_part* {on_identifier}
+        identifier_part <- [A-Za-z0-9_]
+        _ <- [ \n]*
+    """ % " / ".join('"%s"' % keyword for keyword in KEYWORDS)
+
+    def on_keyword(self, value):
+        return ("keyword", value[0])
+
+    def on_identifier(self, value):
+        return ("identifier", self.p_flatten(value))
+
+
+class KeywordSetTokenizer(Parser):
+    # the same tokens, the identifier is matched once and looked up in the
+    # keyword set
+    __grammar__ = r"""
+        tokens <- ( _ token )* _
+        token <- @"%s"n
+        _ <- [ \n]*
+    """ % " ".join(KEYWORDS)
+
+
+def apply_op(op, l, r):
+    if op == "+":
+        return l + r
+    if op == "-":
+        return l - r
+    if op == "*":
+        return l * r
+    return l // r
+
+
 father = """{
         "id" : 1,
         "married" : true,
@@ -95,20 +265,28 @@ father = """{
         }"""
 more_fathers = ','.join([father] * 60)
 json = '{"fathers" : [' + more_fathers + ']}'
+arithmetic = " - ".join(["(12 * 3 - 4 / 2 + 7)"] * 2000)
+words = "\n".join(["def withdraw self return not self yielded or import_ if"
+                   " raised else None"] * 1000)
 
 
 def benchit(klass, source, entry_point, ref=None):
     entry_point = getattr(klass, entry_point)
     # test the parser correctness
-    p = klass(source)
+    # p_parse doesn't track the errors until a parse fails
+    p = klass(source, track_errors=False)
     entry_point(p)
     assert p.p_suffix() == ""
+    stats = p.p_memo_stats()
+    memo = stats["size"] / float(len(source))
+    del p
 
     gc.collect()
 
     NUMBER = 1
     REPEAT = 5
-    total_seconds = min(repeat(lambda: entry_point(klass(source)),
+    total_seconds = min(repeat(lambda: entry_point(klass(source,
+                                                         track_errors=False)),
                                lambda: gc.enable(),
                                repeat=REPEAT,
                                number=NUMBER))
@@ -122,25 +300,123 @@ def benchit(klass, source, entry_point, ref=None):
             var = ref
     else:
         var = ""
+    if stats["evictions"]:
+        var += " %d evictions, %d reparses" % (stats["evictions"],
+                                               stats["reparses"])
 
     kb = len(source) / 1024.0
-    print('%-25s: Took %.3fs to parse %.1fKB: %.0fKB/s %s' % (
-        klass.__name__, seconds_each, kb, kb / seconds_each, var))
+    print('%-25s: Took %.3fs to parse %.1fKB: %.0fKB/s, memo %.1fB/byte %s' % (
+        klass.__name__, seconds_each, kb, kb / seconds_each, memo, var))
     return seconds_each
 
 
+def startup(backend):
+    """
+    Time the creation of a parser class with the fastidious grammar, and its
+    first parse (the tiered parsers compile their rules during the parses)
+    """
+    attrs = dict(__grammar__=FastidiousParser.__grammar__,
+                 p_compiler=FastidiousCompiler(backend=backend))
+    creations = []
+    first_parses = []
+    for i in range(5):
+        # the grammar source is different each time, nothing is cached
+        start = default_timer()
+        klass = type("Startup", (FastidiousParser, ), dict(
+            attrs, __grammar__=attrs["__grammar__"] + "#%f\n" % start))
+        creations.append(default_timer() - start)
+        start = default_timer()
+        klass(grammar, track_errors=False).grammar()
+        first_parses.append(default_timer() - start)
+    print('%-25s: Took %.3fs to create the parser class, %.3fs to parse '
+          '%.1fKB' % ("startup (%s)" % backend, min(creations),
+                      min(first_parses), kb))
+
+
+def scaling(max_size):
+    record = "the quick brown fox jumps over the lazy dog " * 2 + "\n\n"
+    size = 10 * 1024
+    costs = []
+    while size <= max_size:
+        source = record * (size // len(record))
+        p = LinesParser(source)
+        start = default_timer()
+        p.lines()
+        seconds = default_timer() - start
+        assert p.p_suffix(1) == ""
+        costs.append(seconds / len(source))
+        kb = len(source) / 1024.0
+        print('%-25s: Took %.3fs to parse %.1fKB: %.0fKB/s' % (
+            "LinesParser", seconds, kb, kb / seconds))
+        del p, source
+        gc.collect()
+        size *= 10
+    print("cost per byte, largest / smallest input: %.2f" % (
+        costs[-1] / costs[0]))
+
+
+def parse_size(size):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if size[-1].upper() in units:
+        return int(size[:-1]) * units[size[-1].upper()]
+    return int(size)
+
+
 if __name__ == "__main__":
+    if "--scaling" in sys.argv:
+        # --scaling [MAXSIZE] parses 10KB, 100KB, ... up to MAXSIZE
+        # (default 100M)
+        idx = sys.argv.index("--scaling")
+        max_size = "100M"
+        if len(sys.argv) > idx + 1:
+            max_size = sys.argv[idx + 1]
+        scaling(parse_size(max_size))
+        sys.exit(0)
     ref = benchit(NotJSONParser, json, "value")
     if "--json-only" in sys.argv:
         sys.exit(0)
     benchit(NotJSONNoCodeGenParser, json, "value", ref)
+    benchit(NotJSONClosuresParser, json, "value", ref)
+    benchit(NotJSONVMParser, json, "value", ref)
+    # the steady state of the tiered parsers, once their hot rules are
+    # compiled
+    for i in range(10):
+        NotJSONTieredParser(json, track_errors=False).value()
+    benchit(NotJSONTieredParser, json, "value", ref)
     benchit(NotJSONNoMemoizedParser, json, "value", ref)
+    benchit(NotJSONOptimizedParser, json, "value", ref)
+    benchit(NotJSONLRUParser, json, "value", ref)
+    benchit(NotJSONWindowParser, json, "value", ref)
+    ref = benchit(NestedListsJSON, json, "json", "(base)")
+    benchit(JSON, json, "json", ref)
+    assert JSON.p_parse(json) == NestedListsJSON.p_parse(json, "json")
+    ref = benchit(FoldedCalculator, arithmetic, "expr", "(base)")
+    benchit(LeftRecursiveCalculator, arithmetic, "expr", ref)
+    folded = FoldedCalculator.p_parse(arithmetic)
+    assert folded == LeftRecursiveCalculator.p_parse(arithmetic)
+    benchit(PrecedenceCalculator, arithmetic, "expr", ref)
+    assert folded == PrecedenceCalculator.p_parse(arithmetic)
+    ref = benchit(LiteralKeywordsTokenizer, words, "tokens", "(base)")
+    benchit(KeywordSetTokenizer, words, "tokens", ref)
+    tokens = LiteralKeywordsTokenizer.p_parse(words)
+    assert tokens == KeywordSetTokenizer.p_parse(words)
     ref = benchit(FastidiousParser, grammar, "grammar", "(base)")
     benchit(_FastidiousParserBootstraper, grammar, "grammar", ref)
     ref = benchit(Default, grammar, "grammar", "(base)")
     benchit(NoCodeGen, grammar, "grammar", ref)
+    benchit(Closures, grammar, "grammar", ref)
+    benchit(VM, grammar, "grammar", ref)
+    for i in range(10):
+        Tiered(grammar, track_errors=False).grammar()
+    benchit(Tiered, grammar, "grammar", ref)
     benchit(NotMemoized, grammar, "grammar", ref)
 
     default = Default(grammar).grammar()
     nm = NotMemoized(grammar).grammar()
     assert default == nm
+    assert default == Closures(grammar).grammar()
+    assert default == VM(grammar).grammar()
+    assert default == Tiered(grammar).grammar()
+
+    for backend in ("codegen", "closures", "vm", "interpreted", "tiered"):
+        startup(backend)
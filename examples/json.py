@@ -20,11 +20,11 @@ class JSON (Parser):
                  _ {@val}
 
         object <- "{" :members "}"
-        members <- (first:member rest:("," member)*)? {on_elements}
+        members <- member ** ","
         member <- :string ":" :value
 
         array <- "[" :elements "]" {@elements}
-        elements <- (first:value rest:("," value)*)?
+        elements <- value ** ","
 
         true_false_null <- "true" / "false" / "null"
 
@@ -49,9 +49,6 @@ class JSON (Parser):
         EOF <- !.
     """
 
-    def on_elements(self, value, first, rest):
-        return [first] + [i[1] for i in rest]
-
     def on_true_false_null(self, value):
         if value == "true":
             return True
@@ -1,4 +1,4 @@
 from .parser import Parser
-from .parser_base import ParserError
+from .parser_base import ParserError, MemoBudget
 
-__all__ = [Parser, ParserError]
+__all__ = [Parser, ParserError, MemoBudget]
@@ -1,10 +1,14 @@
 """
 Define actions used in generated python fastidious parser classes.
 """
+import ast
+import re
 
 from six import string_types
+from six.moves import builtins
 
 from fastidious.compiler.astutils import Visitor
+from fastidious.compilers.analysis import PRECEDENCE_LABELS
 from .base import Action, ActionError
 
 
@@ -21,9 +25,15 @@ class SimpleAction(Action):
             self.labels.append(node.name)
             self.visit(node.expr)
 
+        def visit_precedenceexpr(self, node):
+            self.labels.extend(PRECEDENCE_LABELS)
+
         def visit_rule(self, node):
             if isinstance(node.action, string_types):
                 actionstr = node.action.strip()
+                if actionstr == "$":
+                    node.action = _SimpleTextAction(actionstr)
+                    return
                 if actionstr.startswith("@"):
                     argname = actionstr[1:]
                     self.labels = []
@@ -34,6 +44,12 @@ class SimpleAction(Action):
                                 argname, node.name))
                     node.action = _SimpleArgAction(argname, actionstr)
                     return
+                if not _IDENTIFIER.match(actionstr):
+                    self.labels = []
+                    self.visit(node.expr)
+                    node.action = _SimpleExprAction(actionstr, self.labels,
+                                                    node.name)
+                    return
                 meth = getattr(self.parser, actionstr, None)
                 if meth is None:
                     raise ActionError("Unknown method `%s`" % actionstr)
@@ -69,7 +85,156 @@ class _SimpleMethAction(SimpleAction):
         self.actionstr = actionstr
 
     def __call__(self, parser, result, **args):
-        return self.meth(parser, result, **args)
+        # like the generated code, call the method of the parser, that a
+        # subclass may override
+        return getattr(parser, self.meth.__name__)(result, **args)
+
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _bound_names(node):
+    "The names bound by a lambda parameter or a comprehension target"
+    if node is None:
+        return set()
+    if isinstance(node, string_types):
+        # python 2 *args and **kwargs
+        return set([node])
+    if isinstance(node, ast.Name):
+        return set([node.id])
+    if isinstance(node, getattr(ast, "arg", ())):
+        return set([node.arg])
+    if isinstance(node, getattr(ast, "Starred", ())):
+        return _bound_names(node.value)
+    names = set()
+    for elt in getattr(node, "elts", []):
+        names |= _bound_names(elt)
+    return names
+
+
+class _Rename(ast.NodeTransformer):
+    """
+    Replace the free names of a python expression by the expressions of
+    `names`, and collect them in `free`. The parameters of the lambdas and
+    the targets of the comprehensions hide the free names in their scope.
+    """
+    def __init__(self, names=None):
+        self.names = names or {}
+        self.free = set()
+        self.bound = frozenset()
+
+    def visit_Name(self, node):
+        if node.id in self.bound:
+            return node
+        self.free.add(node.id)
+        if node.id not in self.names:
+            return node
+        new = ast.parse(self.names[node.id], mode="eval").body
+        return ast.copy_location(new, node)
+
+    def visit_Lambda(self, node):
+        args = node.args
+        # the default values are computed in the enclosing scope
+        args.defaults = [self.visit(d) for d in args.defaults]
+        args.kw_defaults = [d if d is None else self.visit(d)
+                            for d in getattr(args, "kw_defaults", [])]
+        names = _bound_names(args.vararg) | _bound_names(args.kwarg)
+        for field in ("posonlyargs", "args", "kwonlyargs"):
+            for arg in getattr(args, field, []):
+                names |= _bound_names(arg)
+        bound = self.bound
+        self.bound = bound | names
+        node.body = self.visit(node.body)
+        self.bound = bound
+        return node
+
+    def _comprehension(self, node, fields):
+        generators = node.generators
+        # the first iterable is computed in the enclosing scope
+        generators[0].iter = self.visit(generators[0].iter)
+        bound = self.bound
+        for i, generator in enumerate(generators):
+            if i:
+                generator.iter = self.visit(generator.iter)
+            self.bound |= _bound_names(generator.target)
+            generator.target = self.visit(generator.target)
+            generator.ifs = [self.visit(c) for c in generator.ifs]
+        for field in fields:
+            setattr(node, field, self.visit(getattr(node, field)))
+        self.bound = bound
+        return node
+
+    def visit_ListComp(self, node):
+        return self._comprehension(node, ("elt", ))
+
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        return self._comprehension(node, ("key", "value"))
+
+
+# the expressions that would change the generated method or its locals
+_FORBIDDEN = tuple([getattr(ast, name)
+                    for name in ("Yield", "YieldFrom", "Await", "NamedExpr")
+                    if hasattr(ast, name)])
+
+
+class _SimpleExprAction(SimpleAction):
+    """
+    A python expression, e.g. `{ int(digits) }`. It can use the labels of
+    the rule (None if they're not set), `value`, the match of the rule,
+    `self`, the parser, and the builtins. `value` and `self` hide the
+    labels with the same name.
+    """
+    def __init__(self, actionstr, labels, rulename):
+        self.actionstr = actionstr
+        try:
+            self.tree = ast.parse(actionstr, mode="eval")
+        except SyntaxError as e:
+            raise ActionError("Invalid action `%s` in rule `%s`: %s" % (
+                actionstr, rulename, e))
+        for node in ast.walk(self.tree):
+            if isinstance(node, _FORBIDDEN):
+                raise ActionError("Invalid action `%s` in rule `%s`: `%s` "
+                                  "isn't allowed in an action" % (
+                                      actionstr, rulename,
+                                      type(node).__name__))
+        names = _Rename()
+        names.visit(self.tree)
+        free = names.free
+        # the builtins used by the expression
+        self.builtins = []
+        for name in sorted(free):
+            if name in labels or name in ("value", "self"):
+                continue
+            if not hasattr(builtins, name):
+                raise ActionError("`%s`: unknown name in the action of rule "
+                                  "`%s`" % (name, rulename))
+            self.builtins.append(name)
+        self.uses_value = "value" in free
+        # the labels used by the expression, in order
+        self.labels = []
+        for label in labels:
+            if label in free and label not in self.labels + ["value", "self"]:
+                self.labels.append(label)
+        self.func = eval(compile(
+            "lambda %s: (%s)" % (
+                ", ".join(["self", "value"] + self.labels), actionstr),
+            "<action of %s>" % rulename, "eval"))
+
+    def __call__(self, parser, result, **args):
+        return self.func(parser, result,
+                         *[args.get(label) for label in self.labels])
+
+
+class _SimpleTextAction(SimpleAction):
+    """
+    `{$}`: the rule returns the text it matched, see Rule.__call__
+    """
+    captures_text = True
+
+    def __init__(self, actionstr):
+        self.actionstr = actionstr
 
 
 class SimplePyAction(Action):
@@ -82,6 +247,10 @@ class SimplePyAction(Action):
             if isinstance(node.action, _SimpleMethAction):
                 node.action = _SimplePyMethAction(node.action.meth,
                                                   node.action.actionstr)
+            if isinstance(node.action, _SimpleExprAction):
+                node.action = _SimplePyExprAction(node.action)
+            if isinstance(node.action, _SimpleTextAction):
+                node.action = _SimplePyTextAction(node.action.actionstr)
 
     @classmethod
     def update_rules(cls, parser_class):
@@ -93,10 +262,52 @@ class SimplePyAction(Action):
 
 
 class _SimplePyArgAction(_SimpleArgAction, SimplePyAction):
-    def as_code(self):
-        return "result = args['%s']" % self.argname
+    def as_code(self, labels=None):
+        """
+        `labels` are the names of the labels stored in local variables named
+        `label_<name>`. If it's None, they are in the dict `args`.
+        """
+        if labels is None:
+            return "result = args['%s']" % self.argname
+        return "result = label_%s" % self.argname
 
 
 class _SimplePyMethAction(_SimpleMethAction, SimplePyAction):
-    def as_code(self):
-        return "result = self.%s(result, **args)" % self.meth.__name__
+    def as_code(self, labels=None):
+        if labels is None:
+            return "result = self.%s(result, **args)" % self.meth.__name__
+        return "result = self.%s(%s)" % (self.meth.__name__, ", ".join(
+            ["result"] + ["%s=label_%s" % (n, n) for n in labels]))
+
+
+class _SimplePyTextAction(_SimpleTextAction, SimplePyAction):
+    def as_code(self, labels=None):
+        return "result = input[start_pos:pos]"
+
+
+class _SimplePyExprAction(_SimpleExprAction, SimplePyAction):
+    def __init__(self, action):
+        self.__dict__.update(action.__dict__)
+
+    def as_code(self, labels=None):
+        """
+        The builtins are looked up in the global `_p_builtins`: the locals
+        of the generated method (e.g. `input`) would hide them.
+        """
+        names = {"value": "result"}
+        for label in self.labels:
+            if labels is None:
+                names[label] = "args.get(%r)" % label
+            else:
+                names[label] = "label_%s" % label
+        for name in self.builtins:
+            names[name] = "_p_builtins.%s" % name
+        if not hasattr(ast, "unparse"):
+            # python < 3.9: call the expression
+            params = self.labels + self.builtins
+            args = ["self", "result"] + [names[n] for n in params]
+            return "result = (lambda %s: (%s))(%s)" % (
+                ", ".join(["self", "value"] + params), self.actionstr,
+                ", ".join(args))
+        tree = _Rename(names).visit(ast.parse(self.actionstr, mode="eval"))
+        return "result = %s" % ast.unparse(tree)
@@ -1,8 +1,303 @@
 """
 Utility functions to generate python code.
+
+The code is generated as python ast nodes, from templates: small snippets of
+python code parsed once, whose placeholders are substituted (see
+`Template`).
 """
+import ast
+import gc
+import textwrap
+from contextlib import contextmanager
+
+import six
+
+
+# the generated code can be printed (python 3.9+)
+UNPARSE = hasattr(ast, "unparse")
 
 
 def indent(code, space):
     ind = " " * space * 4
     return ind + ("\n" + ind).join([l for l in code.splitlines()])
+
+
+_templates = {}
+
+
+def template(source):
+    "The Template of the python code `source`, parsed once"
+    result = _templates.get(source)
+    if result is None:
+        result = _templates[source] = Template(source)
+    return result
+
+
+class Template(object):
+    """
+    A snippet of python code. Calling it returns new ast nodes of its
+    statements, with the placeholders given as keyword arguments
+    substituted. The placeholders are the names in capitals:
+
+    - a statement that is a placeholder is replaced by the statements of its
+      value (a list of ast statements, used as is),
+    - an expression that is a placeholder is replaced by its value: a copy
+      of an ast expression, or a variable if it's a string, or else a
+      constant,
+    - an attribute, function or argument name that is a placeholder is
+      renamed to its value,
+    - `ID` in a name is replaced by the value of `ID`, an expression id:
+      `memo_ID` is `memo_12`.
+
+    The template is compiled into a python function that builds the nodes.
+    """
+    def __init__(self, source):
+        body = ast.parse(textwrap.dedent(source).strip()).body
+        # the nodes without fields (contexts, operators) are shared
+        self.shared = []
+        self.uses_id = False
+        code = self.stmts(body, False)
+        code = "def build(_s):\n%s    return %s\n" % (
+            "    _id = str(_s['ID'])\n" if self.uses_id else "", code)
+        namespace = dict(vars(ast), _shared=self.shared, _body=_body,
+                         _value=_value)
+        exec(compile(code, "<template>", "exec"), namespace)
+        self.build = namespace["build"]
+
+    def __call__(self, **subst):
+        return self.build(subst)
+
+    def expression(self, **subst):
+        "The expression of a template that is a single expression"
+        return self.build(subst)[0].value
+
+    def name(self, name):
+        "The code of the name `name` of the template"
+        if _placeholder(name):
+            return "_s[%r]" % name
+        if "ID" in name:
+            self.uses_id = True
+            return "%r.replace('ID', _id)" % name
+        return repr(name)
+
+    def stmts(self, nodes, block):
+        """
+        The code of the list of statements `nodes`. A `block` is never
+        empty
+        """
+        parts = []
+        items = []
+        for node in nodes:
+            if isinstance(node, ast.Expr) and isinstance(
+                    node.value, ast.Name) and _placeholder(node.value.id):
+                if items:
+                    parts.append("[%s]" % ", ".join(items))
+                    items = []
+                parts.append("_s[%r]" % node.value.id)
+            else:
+                items.append(self.node(node))
+        if items or not parts:
+            parts.append("[%s]" % ", ".join(items))
+        code = " + ".join(parts)
+        if block and all([p.startswith("_s[") for p in parts]):
+            code = "_body(%s)" % code
+        return code
+
+    def node(self, node):
+        "The code that builds `node`"
+        if not isinstance(node, ast.AST):
+            return repr(node)
+        if not node._fields:
+            self.shared.append(node)
+            return "_shared[%d]" % (len(self.shared) - 1)
+        if isinstance(node, ast.Name):
+            if _placeholder(node.id):
+                return "_value(_s[%r], %s)" % (node.id, self.node(node.ctx))
+            return "Name(%s, %s)" % (self.name(node.id), self.node(node.ctx))
+        # the fields in the order of the arguments of the constructor
+        fields = []
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                if value and isinstance(value[0], ast.stmt):
+                    code = self.stmts(value, field == "body")
+                else:
+                    code = "[%s]" % ", ".join([self.node(v) for v in value])
+            elif field in ("attr", "name", "arg") and isinstance(
+                    value, six.string_types):
+                code = self.name(value)
+            else:
+                code = self.node(value)
+            fields.append(code)
+        return "%s(%s)" % (node.__class__.__name__, ", ".join(fields))
+
+
+def _placeholder(name):
+    return name.isupper()
+
+
+def _body(statements):
+    return statements or [ast.Pass()]
+
+
+def _value(value, ctx):
+    "The expression of the placeholder `value`"
+    if isinstance(value, ast.AST):
+        return copy_ast(value)
+    if isinstance(value, six.string_types):
+        return ast.Name(id=value, ctx=ctx)
+    return constant(value)
+
+
+def copy_ast(node):
+    "A copy of the ast `node`"
+    if isinstance(node, list):
+        return [copy_ast(n) for n in node]
+    if not isinstance(node, ast.AST) or not node._fields:
+        return node
+    return node.__class__(*[copy_ast(getattr(node, field, None))
+                            for field in node._fields])
+
+
+def stmts(source, **subst):
+    "The statements of the template `source` (see Template)"
+    return template(source)(**subst)
+
+
+def expression(source, **subst):
+    "The expression of the template `source` (see Template)"
+    return template(source).expression(**subst)
+
+
+if hasattr(ast, "Constant"):
+    def constant(value):
+        "The ast of the constant `value`"
+        return ast.Constant(value)
+else:  # python < 3.6
+    def constant(value):
+        "The ast of the constant `value`"
+        return ast.parse(repr(value), mode="eval").body
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector while the code is generated. The
+    ast nodes are many small objects that trigger the collections, but they
+    have no reference cycles
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _blocks(node):
+    "The blocks of statements of `node`, and their header (None or else)"
+    body = getattr(node, "body", None)
+    if isinstance(body, list):
+        yield None, body
+    orelse = getattr(node, "orelse", None)
+    if orelse:
+        yield "else:", orelse
+
+
+def set_lines(statements, lineno=1):
+    """
+    Set the location of the nodes of `statements`: each statement and each
+    `else:` is on its own line, as in `listing`. Return the next line
+    number. The columns are unknown.
+    """
+    for statement in statements:
+        todo = [statement]
+        while todo:
+            node = todo.pop()
+            node.lineno = node.end_lineno = lineno
+            node.col_offset = node.end_col_offset = -1
+            fields = _children.get(node.__class__)
+            if fields is None:
+                fields = _child_fields(node)
+            for field in fields:
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    todo.extend([v for v in value
+                                 if isinstance(v, ast.AST) and v._fields])
+                elif isinstance(value, ast.AST) and value._fields:
+                    todo.append(value)
+        lineno += 1
+        for header, block in _blocks(statement):
+            if header is not None:
+                lineno += 1
+            lineno = set_lines(block, lineno)
+    return lineno
+
+
+# class -> the fields of the nodes that may have child nodes, but the
+# blocks of statements. The nodes without fields (contexts, operators)
+# are shared and have no location
+_children = {}
+
+
+def _child_fields(node):
+    fields = ()
+    if not isinstance(node, _NO_CHILDREN):
+        skipped = _NOT_CHILDREN
+        if isinstance(node, ast.stmt):
+            skipped += _BLOCKS
+        fields = tuple([f for f in node._fields if f not in skipped])
+    _children[node.__class__] = fields
+    return fields
+
+
+# the fields of the blocks of statements
+_BLOCKS = ("body", "orelse")
+_NO_CHILDREN = (ast.Name, getattr(ast, "Constant", ast.Name))
+_NOT_CHILDREN = ("ctx", "op", "ops", "id", "attr", "name", "kind",
+                 "type_comment")
+
+
+def _header(statement):
+    "The first line of a compound statement"
+    if isinstance(statement, ast.If):
+        return "if %s:" % ast.unparse(statement.test)
+    if isinstance(statement, ast.While):
+        return "while %s:" % ast.unparse(statement.test)
+    if isinstance(statement, ast.For):
+        return "for %s in %s:" % (ast.unparse(statement.target),
+                                  ast.unparse(statement.iter))
+    if isinstance(statement, ast.FunctionDef):
+        return "def %s(%s):" % (statement.name,
+                                ast.unparse(statement.args))
+    raise TypeError("No header for %r" % statement)
+
+
+def listing(statements, level=0):
+    """
+    The lines of `statements` numbered by `set_lines` (python 3.9+). They
+    read like the code printed by `unparse`, one line per statement.
+    """
+    lines = []
+    for statement in statements:
+        blocks = list(_blocks(statement))
+        if not blocks:
+            lines.append(indent(ast.unparse(statement), level) + "\n")
+            continue
+        lines.append(indent(_header(statement), level) + "\n")
+        for header, block in blocks:
+            if header is not None:
+                lines.append(indent(header, level) + "\n")
+            lines.extend(listing(block, level + 1))
+    return lines
+
+
+def unparse(node):
+    "The python code of `node`, an ast node or a list of statements"
+    if not UNPARSE:
+        raise NotImplementedError("Printing the generated code needs "
+                                  "python 3.9 or later")
+    if isinstance(node, list):
+        return "\n".join([ast.unparse(n) for n in node])
+    return ast.unparse(node)
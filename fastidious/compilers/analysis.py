@@ -0,0 +1,499 @@
+"""
+Static properties of grammar expressions, used by the code generators.
+
+All the answers are conservative: when in doubt, an expression is considered
+able to fail and to consume input, and its FIRST set contains any char.
+"""
+import itertools
+import re
+import string
+
+import six
+
+from fastidious.compiler.astutils import Visitor
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+
+# the labels given to the action of a rule by the operator nodes of its
+# PrecedenceExpr
+PRECEDENCE_LABELS = ("l", "op", "r")
+
+
+class _CanFail(Visitor):
+    def visit_literalexpr(self, node):
+        return node.lit != ""
+
+    def visit_cutexpr(self, node):
+        return False
+
+    def visit_maybeexpr(self, node):
+        return False
+
+    def visit_zeroormoreexpr(self, node):
+        return False
+
+    def visit_oneormoreexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_separatedexpr(self, node):
+        return node.at_least_one and self.visit(node.item)
+
+    def visit_labeledexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_seqexpr(self, node):
+        return any([self.visit(e) for e in node.exprs])
+
+    visit_factoredchoiceexpr = visit_seqexpr
+
+    def visit_prefixexpr(self, node):
+        return False
+
+    def visit_choiceexpr(self, node):
+        return all([self.visit(e) for e in node.exprs])
+
+    def generic_visit(self, node):
+        return True
+
+
+class _CanConsume(Visitor):
+    def visit_literalexpr(self, node):
+        return node.lit != ""
+
+    def visit_not(self, node):
+        return False
+
+    def visit_cutexpr(self, node):
+        return False
+
+    def visit_lookahead(self, node):
+        return False
+
+    def visit_maybeexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_zeroormoreexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_oneormoreexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_separatedexpr(self, node):
+        return self.visit(node.item)
+
+    def visit_labeledexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_seqexpr(self, node):
+        return any([self.visit(e) for e in node.exprs])
+
+    visit_factoredchoiceexpr = visit_seqexpr
+
+    def visit_prefixexpr(self, node):
+        return False
+
+    def visit_choiceexpr(self, node):
+        return any([self.visit(e) for e in node.exprs])
+
+    def generic_visit(self, node):
+        return True
+
+
+class _HasCut(Visitor):
+    def visit_cutexpr(self, node):
+        return True
+
+    def generic_visit(self, node):
+        return any([self.visit(c) for c in node.get_children()])
+
+
+class _HasLabel(Visitor):
+    def visit_labeledexpr(self, node):
+        return True
+
+    def generic_visit(self, node):
+        return any([self.visit(c) for c in node.get_children()])
+
+
+class _LabelNames(Visitor):
+    def __init__(self):
+        self.names = []
+
+    def visit_labeledexpr(self, node):
+        if node.name not in self.names:
+            self.names.append(node.name)
+        self.visit(node.expr)
+
+    def visit_precedenceexpr(self, node):
+        # the labels of the operator nodes
+        for name in PRECEDENCE_LABELS:
+            if name not in self.names:
+                self.names.append(name)
+
+
+class _Labels(Visitor):
+    """
+    Return (tried, bound): the labels set whenever an expression is tried,
+    and the labels set whenever it matches. A labeled expression sets its
+    label even if it fails.
+    """
+    def visit_labeledexpr(self, node):
+        tried, bound = self.visit(node.expr)
+        return tried | set([node.name]), bound | set([node.name])
+
+    def visit_seqexpr(self, node):
+        bound = set()
+        for expr in node.exprs:
+            bound |= self.visit(expr)[1]
+        if not node.exprs:
+            return set(), bound
+        return self.visit(node.exprs[0])[0], bound
+
+    visit_factoredchoiceexpr = visit_seqexpr
+
+    def visit_choiceexpr(self, node):
+        # the alternatives are tried in order until one matches
+        tried = set()
+        bound = None
+        for expr in node.exprs:
+            expr_tried, expr_bound = self.visit(expr)
+            if bound is None:
+                bound = tried | expr_bound
+            else:
+                bound &= tried | expr_bound
+            tried |= expr_tried
+        if not node.exprs:
+            return set(), set()
+        return self.visit(node.exprs[0])[0], bound
+
+    def _optional(self, node):
+        tried = self.visit(node.expr)[0]
+        return tried, tried
+
+    visit_maybeexpr = _optional
+    visit_zeroormoreexpr = _optional
+    visit_not = _optional
+
+    def visit_oneormoreexpr(self, node):
+        return self.visit(node.expr)
+
+    visit_lookahead = visit_oneormoreexpr
+
+    def visit_separatedexpr(self, node):
+        # the separators are only tried after an item
+        tried, bound = self.visit(node.item)
+        if node.at_least_one:
+            return tried, bound
+        return tried, tried
+
+    def visit_precedenceexpr(self, node):
+        # all the operator nodes set their labels
+        return set(), set(PRECEDENCE_LABELS)
+
+    def generic_visit(self, node):
+        # terminals, rule references, prefixes...
+        return set(), set()
+
+
+def can_fail(expr):
+    "Return False if `expr` always matches"
+    return _CanFail().visit(expr)
+
+
+def can_consume(expr):
+    "Return False if `expr` never moves the parser position"
+    return _CanConsume().visit(expr)
+
+
+def has_cut(expr):
+    "Return True if `expr` contains a cut"
+    return _HasCut().visit(expr)
+
+
+def has_label(expr):
+    "Return True if `expr` contains a labeled expression"
+    return _HasLabel().visit(expr)
+
+
+def label_names(expr):
+    "Return the names of the labels of `expr`, in order"
+    visitor = _LabelNames()
+    visitor.visit(expr)
+    return visitor.names
+
+
+def bound_labels(expr):
+    "Return the set of the labels always set when `expr` matches"
+    return _Labels().visit(expr)[1]
+
+
+# max number of case variants of a case-insensitive literal to put in a set
+MAX_CASE_VARIANTS = 64
+
+# the non-ascii chars that match an ascii letter, ignoring the case
+_SPECIAL_FOLDS = {
+    "i": u"\u0130\u0131",
+    "k": u"\u212a",
+    "s": u"\u017f",
+}
+
+
+def case_chars(char):
+    """
+    Return the chars whose lowercase is the lowercase of the ascii `char`,
+    e.g. "k", "K" and the kelvin sign for "k"
+    """
+    lower = char.lower()
+    chars = set([lower, char.upper()])
+    chars.update([c for c in _SPECIAL_FOLDS.get(lower, "")
+                  if c.lower() == lower])
+    return chars
+
+
+def case_variants(lit):
+    """
+    Return a frozenset of the spellings of an ascii `lit`, ignoring the
+    case as str.lower does, None if there are too many or if `lit` isn't
+    ascii
+    """
+    if not all([ord(c) < 128 for c in lit]):
+        return None
+    chars = [sorted(case_chars(c)) for c in lit]
+    count = 1
+    for spellings in chars:
+        count *= len(spellings)
+    if count > MAX_CASE_VARIANTS:
+        return None
+    return frozenset(["".join(spelling)
+                      for spelling in itertools.product(*chars)])
+
+
+def _union(first1, first2):
+    if first1 is None or first2 is None:
+        return None
+    return first1 | first2
+
+
+def _ignorecase(chars):
+    "The chars that match `chars` ignoring the case, None if unknown"
+    result = set()
+    for c in chars:
+        if c.lower() == c.upper():
+            result.add(c)
+        elif ord(c) < 128:
+            result.update([c.lower(), c.upper()])
+            result.update(_SPECIAL_FOLDS.get(c.lower(), ""))
+        else:
+            return None
+    return frozenset(result)
+
+
+# a regex char set larger than this is considered as any char
+_MAX_REGEX_RANGE = 256
+
+
+_WHITESPACES = []
+
+
+def _whitespaces():
+    "The chars matched by `\\s`"
+    if not _WHITESPACES:
+        # all the unicode white spaces are in the BMP
+        _WHITESPACES.extend(
+            [six.unichr(c) for c in range(0x10000) if six.unichr(c).isspace()])
+    return _WHITESPACES
+
+
+def _regex_first(items, ignorecase):
+    "(nullable, first) of a parsed regex"
+    first = frozenset()
+    for op, av in items:
+        nullable, item_first = _regex_item_first(op, av, ignorecase)
+        first = _union(first, item_first)
+        if not nullable:
+            return False, first
+    return True, first
+
+
+def _regex_item_first(op, av, ignorecase):
+    if op is sre_parse.LITERAL:
+        chars = [av]
+    elif op is sre_parse.IN:
+        chars = []
+        for in_op, in_av in av:
+            if in_op is sre_parse.LITERAL:
+                chars.append(in_av)
+            elif in_op is sre_parse.RANGE:
+                if in_av[1] - in_av[0] > _MAX_REGEX_RANGE:
+                    return False, None
+                chars.extend(range(in_av[0], in_av[1] + 1))
+            elif in_av is sre_parse.CATEGORY_SPACE:
+                chars.extend([ord(c) for c in _whitespaces()])
+            else:
+                # negated sets and categories (\\d, \\w...)
+                return False, None
+    elif op is sre_parse.SUBPATTERN:
+        if av[1] & re.IGNORECASE:
+            ignorecase = True
+        return _regex_first(av[-1], ignorecase)
+    elif op is sre_parse.BRANCH:
+        nullable = False
+        first = frozenset()
+        for branch in av[1]:
+            branch_nullable, branch_first = _regex_first(branch, ignorecase)
+            nullable = nullable or branch_nullable
+            first = _union(first, branch_first)
+        return nullable, first
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+        nullable, first = _regex_first(av[2], ignorecase)
+        return nullable or av[0] == 0, first
+    elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+        return _regex_first(av, ignorecase)
+    elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return True, frozenset()
+    else:
+        return True, None
+    chars = frozenset([six.unichr(c) for c in chars])
+    if ignorecase:
+        chars = _ignorecase(chars)
+    return False, chars
+
+
+def regex_first(regex):
+    "(nullable, first) of a compiled regex"
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return True, None
+    return _regex_first(parsed, bool(regex.flags & re.IGNORECASE))
+
+
+_IDENTIFIER_STARTS = frozenset(string.ascii_letters + "_")
+
+
+class _First(Visitor):
+    """
+    Return (nullable, first) for an expression, where `first` is the
+    frozenset of the chars that can start a non-empty match, or None if
+    it may be any char. `rules` maps the rule names to their (nullable,
+    first).
+    """
+    def __init__(self, rules):
+        self.rules = rules
+
+    def visit_literalexpr(self, node):
+        if node.lit == "":
+            return True, frozenset()
+        if node.ignorecase:
+            return False, _ignorecase(node.lit[0])
+        return False, frozenset(node.lit[0])
+
+    def visit_charrangeexpr(self, node):
+        return False, frozenset(node.chars)
+
+    def visit_anycharexpr(self, node):
+        return False, None
+
+    def visit_regexexpr(self, node):
+        return regex_first(node.re)
+
+    def visit_keywordsetexpr(self, node):
+        if node.identifiers:
+            return False, _IDENTIFIER_STARTS
+        first = frozenset([k[0] for k in node.words])
+        if node.ignorecase:
+            first = frozenset("".join(first).lower() + "".join(first).upper())
+        return False, first
+
+    def visit_ruleexpr(self, node):
+        return self.rules.get(node.rulename, (True, None))
+
+    def visit_memoizedexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_labeledexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_rule(self, node):
+        return self.visit(node.expr)
+
+    def visit_seqexpr(self, node):
+        first = frozenset()
+        for expr in node.exprs:
+            nullable, expr_first = self.visit(expr)
+            first = _union(first, expr_first)
+            if not nullable:
+                return False, first
+        return True, first
+
+    visit_factoredchoiceexpr = visit_seqexpr
+
+    def visit_choiceexpr(self, node):
+        nullable = False
+        first = frozenset()
+        for expr in node.exprs:
+            expr_nullable, expr_first = self.visit(expr)
+            nullable = nullable or expr_nullable
+            first = _union(first, expr_first)
+        return nullable, first
+
+    def visit_oneormoreexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_separatedexpr(self, node):
+        nullable, first = self.visit(node.item)
+        return nullable or not node.at_least_one, first
+
+    def visit_precedenceexpr(self, node):
+        # the operand, or a prefix operator
+        nullable, first = self.visit(node.operand)
+        for _, kind, expr in node.levels:
+            if kind == "prefix":
+                first = _union(first, self.visit(expr)[1])
+        return nullable, first
+
+    def _optional(self, node):
+        return True, self.visit(node.expr)[1]
+
+    visit_maybeexpr = _optional
+    visit_zeroormoreexpr = _optional
+
+    def _empty(self, node):
+        return True, frozenset()
+
+    visit_not = _empty
+    visit_lookahead = _empty
+    visit_cutexpr = _empty
+    # already matched by the enclosing FactoredChoiceExpr
+    visit_prefixexpr = _empty
+
+    def generic_visit(self, node):
+        return True, None
+
+
+class FirstSets(object):
+    """
+    Nullability and FIRST sets of the expressions of a grammar. The sets of
+    the rules are computed once, by fixed point iteration.
+    """
+    def __init__(self, rules):
+        self.rules = dict([(r.name, (False, frozenset())) for r in rules])
+        visitor = _First(self.rules)
+        changed = True
+        while changed:
+            changed = False
+            for rule in rules:
+                result = visitor.visit(rule.expr)
+                if result != self.rules[rule.name]:
+                    self.rules[rule.name] = result
+                    changed = True
+        self.visitor = visitor
+
+    def __call__(self, expr):
+        "Return (nullable, first) of `expr`"
+        return self.visitor.visit(expr)
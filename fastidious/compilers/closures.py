@@ -0,0 +1,722 @@
+"""
+Closure compiler: an interpreted backend that doesn't generate code.
+
+Each expression is compiled to a python closure `match(parser, pos, args)`
+that returns `(value, end)`, or `(NoMatch, -1)` if it fails. The rules,
+the constants, the actions and the packrat tables are resolved when the
+closures are built, not when they run: the closures only read
+`parser.input`, and `parser.pos` is only written back before calling an
+action, a cut, and at the end of a rule method.
+
+`args` is the dict of the labels of the enclosing rule, or None if its
+action doesn't take labels.
+
+Two sets of closures are built for each parser: one tracks the errors
+(`p_nomatch`), the other uses the optimizations of the code generator
+(FIRST sets, literal dispatch, regular fragments) and reports nothing. The
+rule methods pick one depending on `parser._p_tracking`.
+"""
+import six
+
+from fastidious.compiler.astutils import Visitor
+from fastidious.compiler.action.pyclass import (_SimpleArgAction,
+                                                _SimpleExprAction,
+                                                _SimpleMethAction)
+from fastidious.compilers.analysis import case_variants, has_cut
+from fastidious.expressions import CharRangeExpr, AnyCharExpr, PrecedenceExpr
+
+if six.PY2:
+    from types import UnboundMethodType
+
+
+def rule_action(parser, rule):
+    """
+    Return the function that computes the value of `rule` from (parser,
+    value, start, end, args), None if it's the value of its body
+    """
+    action = rule.action
+    if action is None:
+        return None
+    if action == "$" or getattr(action, "captures_text", False):
+        return lambda p, value, start, end, args: p.input[start:end]
+    if isinstance(action, _SimpleArgAction):
+        name = action.argname
+        return lambda p, value, start, end, args: args.get(name)
+    if isinstance(action, _SimpleExprAction):
+        func = action.func
+        labels = action.labels
+
+        def expr_action(p, value, start, end, args):
+            p.pos = end
+            return func(p, value, *[args.get(l) for l in labels])
+        return expr_action
+    if isinstance(action, _SimpleMethAction):
+        # the subclasses may override the action
+        meth = getattr(parser, action.meth.__name__)
+    else:
+        meth = action
+
+    def meth_action(p, value, start, end, args):
+        p.pos = end
+        return meth(p, value, **args)
+    return meth_action
+
+
+def uses_labels(rule):
+    "True if the action of `rule` takes the labels"
+    action = rule.action
+    if isinstance(rule.expr, PrecedenceExpr):
+        # the action reduces the operator nodes, with their own labels
+        return False
+    if action is None or action == "$" or getattr(
+            action, "captures_text", False):
+        return False
+    return not isinstance(action, _SimpleExprAction) or bool(action.labels)
+
+
+class ClosureBuilder(Visitor):
+    """
+    Build the closures of the rules of `parser`. `tracking` is True for the
+    closures that report the errors. `inlined` maps the names of the rules
+    whose body replaces their references to the rules (see
+    fastidious.compilers.optimize.inlined_rules).
+    """
+    def __init__(self, parser, tracking, inlined=None, debug=False):
+        self.parser = parser
+        self.tracking = tracking
+        self.inlined = inlined or {}
+        self.debug = debug
+        self.NoMatch = parser.NoMatch
+        self.fail = (parser.NoMatch, -1)
+        self.constants = getattr(parser, "_p_py_constants", {})
+        self.cuts = any([has_cut(r) for r in parser.__rules__])
+        # name -> [closure], filled when all the rules are built
+        self.cells = dict([(r.name, [None]) for r in parser.__rules__])
+        # the bodies of the inlined rules, built once
+        self.bodies = {}
+
+    def __call__(self):
+        "Return the closures of the rules, by name"
+        rules = {}
+        for rule in self.parser.__rules__:
+            rules[rule.name] = self.cells[rule.name][0] = self.visit(rule)
+        return rules
+
+    def consts(self, node):
+        if self.tracking:
+            # the optimizations don't report the errors
+            return {}
+        return self.constants.get(node.id, {})
+
+    def visit(self, node):
+        regex = self.consts(node).get("fused")
+        if regex is None:
+            return Visitor.visit(self, node)
+        # a regular fragment (see fastidious.compilers.regular)
+        value = eval("lambda m: %s" % node._py_fused)
+        fail = self.fail
+        match_regex = regex.match
+
+        def match(p, pos, args):
+            m = match_regex(p.input, pos)
+            if m:
+                return value(m), m.end()
+            return fail
+        return match
+
+    def report(self, id):
+        "Return a function that records the failure of `id` at a position"
+        if not self.tracking:
+            return None
+
+        def report(p, pos):
+            p.p_nomatch(id, pos)
+        return report
+
+    def backtrack(self, child):
+        "Push the start position of `child` on the backtrack stack"
+        if not self.cuts:
+            return child
+
+        def match(p, pos, args):
+            bt = p._p_backtrack
+            bt.append(pos)
+            result = child(p, pos, args)
+            bt.pop()
+            return result
+        return match
+
+    def visit_rule(self, node):
+        self.labels = uses_labels(node)
+        body = self.visit(node.expr)
+        action = rule_action(self.parser, node)
+        if isinstance(node.expr, PrecedenceExpr):
+            action = None
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+        labels = self.labels
+        if node.left_recursive:
+            match = self._grow(node, body, action, report)
+        elif action is None and report is None:
+            match = body
+        else:
+            def match(p, pos, args):
+                args = {} if labels else None
+                result, end = body(p, pos, args)
+                if result is NoMatch:
+                    if report is not None:
+                        report(p, pos)
+                    return fail
+                if action is None:
+                    return result, end
+                result = action(p, result, pos, end, args)
+                if result is NoMatch:
+                    # the action rejects the match
+                    return fail
+                return result, end
+        if self.debug:
+            match = self._debugged(node, match)
+        return match
+
+    def _grow(self, node, body, action, report):
+        """
+        The closure that grows the match of the left recursive rule `node`
+        (see Rule.grow)
+        """
+        id = node.id
+        labels = self.labels
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def match(p, pos, args):
+            seeds = p._p_seeds
+            key = (id, pos)
+            seed = seeds.get(key)
+            if seed is None:
+                seeds[key] = seed = fail
+                while 42:
+                    args = {} if labels else None
+                    result, end = body(p, pos, args)
+                    if result is NoMatch or end <= seed[1]:
+                        break
+                    if action is not None:
+                        result = action(p, result, pos, end, args)
+                        if result is NoMatch:
+                            # the seed grows no more
+                            break
+                    seeds[key] = seed = (result, end)
+                del seeds[key]
+            if seed[0] is NoMatch and report is not None:
+                report(p, pos)
+            return seed
+        return match
+
+    def _debugged(self, node, rule):
+        name = "%s(%s)" % (node.name, node.id)
+        NoMatch = self.NoMatch
+
+        def match(p, pos, args):
+            p.pos = pos
+            p.p_debug(name)
+            p._debug_indent += 1
+            result, end = rule(p, pos, args)
+            p._debug_indent -= 1
+            if result is NoMatch:
+                p.pos = pos
+                p.p_debug("%s -- NO MATCH" % name)
+            else:
+                p.pos = end
+                p.p_debug("%s -- MATCH %r" % (name, result))
+            return result, end
+        return match
+
+    def visit_ruleexpr(self, node):
+        rule = self.inlined.get(node.rulename)
+        if rule is not None:
+            if rule.name not in self.bodies:
+                # inlined rules have no labels
+                labels = self.labels
+                self.labels = False
+                self.bodies[rule.name] = self.visit(rule.expr)
+                self.labels = labels
+            body = self.bodies[rule.name]
+            report = self.report(rule.id)
+            if report is None:
+                return body
+            NoMatch = self.NoMatch
+
+            def inlined(p, pos, args):
+                result = body(p, pos, None)
+                if result[0] is NoMatch:
+                    # the rule still reports its failure, for its alias
+                    report(p, pos)
+                return result
+            return inlined
+        cell = self.cells[node.rulename]
+
+        def match(p, pos, args):
+            return cell[0](p, pos, None)
+        return match
+
+    def visit_memoizedexpr(self, node):
+        child = self.visit(node.expr)
+        index = node.index
+        NoMatch = self.NoMatch
+
+        def match(p, pos, args):
+            table = p._p_memo[index]
+            end = table[pos]
+            if end is None:
+                result, end = child(p, pos, None)
+                if result is NoMatch:
+                    end = pos
+                table[pos] = end
+                table[~pos] = result
+                return result, end
+            return table[~pos], end
+        return match
+
+    def visit_regexexpr(self, node):
+        match_regex = node.re.match
+        report = self.report(node.id)
+        fail = self.fail
+
+        def match(p, pos, args):
+            m = match_regex(p.input, pos)
+            if m:
+                return m.group(), m.end()
+            if report is not None:
+                report(p, pos)
+            return fail
+        return match
+
+    def visit_literalexpr(self, node):
+        lit = node.lit
+        length = len(lit)
+        report = self.report(node.id)
+        fail = self.fail
+        if length == 0:
+            return lambda p, pos, args: ("", pos)
+        if not node.ignorecase:
+            def match(p, pos, args):
+                if p.input.startswith(lit, pos):
+                    return lit, pos + length
+                if report is not None:
+                    report(p, pos)
+                return fail
+            return match
+        variants = case_variants(lit)
+        lower = lit.lower()
+
+        def match(p, pos, args):
+            end = pos + length
+            text = p.input[pos:end]
+            if variants is not None and text in variants or (
+                    variants is None and text.lower() == lower):
+                return text, end
+            if report is not None:
+                report(p, pos)
+            return fail
+        return match
+
+    def _chars(self, node, chars):
+        # `chars` is None for any char
+        report = self.report(node.id)
+        fail = self.fail
+
+        def match(p, pos, args):
+            char = p.input[pos:pos + 1]
+            if char and (chars is None or char in chars):
+                return char, pos + 1
+            if report is not None:
+                report(p, pos)
+            return fail
+        return match
+
+    def visit_charrangeexpr(self, node):
+        return self._chars(node, node.charset)
+
+    def visit_keywordsetexpr(self, node):
+        match_regex = node.re.match
+        classify = node.classify
+        report = self.report(node.id)
+        fail = self.fail
+
+        def match(p, pos, args):
+            m = match_regex(p.input, pos)
+            if m:
+                value = classify(m.group())
+                if value is not None:
+                    return value, m.end()
+            if report is not None:
+                report(p, pos)
+            return fail
+        return match
+
+    def visit_anycharexpr(self, node):
+        return self._chars(node, None)
+
+    def visit_seqexpr(self, node):
+        children = [self.visit(e) for e in node.exprs]
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+        if len(children) == 2:
+            # the most common sequence, without the loop
+            first, second = children
+
+            def pair(p, pos, args):
+                result1, end = first(p, pos, args)
+                if result1 is not NoMatch:
+                    result2, end = second(p, end, args)
+                    if result2 is not NoMatch:
+                        return [result1, result2], end
+                if report is not None:
+                    report(p, pos)
+                return fail
+            return pair
+
+        def match(p, pos, args):
+            start = pos
+            results = []
+            for child in children:
+                result, pos = child(p, pos, args)
+                if result is NoMatch:
+                    if report is not None:
+                        report(p, start)
+                    return fail
+                results.append(result)
+            return results, pos
+        return match
+
+    def visit_choiceexpr(self, node):
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+        consts = self.consts(node)
+        children = [self.visit(e) for e in node.exprs]
+        if "dispatch" in consts:
+            # a choice of literals: find the candidates with the next char
+            candidates = consts["dispatch"].get
+
+            def dispatch(p, pos, args):
+                input = p.input
+                for lit in candidates(input[pos:pos + 1], ()):
+                    if input.startswith(lit, pos):
+                        return lit, pos + len(lit)
+                return fail
+            return dispatch
+        # the FIRST sets of the alternatives, None if they can't be skipped
+        firsts = [self.consts(e).get("first") for e in node.exprs]
+        alternatives = list(zip(children, firsts))
+        predict = any([f is not None for f in firsts])
+        # a cut in an alternative (not the last) commits the choice
+        commits = [self.cuts] * (len(children) - 1) + [False]
+        if any(commits):
+            alternatives = list(zip(children, commits))
+
+            def match(p, pos, args):
+                bt = p._p_backtrack
+                for child, commit in alternatives:
+                    if commit:
+                        bt.append(pos)
+                        result = child(p, pos, args)
+                        if result[0] is not NoMatch:
+                            bt.pop()
+                            return result
+                        if bt.pop() is None:
+                            break
+                    else:
+                        result = child(p, pos, args)
+                        if result[0] is not NoMatch:
+                            return result
+                if report is not None:
+                    report(p, pos)
+                return fail
+        elif predict:
+            def match(p, pos, args):
+                char = p.input[pos:pos + 1]
+                for child, first in alternatives:
+                    if first is not None and char not in first:
+                        continue
+                    result = child(p, pos, args)
+                    if result[0] is not NoMatch:
+                        return result
+                return fail
+        else:
+            def match(p, pos, args):
+                for child in children:
+                    result = child(p, pos, args)
+                    if result[0] is not NoMatch:
+                        return result
+                if report is not None:
+                    report(p, pos)
+                return fail
+        return match
+
+    def visit_factoredchoiceexpr(self, node):
+        prefix = [(e.id, self.visit(e)) for e in node.prefix]
+        choice = self.visit(node.choice)
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def match(p, pos, args):
+            prefixes = p._p_prefixes
+            # a recursive call of the choice shadows the values
+            saved = [prefixes.get(id) for id, _ in prefix]
+            end = pos
+            for id, child in prefix:
+                result, end = child(p, end, args)
+                if result is NoMatch:
+                    break
+                prefixes[id] = result
+            else:
+                result, end = choice(p, end, args)
+            for (id, _), value in zip(prefix, saved):
+                prefixes[id] = value
+            if result is NoMatch:
+                if report is not None:
+                    report(p, pos)
+                return fail
+            return result, end
+        return match
+
+    def visit_prefixexpr(self, node):
+        id = node.prefix.id
+        return lambda p, pos, args: (p._p_prefixes[id], pos)
+
+    def visit_precedenceexpr(self, node):
+        """
+        `climb(p, pos, level)` matches an operand and the operators of
+        precedence `level` or more (see PrecedenceExpr.climb)
+        """
+        operand = self.visit(node.operand)
+        prefixes = []
+        operators = []
+        for level, kind, expr in node.levels:
+            if kind == "prefix":
+                prefixes.append((level, self.visit(expr)))
+            else:
+                operators.append((level, kind, self.visit(expr)))
+        action = None
+        if node.rule is not None:
+            action = rule_action(self.parser, node.rule)
+        cuts = self.cuts
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def reduce(p, value, start, end, l, op, r):
+            if action is None:
+                return value
+            return action(p, value, start, end, {"l": l, "op": op, "r": r})
+
+        def prefix(p, start, level, op_level, child):
+            op, end = child(p, start, None)
+            if op is NoMatch:
+                return fail
+            right, end = climb(p, end, max(op_level, level))
+            if right is NoMatch:
+                return fail
+            return reduce(p, [op, right], start, end, None, op, right), end
+
+        def operator(p, pos, start, left, op_level, kind, child):
+            op, end = child(p, pos, None)
+            if op is NoMatch:
+                return fail
+            if kind == "postfix":
+                return reduce(p, [left, op], start, end, left, op, None), end
+            # the right operand of a left associative operator can't
+            # contain the operators of its level
+            right, end = climb(p, end, op_level + 1
+                               if kind == "left" else op_level)
+            if right is NoMatch:
+                return fail
+            return reduce(p, [left, op, right], start, end,
+                          left, op, right), end
+
+        if cuts:
+            def backtracked(alternative):
+                def match(p, pos, *args):
+                    bt = p._p_backtrack
+                    bt.append(pos)
+                    result = alternative(p, pos, *args)
+                    bt.pop()
+                    return result
+                return match
+            prefix = backtracked(prefix)
+            operator = backtracked(operator)
+
+        def climb(p, pos, level):
+            start = pos
+            for op_level, child in prefixes:
+                left, pos = prefix(p, start, level, op_level, child)
+                if left is not NoMatch:
+                    break
+            else:
+                left, pos = operand(p, start, None)
+                if left is NoMatch:
+                    return fail
+            while 42:
+                for op_level, kind, child in operators:
+                    if op_level < level:
+                        continue
+                    node, end = operator(p, pos, start, left,
+                                         op_level, kind, child)
+                    if node is not NoMatch:
+                        left, pos = node, end
+                        break
+                else:
+                    return left, pos
+
+        return lambda p, pos, args: climb(p, pos, 0)
+
+    def visit_cutexpr(self, node):
+        commits = node.commits
+
+        def match(p, pos, args):
+            if commits:
+                p._p_backtrack[-1] = None
+            p.pos = pos
+            p.p_cut()
+            return "", pos
+        return match
+
+    def visit_labeledexpr(self, node):
+        child = self.visit(node.expr)
+        if not self.labels:
+            return child
+        name = node.name
+
+        def match(p, pos, args):
+            result = child(p, pos, args)
+            # the label is set even if the expression fails
+            args[name] = result[0]
+            return result
+        return match
+
+    def _repeat(self, node, at_least_one):
+        child = self.backtrack(self.visit(node.expr))
+        join = isinstance(node.expr, (CharRangeExpr, AnyCharExpr))
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def match(p, pos, args):
+            results = []
+            while 42:
+                result, end = child(p, pos, args)
+                if result is NoMatch:
+                    break
+                results.append(result)
+                pos = end
+            if at_least_one and not results:
+                if report is not None:
+                    report(p, pos)
+                return fail
+            if join:
+                return "".join(results), pos
+            return results, pos
+        return match
+
+    def visit_zeroormoreexpr(self, node):
+        return self._repeat(node, False)
+
+    def visit_oneormoreexpr(self, node):
+        return self._repeat(node, True)
+
+    def visit_separatedexpr(self, node):
+        item = self.visit(node.item)
+        separator = self.visit(node.separator)
+        at_least_one = node.at_least_one
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def following(p, pos, args):
+            "A separator and the next item"
+            result, end = separator(p, pos, args)
+            if result is NoMatch:
+                return fail
+            return item(p, end, args)
+
+        first = self.backtrack(item)
+        following = self.backtrack(following)
+
+        def match(p, pos, args):
+            results = []
+            result, end = first(p, pos, args)
+            while result is not NoMatch:
+                results.append(result)
+                pos = end
+                result, end = following(p, pos, args)
+            if at_least_one and not results:
+                if report is not None:
+                    report(p, pos)
+                return fail
+            return results, pos
+        return match
+
+    def visit_maybeexpr(self, node):
+        child = self.backtrack(self.visit(node.expr))
+        NoMatch = self.NoMatch
+
+        def match(p, pos, args):
+            result = child(p, pos, args)
+            if result[0] is NoMatch:
+                return "", pos
+            return result
+        return match
+
+    def _predicate(self, node, negative):
+        child = self.backtrack(self.visit(node.expr))
+        report = self.report(node.id)
+        NoMatch = self.NoMatch
+        fail = self.fail
+
+        def match(p, pos, args):
+            if (child(p, pos, args)[0] is NoMatch) is negative:
+                return "", pos
+            if report is not None:
+                report(p, pos)
+            return fail
+        return match
+
+    def visit_not(self, node):
+        return self._predicate(node, True)
+
+    def visit_lookahead(self, node):
+        return self._predicate(node, False)
+
+
+def _method(name, tracked, fast, NoMatch):
+    "The method of the rule `name`"
+    def method(self):
+        start = self.pos
+        if self._p_tracking:
+            result, end = tracked(self, start, None)
+        else:
+            result, end = fast(self, start, None)
+        if result is NoMatch:
+            self.pos = start
+        else:
+            self.pos = end
+        return result
+    method.__name__ = name
+    return method
+
+
+def build_closures(parser, inlined=None, debug=False):
+    "Add the methods that run the closures of the rules to `parser`"
+    tracked = ClosureBuilder(parser, True, inlined, debug)()
+    fast = ClosureBuilder(parser, False, inlined, debug)()
+    for rule in parser.__rules__:
+        method = _method(rule.name, tracked[rule.name], fast[rule.name],
+                         parser.NoMatch)
+        method.__doc__ = rule.as_grammar()
+        if six.PY3:
+            method.__qualname__ = "%s.%s" % (parser.__name__, rule.name)
+        else:
+            method = UnboundMethodType(method, None, parser)
+        setattr(parser, rule.name, method)
@@ -0,0 +1,252 @@
+"""
+Memoization policies: decide which rules get a packrat table.
+
+A rule is memoized unless:
+
+- it's annotated `@nomemo`, or the memo plan says so,
+- or it's cheap: its body doesn't reference other rules and is small,
+- or it is never called twice at the same position: it's referenced only
+  once, at the left edge of a rule that is itself memoized or never called
+  twice at the same position.
+
+`@memo` (or the plan) forces the memoization of a rule.
+"""
+import copy
+import json
+
+import six
+
+from fastidious.compiler.astutils import Visitor
+from fastidious.compilers.analysis import can_consume
+
+
+# rules whose body is at most this number of nodes and doesn't reference
+# other rules are considered cheaper to re-parse than to memoize
+CHEAP_RULE_SIZE = 8
+
+
+class _RuleSize(Visitor):
+    """Number of nodes of an expression, None if it references rules"""
+    def visit_ruleexpr(self, node):
+        return None
+
+    def visit_memoizedexpr(self, node):
+        return None
+
+    def generic_visit(self, node):
+        size = 1
+        for child in node.get_children():
+            child_size = self.visit(child)
+            if child_size is None:
+                return None
+            size += child_size
+        return size
+
+
+class _CallSites(Visitor):
+    """
+    Find the rule references of each rule. A reference is at the left edge
+    if it's always called at the start position of the calling rule.
+    """
+    def __init__(self, rules):
+        # rulename -> [(calling rule name, at left edge), ...]
+        self.sites = {}
+        for rule in rules:
+            self.caller = rule.name
+            self.left_edge = True
+            self.visit(rule.expr)
+
+    def visit_ruleexpr(self, node):
+        self.sites.setdefault(node.rulename, []).append(
+            (self.caller, self.left_edge))
+
+    def visit_memoizedexpr(self, node):
+        self.visit(node.expr)
+
+    def visit_seqexpr(self, node):
+        left_edge = self.left_edge
+        for expr in node.exprs:
+            self.visit(expr)
+            if can_consume(expr):
+                self.left_edge = False
+        self.left_edge = left_edge
+
+    visit_factoredchoiceexpr = visit_seqexpr
+
+    def visit_choiceexpr(self, node):
+        for expr in node.exprs:
+            self.visit(expr)
+
+    def _repeated(self, node):
+        # the iterations are called at different positions
+        left_edge = self.left_edge
+        self.left_edge = False
+        for child in node.get_children():
+            self.visit(child)
+        self.left_edge = left_edge
+
+    visit_zeroormoreexpr = _repeated
+    visit_oneormoreexpr = _repeated
+    visit_separatedexpr = _repeated
+    # the operands and the operators are matched at each operator
+    visit_precedenceexpr = _repeated
+
+
+class MemoPolicy(object):
+    def __init__(self, rules, plan=None):
+        self.rules = dict([(r.name, r) for r in rules])
+        self.plan = plan
+        self.sites = _CallSites(rules).sites
+        self._memoized = {}
+        self._single_entry = {}
+
+    def forced(self, rulename):
+        "Return True or False if the memoization is forced, None otherwise"
+        rule = self.rules[rulename]
+        if "memo" in rule.annotations:
+            return True
+        if "nomemo" in rule.annotations:
+            return False
+        if self.plan is not None:
+            return self.plan.memoize(rulename)
+        return None
+
+    def is_cheap(self, rulename):
+        size = _RuleSize().visit(self.rules[rulename].expr)
+        return size is not None and size <= CHEAP_RULE_SIZE
+
+    def is_single_entry(self, rulename):
+        "True if the rule can't be called twice at the same position"
+        if rulename not in self._single_entry:
+            # guard against cycles
+            self._single_entry[rulename] = False
+            sites = self.sites.get(rulename, [])
+            if not sites:
+                # only called from outside the grammar
+                single = True
+            elif len(sites) > 1:
+                single = False
+            else:
+                caller, left_edge = sites[0]
+                if left_edge:
+                    single = self.memoized(caller)
+                    single = single or self.is_single_entry(caller)
+                else:
+                    single = False
+            self._single_entry[rulename] = single
+        return self._single_entry[rulename]
+
+    def memoized(self, rulename):
+        if rulename not in self._memoized:
+            memo = self.forced(rulename)
+            if memo is None:
+                cheap = self.is_cheap(rulename)
+                memo = not (cheap or self.is_single_entry(rulename))
+            self._memoized[rulename] = memo
+        return self._memoized[rulename]
+
+
+def memoized_rules(rules, plan=None):
+    "Return the names of the rules to memoize"
+    policy = MemoPolicy(rules, plan)
+    return set([r.name for r in rules if policy.memoized(r.name)])
+
+
+class MemoPlan(object):
+    """
+    Memoization decisions recorded by `train_memo_plan`. `stats` maps rule
+    names to dicts with the keys `memoize`, `lookups` and `hits`.
+    """
+    def __init__(self, stats=None):
+        self.stats = stats or {}
+
+    def memoize(self, rulename):
+        "Return True or False if the plan knows the rule, None otherwise"
+        stats = self.stats.get(rulename)
+        if stats is None:
+            return None
+        return stats["memoize"]
+
+    def save(self, out):
+        "Write the plan as JSON to `out`, a file name or a file object"
+        if isinstance(out, six.string_types):
+            with open(out, "w") as f:
+                return self.save(f)
+        json.dump(self.stats, out, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, source):
+        "Load a plan from a file name or a file object"
+        if isinstance(source, six.string_types):
+            with open(source) as f:
+                return cls.load(f)
+        return cls(json.load(source))
+
+
+class _CountingMemoTable(dict):
+    """Sparse packrat table that counts the lookups and the hits"""
+    __slots__ = ("counts", )
+
+    def __getitem__(self, pos):
+        value = self.get(pos)
+        if pos >= 0:
+            self.counts[0] += 1
+            if value is not None:
+                self.counts[1] += 1
+        return value
+
+
+class _CountingMemoTables(dict):
+    def __init__(self, counts):
+        dict.__init__(self)
+        self.counts = counts
+
+    def __missing__(self, index):
+        table = self[index] = _CountingMemoTable()
+        table.counts = self.counts.setdefault(index, [0, 0])
+        return table
+
+    def p_release(self, start, end):
+        # the released matches would never be hit: keep them, it doesn't
+        # change the counts
+        pass
+
+
+def train_memo_plan(parser, corpus, methodname=None, min_hit_rate=0.05):
+    """
+    Parse each text of `corpus` with every rule of `parser` memoized and
+    return a MemoPlan. Rules whose memo hits are fewer than `min_hit_rate`
+    of the lookups aren't memoized by the plan. The rules not called while
+    parsing the corpus are left to the default policy.
+    """
+    from fastidious.fastidious_compiler import FastidiousCompiler
+    from fastidious.parser_base import ParserMeta
+
+    counts = {}
+
+    def __init__(self, input, *args, **kwargs):
+        parser.__init__(self, input, *args, **kwargs)
+        self._p_memo = _CountingMemoTables(counts)
+
+    trainee = ParserMeta(
+        "%sMemoTraining" % parser.__name__,
+        (parser, ),
+        {
+            "__rules__": copy.deepcopy(parser.__rules__),
+            "__default__": parser.__default__,
+            "__init__": __init__,
+            "p_compiler": FastidiousCompiler(memoize="all"),
+        })
+    for text in corpus:
+        p = trainee(text)
+        getattr(p, methodname or trainee.__default__)()
+
+    stats = {}
+    for index, (lookups, hits) in counts.items():
+        rulename = trainee._p_memo_rules[index]
+        stats[rulename] = dict(
+            memoize=lookups > 0 and hits >= lookups * min_hit_rate,
+            lookups=lookups,
+            hits=hits,
+        )
+    return MemoPlan(stats)
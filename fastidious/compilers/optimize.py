@@ -0,0 +1,269 @@
+"""
+Grammar rewritings enabled by the optimization level of the compiler.
+
+Left-factoring: the consecutive alternatives of a choice that start with the
+same expressions are grouped in a FactoredChoiceExpr, that matches the
+common prefix once. In the alternatives, the prefix is replaced by
+PrefixExpr, that returns the value of the prefix match, so the alternatives
+keep their value shapes and the actions get the same arguments. E.g.::
+
+    (int frac exp) / (int exp) / int
+
+is matched as `int` followed by::
+
+    (<int> frac exp) / (<int> exp) / <int>
+
+Choices with cuts aren't factored: a cut would only commit the group of
+alternatives.
+
+Inlining: the code generator copies the body of the small rules into their
+callers, instead of calling their methods. A rule is inlined if it has no
+action and no labels (its labels would be given to the action of the
+caller), isn't recursive, isn't annotated `@memo`, and its body has at most
+`threshold` nodes, counting the nodes of the rules inlined in it. The
+inlined copies add at most as many nodes as the grammar has.
+
+Text captures: a rule whose action is `p_flatten` returns the text it
+matched if the values of its body are made of the matched text (char
+classes, literals, regexes, predicates, rules without action...). Such
+rules get the `{$}` action instead: they return a slice of the input, and
+the code generator doesn't build the values of their body.
+"""
+import six
+
+from fastidious.compiler.astutils import Mutator, Visitor
+from fastidious.compiler.action.pyclass import (_SimpleMethAction,
+                                                _SimplePyTextAction)
+from fastidious.compilers.analysis import has_cut, has_label
+from fastidious.expressions import (ChoiceExpr, SeqExpr, FactoredChoiceExpr,
+                                    PrefixExpr)
+from fastidious.parser_base import ParserMixin
+
+
+def _items(expr):
+    "The expressions matched in sequence by an alternative"
+    if isinstance(expr, SeqExpr):
+        return list(expr.exprs)
+    return [expr]
+
+
+def _key(expr):
+    "Two expressions with the same key match the same way"
+    return (expr.__class__, expr.as_grammar())
+
+
+def _common_prefix(alternatives):
+    items = [_items(e) for e in alternatives]
+    size = min([len(i) for i in items])
+    length = 0
+    while length < size:
+        keys = set([_key(i[length]) for i in items])
+        if len(keys) > 1:
+            break
+        length += 1
+    return items[0][:length]
+
+
+class _LeftFactoring(Mutator):
+    def visit_choiceexpr(self, node):
+        # factor the nested choices first
+        self.generic_visit(node)
+        if any([has_cut(e) for e in node.exprs]):
+            return node
+        groups = []
+        for expr in node.exprs:
+            if groups and _key(_items(groups[-1][0])[0]) == _key(
+                    _items(expr)[0]):
+                groups[-1].append(expr)
+            else:
+                groups.append([expr])
+        if len(groups) == len(node.exprs):
+            return node
+        if len(groups) == 1:
+            # the whole choice shares a prefix
+            return self.factor(node, node.exprs)
+        node.exprs = tuple([
+            group[0] if len(group) == 1 else self.factor(None, group)
+            for group in groups])
+        return node
+
+    def factor(self, choice, alternatives):
+        prefix = _common_prefix(alternatives)
+        factored = []
+        for expr in alternatives:
+            refs = [PrefixExpr(p) for p in prefix]
+            if isinstance(expr, SeqExpr):
+                expr.exprs = tuple(refs + _items(expr)[len(prefix):])
+                factored.append(expr)
+            else:
+                factored.append(refs[0])
+        if choice is None:
+            choice = ChoiceExpr(*factored)
+        else:
+            choice.exprs = tuple(factored)
+        return FactoredChoiceExpr(prefix, choice)
+
+
+def left_factor(rules):
+    "Left-factor the choices of `rules` in place"
+    for rule in rules:
+        _LeftFactoring().visit(rule)
+
+
+class _Size(Visitor):
+    """
+    Number of nodes of an expression, once the rules of `inlined` (name ->
+    size) are inlined
+    """
+    def __init__(self, inlined=None):
+        self.inlined = inlined or {}
+
+    def visit_ruleexpr(self, node):
+        return self.inlined.get(node.rulename, 1)
+
+    def visit_memoizedexpr(self, node):
+        return self.visit(node.expr)
+
+    def generic_visit(self, node):
+        return 1 + sum([self.visit(c) for c in node.get_children()])
+
+
+class _References(Visitor):
+    """Names of the rules referenced by an expression, once per call"""
+    def __init__(self):
+        self.names = []
+
+    def visit_ruleexpr(self, node):
+        self.names.append(node.rulename)
+
+    def visit_memoizedexpr(self, node):
+        self.visit(node.expr)
+
+
+def _references(expr):
+    visitor = _References()
+    visitor.visit(expr)
+    return visitor.names
+
+
+def inlined_rules(rules, threshold):
+    """
+    Return the rules to inline, by name. The size of a rule counts the
+    nodes of the rules inlined in it, and the inlined copies add at most as
+    many nodes as the grammar has.
+    """
+    references = dict([(r.name, _references(r.expr)) for r in rules])
+    calls = {}
+    for names in references.values():
+        for name in names:
+            calls[name] = calls.get(name, 0) + 1
+    budget = [sum([_Size().visit(r.expr) for r in rules])]
+
+    def recursive(name):
+        seen = set()
+        todo = list(references[name])
+        while todo:
+            ref = todo.pop()
+            if ref == name:
+                return True
+            if ref not in seen and ref in references:
+                seen.add(ref)
+                todo.extend(references[ref])
+        return False
+
+    by_name = dict([(r.name, r) for r in rules])
+    # the sizes of the inlined rules, once their own calls are inlined
+    sizes = {}
+    visited = set()
+
+    def inline(name):
+        "Decide if the rule `name` is inlined, its callees first"
+        if name in visited:
+            return
+        visited.add(name)
+        rule = by_name[name]
+        if rule.action is not None or "memo" in rule.annotations:
+            return
+        if has_label(rule.expr) or recursive(name):
+            return
+        for ref in references[name]:
+            if ref in by_name:
+                inline(ref)
+        size = _Size(sizes).visit(rule.expr)
+        # each call is replaced by the body
+        growth = (size - 1) * calls.get(name, 0)
+        if size <= threshold and growth <= budget[0]:
+            sizes[name] = size
+            budget[0] -= growth
+
+    for rule in rules:
+        inline(rule.name)
+    return dict([(name, by_name[name]) for name in sizes])
+
+
+class _IsText(Visitor):
+    """
+    True if the value of an expression, flattened, is the text it matched.
+    `texts` are the names of the rules whose value is their text.
+    """
+    def __init__(self, texts):
+        self.texts = texts
+
+    def visit_ruleexpr(self, node):
+        return node.rulename in self.texts
+
+    def visit_regexexpr(self, node):
+        return True
+
+    def visit_prefixexpr(self, node):
+        # the prefix is checked as a child of its FactoredChoiceExpr
+        return True
+
+    visit_literalexpr = visit_regexexpr
+    visit_charrangeexpr = visit_regexexpr
+    visit_anycharexpr = visit_regexexpr
+    visit_cutexpr = visit_regexexpr
+
+    def visit_separatedexpr(self, node):
+        # the separators are dropped
+        return False
+
+    def visit_keywordsetexpr(self, node):
+        return not node.identifiers
+
+    def generic_visit(self, node):
+        # sequences, choices, repetitions, predicates, labels: the values
+        # of predicates and failed maybes are ""
+        return all([self.visit(c) for c in node.get_children()])
+
+
+def _flattens(action):
+    if not isinstance(action, _SimpleMethAction):
+        return False
+    return six.get_unbound_function(action.meth) is six.get_unbound_function(
+        ParserMixin.p_flatten)
+
+
+def capture_texts(rules):
+    "Give the `{$}` action to the `{p_flatten}` rules that return their text"
+    rules = dict([(r.name, r) for r in rules])
+    texts = set([name for name, r in rules.items()
+                 if r.action is None or _flattens(r.action)])
+    texts.update([name for name, r in rules.items()
+                  if getattr(r.action, "captures_text", False)])
+    # remove the rules that don't return their text until the set is stable
+    changed = True
+    while changed:
+        changed = False
+        visitor = _IsText(texts)
+        for name in sorted(texts):
+            rule = rules[name]
+            if getattr(rule.action, "captures_text", False):
+                continue
+            if not visitor.visit(rule.expr):
+                texts.discard(name)
+                changed = True
+    for name in texts:
+        if _flattens(rules[name].action):
+            rules[name].action = _SimplePyTextAction(
+                rules[name].action.actionstr)
@@ -0,0 +1,264 @@
+"""
+Regular fragments: the subtrees of a grammar that can be matched by a single
+regex.
+
+A fragment has no labels, no actions, no cuts and no recursion: the rules it
+references are inlined. PEG expressions never backtrack into a match, so the
+choices and the repetitions are translated to atomic groups and possessive
+quantifiers, that need python 3.11.
+
+The value of the fragment is rebuilt from the match with the same shape as
+the value of the original expressions. The repetitions are only regular if
+their values can be rebuilt from the matched text: the repetitions of a
+char class or `.` (joined), and of the fixed width matches whose value is
+their text (lists of chars, of literals...).
+"""
+import re
+import sys
+
+import six
+
+from fastidious.compiler.astutils import VisitorBase
+from fastidious.compilers.analysis import (case_chars, case_variants,
+                                           sre_parse)
+from fastidious.expressions import (LiteralExpr, CharRangeExpr, AnyCharExpr,
+                                    RegexExpr, RuleExpr, Not, LookAhead)
+
+# atomic groups and possessive quantifiers
+FUSE_REGEXES = sys.version_info >= (3, 11)
+
+# fragments with longer patterns are left as they are
+MAX_PATTERN_SIZE = 4096
+
+_SCOPED_FLAGS = frozenset("imsx")
+
+
+class _Fragment(object):
+    """
+    The translation of an expression. `value` is the python expression that
+    rebuilds the value from the match `m`, None if the value is the matched
+    text.
+    """
+    def __init__(self, pattern, value=None):
+        self.pattern = pattern
+        self.value = value
+
+    def width(self):
+        "The (min, max) length of the matches"
+        return sre_parse.parse(self.pattern).getwidth()
+
+
+def _char_ranges(chars):
+    "The content of the regex char class of `chars`"
+    codes = sorted([ord(c) for c in chars])
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    content = []
+    for start, end in ranges:
+        if end - start < 2:
+            content.extend([re.escape(six.unichr(c))
+                            for c in range(start, end + 1)])
+        else:
+            content.append("%s-%s" % (re.escape(six.unichr(start)),
+                                      re.escape(six.unichr(end))))
+    return "".join(content)
+
+
+class _Translator(VisitorBase):
+    """Return the _Fragment of an expression, None if it's not regular"""
+    def __init__(self, rules):
+        self.rules = dict([(r.name, r) for r in rules])
+        # the rules being translated, to detect the recursions
+        self.stack = []
+        self.groups = 0
+
+    def group(self, fragment, capture=False):
+        """
+        Return the pattern and the value of a sub-fragment. Its text is
+        captured if it's its value, or if `capture` is True
+        """
+        if fragment.value is not None and not capture:
+            return fragment.pattern, fragment.value
+        self.groups += 1
+        name = "g%d" % self.groups
+        value = fragment.value
+        if value is None:
+            value = "m.group('%s')" % name
+        return "(?P<%s>%s)" % (name, fragment.pattern), value
+
+    def visit_literalexpr(self, node):
+        pattern = re.escape(node.lit)
+        if node.ignorecase and node.lit:
+            if case_variants(node.lit) is None:
+                return None
+            # the regex flag `i` would also match the chars that aren't
+            # equal once lowered, e.g. the long s for "s"
+            pattern = "".join([
+                "[%s]" % "".join(sorted(case_chars(c))) if c.isalpha()
+                else re.escape(c) for c in node.lit])
+        return _Fragment(pattern)
+
+    def visit_charrangeexpr(self, node):
+        if not node.charset:
+            return _Fragment("(?!)")
+        return _Fragment("[%s]" % _char_ranges(node.charset))
+
+    def visit_anycharexpr(self, node):
+        return _Fragment("(?s:.)")
+
+    def visit_regexexpr(self, node):
+        if node.re.groups:
+            # the group numbers would change
+            return None
+        flags = set(node.flags or "")
+        flags.discard("u")
+        if not flags <= _SCOPED_FLAGS:
+            return None
+        pattern = node.lit
+        if "x" in flags:
+            # end the last comment
+            pattern += "\n"
+        if flags:
+            pattern = "(?%s:%s)" % ("".join(sorted(flags)), pattern)
+        try:
+            re.compile(pattern)
+        except re.error:
+            return None
+        # the first match is kept, as with `RegexExpr`
+        return _Fragment("(?>%s)" % pattern)
+
+    def visit_ruleexpr(self, node):
+        rule = self.rules.get(node.rulename)
+        if rule is None or rule.action is not None:
+            return None
+        if rule.name in self.stack:
+            return None
+        self.stack.append(rule.name)
+        fragment = self.visit(rule.expr)
+        self.stack.pop()
+        return fragment
+
+    def visit_memoizedexpr(self, node):
+        return self.visit(node.expr)
+
+    def visit_seqexpr(self, node):
+        patterns = []
+        values = []
+        for expr in node.exprs:
+            fragment = self.visit(expr)
+            if fragment is None:
+                return None
+            if isinstance(expr, (Not, LookAhead)):
+                patterns.append(fragment.pattern)
+                values.append('""')
+            else:
+                pattern, value = self.group(fragment)
+                patterns.append(pattern)
+                values.append(value)
+        return _Fragment("".join(patterns), "[%s]" % ", ".join(values))
+
+    def visit_choiceexpr(self, node):
+        fragments = [self.visit(e) for e in node.exprs]
+        if not fragments or None in fragments:
+            return None
+        if all([f.value is None for f in fragments]):
+            return _Fragment("(?>%s)" % "|".join(
+                [f.pattern for f in fragments]))
+        # find the alternative that matched
+        patterns = []
+        value = None
+        for fragment in reversed(fragments):
+            pattern, alternative = self.group(fragment, capture=True)
+            patterns.insert(0, pattern)
+            if value is None:
+                value = alternative
+            else:
+                value = "%s if m.group('g%d') is not None else %s" % (
+                    alternative, self.groups, value)
+        return _Fragment("(?>%s)" % "|".join(patterns), "(%s)" % value)
+
+    def visit_maybeexpr(self, node):
+        fragment = self.visit(node.expr)
+        if fragment is None:
+            return None
+        if fragment.value is None:
+            return _Fragment("(?:%s)?+" % fragment.pattern)
+        pattern, value = self.group(fragment, capture=True)
+        return _Fragment("%s?+" % pattern, "(%s if m.group('g%d') is not None "
+                                           "else \"\")" % (value, self.groups))
+
+    def _repeated(self, node, quantifier):
+        fragment = self.visit(node.expr)
+        if fragment is None or fragment.value is not None:
+            return None
+        pattern = "(?:%s)%s" % (fragment.pattern, quantifier)
+        if isinstance(node.expr, (CharRangeExpr, AnyCharExpr)):
+            # the matched chars are joined
+            return _Fragment(pattern)
+        low, high = fragment.width()
+        if low != high or low == 0:
+            return None
+        self.groups += 1
+        name = "g%d" % self.groups
+        pattern = "(?P<%s>%s)" % (name, pattern)
+        if low == 1:
+            return _Fragment(pattern, "list(m.group('%s'))" % name)
+        return _Fragment(
+            pattern,
+            "[t[i:i + {0}] for t in [m.group('{1}')] "
+            "for i in range(0, len(t), {0})]".format(low, name))
+
+    def visit_zeroormoreexpr(self, node):
+        return self._repeated(node, "*+")
+
+    def visit_oneormoreexpr(self, node):
+        return self._repeated(node, "++")
+
+    def visit_not(self, node):
+        fragment = self.visit(node.expr)
+        if fragment is None:
+            return None
+        return _Fragment("(?!%s)" % fragment.pattern, '""')
+
+    def visit_lookahead(self, node):
+        fragment = self.visit(node.expr)
+        if fragment is None:
+            return None
+        return _Fragment("(?=%s)" % fragment.pattern, '""')
+
+    def generic_visit(self, node):
+        # labels, cuts, factored choices...
+        return None
+
+
+# these are already matched in one step
+_TERMINALS = (LiteralExpr, CharRangeExpr, AnyCharExpr, RegexExpr)
+
+
+def regular_fragment(rules, expr):
+    """
+    Return (regex, value) if `expr` is a regular fragment worth matching as
+    a single regex, None otherwise. `value` is the python expression of its
+    value, given the match `m`.
+    """
+    if not FUSE_REGEXES or isinstance(expr, _TERMINALS):
+        return None
+    if isinstance(expr, (Not, LookAhead)) and isinstance(
+            expr.expr, _TERMINALS):
+        return None
+    # the rules are fused on their own (MemoizedExpr wraps the references of
+    # inherited rules)
+    if isinstance(expr, RuleExpr) or hasattr(expr, "index"):
+        return None
+    fragment = _Translator(rules).visit(expr)
+    if fragment is None or len(fragment.pattern) > MAX_PATTERN_SIZE:
+        return None
+    try:
+        regex = re.compile(fragment.pattern)
+    except (re.error, RecursionError):
+        return None
+    return regex, fragment.value or "m.group()"
@@ -1,4 +1,5 @@
 from fastidious.compiler.astutils import Visitor
+from fastidious.expressions import PrecedenceExpr
 
 
 class DuplicateRule(Exception):
@@ -61,14 +62,20 @@ def _dedup(lst):
 class LeftRecursionChecker(Visitor):
     def __init__(self):
         self.leftmosts = {}
+        # the rules whose body is a PrecedenceExpr
+        self.precedences = set()
 
     def visit_rule(self, node):
         self.leftmosts[node.name] = _dedup(self.visit(node.expr))
+        if isinstance(node.expr, PrecedenceExpr):
+            self.precedences.add(node.name)
 
     def visit_seqexpr(self, node):
         left = node.exprs[0]
         return self.visit(left)
 
+    visit_factoredchoiceexpr = visit_seqexpr
+
     def visit_choiceexpr(self, node):
         leftmosts = []
         for e in node.exprs:
@@ -81,13 +88,36 @@ class LeftRecursionChecker(Visitor):
     def visit_labeledexpr(self, node):
         return self.visit(node.expr)
 
+    def visit_precedenceexpr(self, node):
+        # the operand, or a prefix operator
+        leftmosts = self.visit(node.operand)
+        for _, kind, expr in node.levels:
+            if kind == "prefix":
+                leftmosts += self.visit(expr)
+        return leftmosts
+
     def generic_action(self, node):
         return []
 
     def check_rules(self, rules):
+        """
+        Raise LeftRecursion if some rules are left recursive through other
+        rules. Return the names of the directly left recursive rules
+        """
         for r in rules:
             self.visit(r)
 
+        # a rule that calls itself at the left edge grows its match (see
+        # Rule.left_recursive)
+        direct = set()
+        for rule, lefts in self.leftmosts.items():
+            if rule in lefts and rule in self.precedences:
+                raise LeftRecursion(
+                    "rule `%s` is the operand of its own operators" % rule)
+            if rule in lefts:
+                lefts.remove(rule)
+                direct.add(rule)
+
         # expand the found left expressions to their own left expressions too
         changed = True
         while changed:
@@ -108,7 +138,12 @@ class LeftRecursionChecker(Visitor):
                     raise LeftRecursion(
                         "rule `%s` and `%s` are left recursive"
                         " (maybe through another rule)" % (rule, l))
+        return direct
 
 
 def check_left_recursion(rules):
-    LeftRecursionChecker().check_rules(rules)
+    """
+    Check that the rules are not indirectly left recursive, and return the
+    names of the rules that are directly left recursive
+    """
+    return LeftRecursionChecker().check_rules(rules)
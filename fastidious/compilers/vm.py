@@ -0,0 +1,815 @@
+"""
+Parsing machine: a backend that lowers the grammar to an array of
+instructions, run by a single loop, in the style of the LPeg virtual
+machine.
+
+The machine has no python recursion: the rule calls, the pending
+alternatives and everything that must be undone when an expression fails
+are entries of an explicit stack, so the nesting depth of the input is only
+limited by the memory. The stack entries are tuples whose first item is
+their kind:
+
+- (CHOICE, target, pos, height): an alternative to try at `target`, from
+  `pos`, with the `height` first values. COMMITTED once a cut committed it.
+- (CALL, return, args, start, rule): a rule call, `args` are the labels of
+  the caller.
+- (MEMO, table, start): a rule match to store in a packrat table.
+- (LABEL, name): a label to set to NoMatch if its expression fails.
+- (PREFIXES, ids, saved): the prefix values of a factored choice.
+- (REPORT, id, start): a failure to report (error tracking only).
+- (SEED, key, start, height, done): the match of a left recursive rule
+  being grown (see Rule.grow), its seed is `parser._p_seeds[key]`. `done`
+  returns from the rule.
+- (CLIMB, return): a precedence climb (see PrecedenceExpr.climb), its
+  start position is on the value stack, below its operands.
+
+Each expression pushes its value on the value stack. When an expression
+fails, the stack is unwound down to the last CHOICE entry.
+
+Two programs are built for each parser: one tracks the errors, the other
+uses the optimizations of the code generator (FIRST sets, literal dispatch,
+regular fragments) and reports nothing.
+"""
+import six
+
+from fastidious.compiler.astutils import Visitor
+from fastidious.compilers.analysis import case_variants, has_cut
+from fastidious.compilers.closures import rule_action, uses_labels
+from fastidious.expressions import CharRangeExpr, AnyCharExpr, PrecedenceExpr
+
+if six.PY2:
+    from types import UnboundMethodType
+
+
+# instructions, (op, a, b, c). The jump targets are always `a`
+LIT = 0            # literal a, of length b, of expression c
+SET = 1            # a char in the set a
+CHOICE = 2         # push an alternative at a
+COMMIT = 3         # pop the alternative, jump to a
+CALL = 4           # call the rule at a, that takes labels if b, rule c
+RETURN = 5         # apply the action a, return
+MAKELIST = 6       # replace the a top values by their list
+APPEND = 7         # append the top value to the list below
+PARTIALCOMMIT = 8  # update the position of the alternative, jump to a
+REGEX = 9          # the `match` method a of a regex
+ANY = 10           # any char
+PUSH = 11          # push the value a
+PUSHLIST = 12      # push an empty list
+JUMP = 13          # jump to a
+TESTSET = 14       # jump to a if the next char isn't in the set b
+MEMO = 15          # the memoized match of the rule in table b, or jump to a
+MEMOSTORE = 16     # memoize the rule match
+JOIN = 17          # join the top list of strings
+PUSHLABEL = 18     # a label named a, set to NoMatch on failure
+SETLABEL = 19      # set the label a to the top value
+ILIT = 20          # the literal b ignoring the case, one of a if not None
+BACKCOMMIT = 21    # pop the alternative, restore its position, jump to a
+FAILTWICE = 22     # pop the alternative and fail
+FAIL = 23          # fail
+FUSED = 24         # the `match` method a of a regex, b builds the value
+DISPATCH = 25      # one of the literals a[next char]
+CUT = 26           # commit the alternative if a, release the packrat tables
+PUSHREPORT = 27    # report the failure of the expression a
+POP = 28           # pop a report
+PREFIXES = 29      # save the prefix values a
+SETPREFIX = 30     # set the prefix value a to the top value
+POPPREFIXES = 31   # restore the prefix values
+PUSHPREFIX = 32    # push the prefix value a
+GROW = 33          # the seed of the rule b and jump to a, or grow it
+GROWN = 34         # apply the action b, grow the seed again from a
+CLIMB = 35         # push the position, climb from a
+REDUCE = 36        # apply the action b to the operator node labelled a
+CLIMBED = 37       # replace the start position by the value, return
+DROP = 38          # pop the top value
+KEYWORD = 39       # the identifier matched by a, if b gives it a value
+
+OPCODES = dict([(name, value) for name, value in globals().items()
+                if name.isupper() and isinstance(value, int)])
+
+# the other stack entries are CHOICE, CALL, MEMO, PREFIXES and CLIMB
+COMMITTED = 100
+LABEL = 101
+REPORT = 102
+SEED = 103
+
+
+class Assembler(Visitor):
+    """
+    Lower the rules of `parser` to a list of instructions. `tracking` is
+    True for the program that reports the errors. The bodies of the
+    `inlined` rules replace their calls. `entries` maps the rule names to
+    the index of their first instruction.
+    """
+    def __init__(self, parser, tracking, inlined=None):
+        self.parser = parser
+        self.tracking = tracking
+        self.inlined = inlined or {}
+        self.constants = getattr(parser, "_p_py_constants", {})
+        self.rules = dict([(r.name, r) for r in parser.__rules__])
+        self.code = []
+        self.entries = {}
+        self.calls = []
+        for rule in parser.__rules__:
+            self.visit(rule)
+        for at, name in self.calls:
+            self.code[at][1] = self.entries[name]
+        self.code = [tuple(i) for i in self.code]
+
+    def emit(self, op, a=None, b=None, c=None):
+        self.code.append([op, a, b, c])
+        return len(self.code) - 1
+
+    def here(self):
+        return len(self.code)
+
+    def patch(self, at, target=None):
+        "Set the jump target of the instruction `at` (default: here)"
+        self.code[at][1] = self.here() if target is None else target
+
+    def consts(self, node):
+        if self.tracking:
+            # the optimizations don't report the errors
+            return {}
+        return self.constants.get(node.id, {})
+
+    def reported(self, node, visit):
+        "Emit the code of `visit`, that reports the failure of `node`"
+        if self.tracking:
+            self.emit(PUSHREPORT, node.id)
+        visit(node)
+        if self.tracking:
+            self.emit(POP)
+
+    def visit(self, node):
+        regex = self.consts(node).get("fused")
+        if regex is None:
+            return Visitor.visit(self, node)
+        # a regular fragment (see fastidious.compilers.regular)
+        self.emit(FUSED, regex.match, eval("lambda m: %s" % node._py_fused))
+
+    def visit_rule(self, node):
+        self.labels = uses_labels(node)
+        self.entries[node.name] = self.here()
+        if node.left_recursive:
+            # GROW done body: ... GROWN body done: RETURN
+            grow = self.emit(GROW, None, node.id)
+            self.visit(node.expr)
+            self.emit(GROWN, grow + 1, rule_action(self.parser, node))
+            self.patch(grow)
+            self.emit(RETURN)
+            return
+        self.visit(node.expr)
+        if isinstance(node.expr, PrecedenceExpr):
+            # the action reduces the operator nodes
+            self.emit(RETURN)
+            return
+        self.emit(RETURN, rule_action(self.parser, node))
+
+    def visit_ruleexpr(self, node):
+        rule = self.rules[node.rulename]
+        if rule.name in self.inlined:
+            # the rule still reports its failure, for its alias
+            self.reported(rule, lambda rule: self.visit(rule.expr))
+            return
+        at = self.emit(CALL, None, uses_labels(rule), rule)
+        self.calls.append((at, node.rulename))
+
+    def visit_memoizedexpr(self, node):
+        at = self.emit(MEMO, None, node.index)
+        self.visit(node.expr)
+        self.emit(MEMOSTORE)
+        self.patch(at)
+
+    def visit_literalexpr(self, node):
+        if not node.lit:
+            self.emit(PUSH, "")
+        elif not node.ignorecase:
+            self.emit(LIT, node.lit, len(node.lit), node.id)
+        else:
+            self.emit(ILIT, case_variants(node.lit), node.lit.lower(),
+                      node.id)
+
+    def visit_charrangeexpr(self, node):
+        self.emit(SET, node.charset, None, node.id)
+
+    def visit_anycharexpr(self, node):
+        self.emit(ANY, None, None, node.id)
+
+    def visit_regexexpr(self, node):
+        self.emit(REGEX, node.re.match, None, node.id)
+
+    def visit_keywordsetexpr(self, node):
+        self.emit(KEYWORD, node.re.match, node.classify, node.id)
+
+    def visit_seqexpr(self, node):
+        self.reported(node, self._seq)
+
+    def _seq(self, node):
+        for expr in node.exprs:
+            self.visit(expr)
+        if node.exprs:
+            self.emit(MAKELIST, len(node.exprs))
+        else:
+            self.emit(PUSHLIST)
+
+    def visit_choiceexpr(self, node):
+        consts = self.consts(node)
+        if "dispatch" in consts:
+            # a choice of literals: find the candidates with the next char
+            self.emit(DISPATCH, consts["dispatch"].get)
+            return
+        self.reported(node, self._choice)
+
+    def _choice(self, node):
+        if not node.exprs:
+            self.emit(FAIL)
+            return
+        ends = []
+        last = len(node.exprs) - 1
+        fail = None
+        for i, expr in enumerate(node.exprs):
+            # skip the alternatives that can't start with the next char. A
+            # cut may commit the choice before any char is consumed.
+            first = self.consts(expr).get("first")
+            test = None
+            if first is not None and not has_cut(expr):
+                test = self.emit(TESTSET, None, first)
+            if i < last:
+                choice = self.emit(CHOICE)
+                self.visit(expr)
+                ends.append(self.emit(COMMIT))
+                self.patch(choice)
+                if test is not None:
+                    self.patch(test)
+            else:
+                self.visit(expr)
+                if test is not None:
+                    ends.append(self.emit(JUMP))
+                    fail = self.emit(FAIL)
+                    self.patch(test, fail)
+        for at in ends:
+            self.patch(at)
+
+    def visit_factoredchoiceexpr(self, node):
+        self.reported(node, self._factored)
+
+    def _factored(self, node):
+        self.emit(PREFIXES, tuple([e.id for e in node.prefix]))
+        for expr in node.prefix:
+            self.visit(expr)
+            self.emit(SETPREFIX, expr.id)
+        self.visit(node.choice)
+        self.emit(POPPREFIXES)
+
+    def visit_prefixexpr(self, node):
+        self.emit(PUSHPREFIX, node.prefix.id)
+
+    def visit_cutexpr(self, node):
+        self.emit(CUT, node.commits)
+
+    def visit_precedenceexpr(self, node):
+        """
+        CLIMB climbs[0] JUMP end, then a program for each precedence level
+        `climbs[level]`:
+
+            [CHOICE next prefix CLIMB climbs[max(prefix level, level)]
+             REDUCE COMMIT loop next: ...] operand
+            loop: CHOICE end [CHOICE next] operator [CLIMB climbs[..]]
+            REDUCE COMMIT again next: ... again: PARTIALCOMMIT loop+1
+            end: CLIMBED
+        """
+        action = None
+        if node.rule is not None:
+            action = rule_action(self.parser, node.rule)
+        levels = node.levels
+        climbs = []
+        # the CLIMB instructions and their levels, patched at the end
+        calls = [(self.emit(CLIMB), 0)]
+        over = self.emit(JUMP)
+        for level in range(len(levels) + 1):
+            climbs.append(self.here())
+            commits = []
+            for op_level, kind, expr in levels:
+                if kind != "prefix":
+                    continue
+                choice = self.emit(CHOICE)
+                self.visit(expr)
+                calls.append((self.emit(CLIMB), max(op_level, level)))
+                self.emit(REDUCE, ("op", "r"), action)
+                commits.append(self.emit(COMMIT))
+                self.patch(choice)
+            self.visit(node.operand)
+            for at in commits:
+                self.patch(at)
+            operators = [(op_level, kind, expr)
+                         for op_level, kind, expr in levels
+                         if kind != "prefix" and op_level >= level]
+            if operators:
+                loop = self.emit(CHOICE)
+                agains = []
+                for i, (op_level, kind, expr) in enumerate(operators):
+                    choice = None
+                    if i < len(operators) - 1:
+                        choice = self.emit(CHOICE)
+                    self.visit(expr)
+                    if kind == "postfix":
+                        self.emit(REDUCE, ("l", "op"), action)
+                    else:
+                        # the right operand of a left associative operator
+                        # can't contain the operators of its level
+                        right = op_level
+                        if kind == "left":
+                            right += 1
+                        calls.append((self.emit(CLIMB), right))
+                        self.emit(REDUCE, ("l", "op", "r"), action)
+                    if choice is not None:
+                        agains.append(self.emit(COMMIT))
+                        self.patch(choice)
+                for at in agains:
+                    self.patch(at)
+                self.emit(PARTIALCOMMIT, loop + 1)
+                self.patch(loop)
+            self.emit(CLIMBED)
+        for at, level in calls:
+            self.patch(at, climbs[level])
+        self.patch(over)
+
+    def visit_labeledexpr(self, node):
+        if not self.labels:
+            self.visit(node.expr)
+            return
+        self.emit(PUSHLABEL, node.name)
+        self.visit(node.expr)
+        self.emit(SETLABEL, node.name)
+
+    def _repeat(self, node, at_least_one=False):
+        # PUSHLIST [body APPEND] loop: CHOICE end body APPEND PARTIALCOMMIT
+        # loop end: [JOIN]
+        self.emit(PUSHLIST)
+        if at_least_one:
+            self.visit(node.expr)
+            self.emit(APPEND)
+        loop = self.emit(CHOICE)
+        self.visit(node.expr)
+        self.emit(APPEND)
+        self.emit(PARTIALCOMMIT, loop + 1)
+        self.patch(loop)
+        if isinstance(node.expr, (CharRangeExpr, AnyCharExpr)):
+            self.emit(JOIN)
+
+    def visit_zeroormoreexpr(self, node):
+        self._repeat(node)
+
+    def visit_oneormoreexpr(self, node):
+        self.reported(node, lambda node: self._repeat(node, True))
+
+    def visit_separatedexpr(self, node):
+        if node.at_least_one:
+            self.reported(node, self._separated)
+        else:
+            self._separated(node)
+
+    def _separated(self, node):
+        # PUSHLIST [CHOICE end] item APPEND [PARTIALCOMMIT loop | CHOICE end]
+        # loop: separator DROP item APPEND PARTIALCOMMIT loop end:
+        self.emit(PUSHLIST)
+        if not node.at_least_one:
+            first = self.emit(CHOICE)
+        self.visit(node.item)
+        self.emit(APPEND)
+        if node.at_least_one:
+            first = self.emit(CHOICE)
+        else:
+            self.emit(PARTIALCOMMIT, self.here() + 1)
+        loop = self.here()
+        self.visit(node.separator)
+        self.emit(DROP)
+        self.visit(node.item)
+        self.emit(APPEND)
+        self.emit(PARTIALCOMMIT, loop)
+        self.patch(first)
+
+    def visit_maybeexpr(self, node):
+        choice = self.emit(CHOICE)
+        self.visit(node.expr)
+        commit = self.emit(COMMIT)
+        self.patch(choice)
+        self.emit(PUSH, "")
+        self.patch(commit)
+
+    def visit_not(self, node):
+        self.reported(node, self._not)
+
+    def _not(self, node):
+        choice = self.emit(CHOICE)
+        self.visit(node.expr)
+        self.emit(FAILTWICE)
+        self.patch(choice)
+        self.emit(PUSH, "")
+
+    def visit_lookahead(self, node):
+        self.reported(node, self._lookahead)
+
+    def _lookahead(self, node):
+        choice = self.emit(CHOICE)
+        self.visit(node.expr)
+        commit = self.emit(BACKCOMMIT)
+        self.patch(choice)
+        self.emit(FAIL)
+        self.patch(commit)
+        self.emit(PUSH, "")
+
+
+def disassemble(code):
+    "Return the instructions of `code` as text, one per line"
+    names = dict([(value, name) for name, value in OPCODES.items()])
+    lines = []
+    for pc, (op, a, b, c) in enumerate(code):
+        # the regexes rather than their `match` methods
+        operands = [repr(getattr(x, "__self__", x)) for x in (a, b)
+                    if x is not None]
+        if c is not None:
+            operands.append(c.name if op == CALL else "#%s" % c)
+        lines.append("%4d %-13s %s" % (pc, names[op], " ".join(operands)))
+    return "\n".join(lines)
+
+
+def run(p, code, pc, rule, tracking, debug=False):
+    """
+    Run `code` from `pc`, the first instruction of `rule`, at the position
+    of the parser `p`. Return (value, end), value is NoMatch if the rule
+    fails
+    """
+    input = p.input
+    pos = p.pos
+    NoMatch = p.NoMatch
+    memo = p._p_memo
+    seeds = p._p_seeds
+    values = []
+    prefixes = {}
+    args = {} if uses_labels(rule) else None
+    stack = [(CALL, -1, None, pos, rule)]
+    if debug:
+        p.p_debug("%s(%s)" % (rule.name, rule.id))
+        p._debug_indent += 1
+    while 42:
+        op, a, b, c = code[pc]
+        # the most frequent instructions first
+        if op == CALL:
+            stack.append((CALL, pc + 1, args, pos, c))
+            args = {} if b else None
+            pc = a
+            if debug:
+                p.pos = pos
+                p.p_debug("%s(%s)" % (c.name, c.id))
+                p._debug_indent += 1
+            continue
+        elif op == RETURN:
+            _, pc, caller_args, start, rule = stack.pop()
+            if a is not None:
+                values[-1] = a(p, values[-1], start, pos, args)
+            args = caller_args
+            if debug:
+                p.pos = pos
+                p._debug_indent -= 1
+                p.p_debug("%s(%s) -- MATCH %r" % (rule.name, rule.id,
+                                                  values[-1]))
+            if values[-1] is not NoMatch:
+                if pc < 0:
+                    return values[-1], pos
+                continue
+            # the action rejects the match: the call fails without
+            # consuming any input
+            if pc < 0:
+                return NoMatch, start
+        elif op == TESTSET:
+            if input[pos:pos + 1] in b:
+                pc += 1
+            else:
+                pc = a
+            continue
+        elif op == MEMO:
+            table = memo[b]
+            end = table[pos]
+            if end is None:
+                stack.append((MEMO, table, pos))
+                pc += 1
+                continue
+            value = table[~pos]
+            if value is not NoMatch:
+                values.append(value)
+                pos = end
+                pc = a
+                continue
+        elif op == CHOICE:
+            stack.append((CHOICE, a, pos, len(values)))
+            pc += 1
+            continue
+        elif op == MEMOSTORE:
+            _, table, start = stack.pop()
+            table[start] = pos
+            table[~start] = values[-1]
+            pc += 1
+            continue
+        elif op == MAKELIST:
+            items = values[-a:]
+            del values[-a:]
+            values.append(items)
+            pc += 1
+            continue
+        elif op == LIT:
+            if input.startswith(a, pos):
+                values.append(a)
+                pos += b
+                pc += 1
+                continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == PUSHLABEL:
+            stack.append((LABEL, a))
+            pc += 1
+            continue
+        elif op == SETLABEL:
+            stack.pop()
+            args[a] = values[-1]
+            pc += 1
+            continue
+        elif op == REGEX:
+            m = a(input, pos)
+            if m:
+                values.append(m.group())
+                pos = m.end()
+                pc += 1
+                continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == FUSED:
+            m = a(input, pos)
+            if m:
+                values.append(b(m))
+                pos = m.end()
+                pc += 1
+                continue
+        elif op == COMMIT:
+            stack.pop()
+            pc = a
+            continue
+        elif op == PUSH:
+            values.append(a)
+            pc += 1
+            continue
+        elif op == SET:
+            char = input[pos:pos + 1]
+            if char in a:
+                values.append(char)
+                pos += 1
+                pc += 1
+                continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == PUSHLIST:
+            values.append([])
+            pc += 1
+            continue
+        elif op == APPEND:
+            value = values.pop()
+            values[-1].append(value)
+            pc += 1
+            continue
+        elif op == PARTIALCOMMIT:
+            stack[-1] = (CHOICE, stack[-1][1], pos, len(values))
+            pc = a
+            continue
+        elif op == JUMP:
+            pc = a
+            continue
+        elif op == ANY:
+            if pos < len(input):
+                values.append(input[pos])
+                pos += 1
+                pc += 1
+                continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == ILIT:
+            text = input[pos:pos + len(b)]
+            if a is not None and text in a or (
+                    a is None and text.lower() == b):
+                values.append(text)
+                pos += len(b)
+                pc += 1
+                continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == DISPATCH:
+            for lit in a(input[pos:pos + 1], ()):
+                if input.startswith(lit, pos):
+                    values.append(lit)
+                    pos += len(lit)
+                    pc += 1
+                    break
+            else:
+                lit = None
+            if lit is not None:
+                continue
+        elif op == PUSHREPORT:
+            stack.append((REPORT, a, pos))
+            pc += 1
+            continue
+        elif op == POP:
+            stack.pop()
+            pc += 1
+            continue
+        elif op == JOIN:
+            values[-1] = "".join(values[-1])
+            pc += 1
+            continue
+        elif op == DROP:
+            values.pop()
+            pc += 1
+            continue
+        elif op == KEYWORD:
+            m = a(input, pos)
+            if m:
+                value = b(m.group())
+                if value is not None:
+                    values.append(value)
+                    pos = m.end()
+                    pc += 1
+                    continue
+            if tracking:
+                p.p_nomatch(c, pos)
+        elif op == BACKCOMMIT:
+            _, _, pos, height = stack.pop()
+            del values[height:]
+            pc = a
+            continue
+        elif op == FAILTWICE:
+            stack.pop()
+        elif op == CUT:
+            if a:
+                # commit the pending alternative
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i][0] == CHOICE:
+                        stack[i] = (COMMITTED, ) + stack[i][1:]
+                        break
+            # the first pending alternative is the lowest position
+            floor = pos
+            for entry in stack:
+                if entry[0] == CHOICE:
+                    floor = entry[2]
+                    break
+            p.pos = pos
+            p.p_cut(floor)
+            values.append("")
+            pc += 1
+            continue
+        elif op == PREFIXES:
+            stack.append((PREFIXES, a, [prefixes.get(id) for id in a]))
+            pc += 1
+            continue
+        elif op == SETPREFIX:
+            prefixes[a] = values.pop()
+            pc += 1
+            continue
+        elif op == POPPREFIXES:
+            _, ids, saved = stack.pop()
+            prefixes.update(zip(ids, saved))
+            pc += 1
+            continue
+        elif op == PUSHPREFIX:
+            values.append(prefixes[a])
+            pc += 1
+            continue
+        elif op == CLIMB:
+            stack.append((CLIMB, pc + 1))
+            values.append(pos)
+            pc = a
+            continue
+        elif op == REDUCE:
+            items = values[-len(a):]
+            del values[-len(a):]
+            value = items
+            if b is not None:
+                labels = dict(l=None, r=None)
+                labels.update(zip(a, items))
+                value = b(p, items, values[-1], pos, labels)
+            values.append(value)
+            pc += 1
+            continue
+        elif op == CLIMBED:
+            _, pc = stack.pop()
+            value = values.pop()
+            values[-1] = value
+            continue
+        elif op == GROW:
+            key = (b, pos)
+            seed = seeds.get(key)
+            if seed is None:
+                seeds[key] = (NoMatch, -1)
+                stack.append((SEED, key, pos, len(values), a))
+                pc += 1
+                continue
+            # a recursive call: the last seed
+            if seed[0] is not NoMatch:
+                values.append(seed[0])
+                pos = seed[1]
+                pc = a
+                continue
+        elif op == GROWN:
+            _, key, start, height, done = stack[-1]
+            seed = seeds[key]
+            if pos <= seed[1]:
+                stack.pop()
+                del seeds[key]
+                del values[height:]
+                values.append(seed[0])
+                pos = seed[1]
+                pc = done
+                continue
+            # a longer match: the new seed
+            value = values.pop()
+            if b is not None:
+                value = b(p, value, start, pos, args)
+            if value is not NoMatch:
+                seeds[key] = (value, pos)
+                pos = start
+                if args is not None:
+                    args = {}
+                pc = a
+                continue
+            # the action rejects the match: the seed grows no more
+        # FAIL, and the failures: unwind the stack to the last alternative
+        while 42:
+            entry = stack.pop()
+            kind = entry[0]
+            if kind == CHOICE:
+                _, pc, pos, height = entry
+                del values[height:]
+                break
+            elif kind == CALL:
+                _, ret, args, start, rule = entry
+                if tracking:
+                    p.p_nomatch(rule.id, start)
+                if debug:
+                    p.pos = start
+                    p._debug_indent -= 1
+                    p.p_debug("%s(%s) -- NO MATCH" % (rule.name, rule.id))
+                if ret < 0:
+                    return NoMatch, start
+            elif kind == REPORT:
+                p.p_nomatch(entry[1], entry[2])
+            elif kind == LABEL:
+                # the label is set even if the expression fails
+                args[entry[1]] = NoMatch
+            elif kind == MEMO:
+                _, table, start = entry
+                table[start] = start
+                table[~start] = NoMatch
+            elif kind == PREFIXES:
+                _, ids, saved = entry
+                prefixes.update(zip(ids, saved))
+            elif kind == SEED:
+                # the body doesn't match anymore, the last seed does
+                _, key, start, height, done = entry
+                value, end = seeds.pop(key)
+                if value is not NoMatch:
+                    del values[height:]
+                    values.append(value)
+                    pos = end
+                    pc = done
+                    break
+
+
+def _method(rule, tracked, fast, debug):
+    "The method of `rule`, that runs the program `tracked` or `fast`"
+    name = rule.name
+    tracked_pc = tracked.entries[name]
+    fast_pc = fast.entries[name]
+    tracked = tracked.code
+    fast = fast.code
+
+    def method(self):
+        if self._p_tracking:
+            result, self.pos = run(self, tracked, tracked_pc, rule, True,
+                                   debug)
+        else:
+            result, self.pos = run(self, fast, fast_pc, rule, False, debug)
+        return result
+    method.__name__ = name
+    return method
+
+
+def build_vm(parser, inlined=None, debug=False):
+    "Add the methods that run the programs of the rules to `parser`"
+    tracked = Assembler(parser, True, inlined)
+    fast = Assembler(parser, False, inlined)
+    parser._p_vm_code = fast.code
+    for rule in parser.__rules__:
+        method = _method(rule, tracked, fast, debug)
+        method.__doc__ = rule.as_grammar()
+        if six.PY3:
+            method.__qualname__ = "%s.%s" % (parser.__name__, rule.name)
+        else:
+            method = UnboundMethodType(method, None, parser)
+        setattr(parser, rule.name, method)
@@ -2,9 +2,13 @@ import re
 
 import six
 
+from fastidious.compiler.pyutils import unparse
+
 
 if six.PY2:
     from types import UnboundMethodType
+else:
+    from types import MethodType
 
 
 class ExprMixin(object):
@@ -38,6 +42,11 @@ class ExprMixin(object):
             ExprMixin.last_id += 1
         return self._id
 
+    @property
+    def _py_code(self):
+        "The python code generated for the expression (python 3.9+)"
+        return unparse(self._py_ast)
+
     def get_children(self):
         if hasattr(self, "expr"):
             return [self.expr]
@@ -65,14 +74,12 @@ class RegexExpr(ExprMixin):
 
     def __call__(self, parser):
         self.debug(parser, "RegexExpr `{}`".format(self.lit))
-        m = self.re.match(parser.p_suffix())
+        m = self.re.match(parser.input, parser.pos)
         if m is None:
             parser.p_nomatch(self.id)
             return parser.NoMatch
-        end = m.end()
-        result = parser.p_suffix(end)
-        parser.pos += end
-        return result
+        parser.pos = m.end()
+        return m.group()
 
     def as_grammar(self, atomic=False):
         return "~{}{}".format(repr(self.lit), self.flags or "")
@@ -83,6 +90,62 @@ class RegexExpr(ExprMixin):
         return self.lit
 
 
+# the tokens matched by a KeywordSetExpr
+IDENTIFIER = r"[A-Za-z_][A-Za-z0-9_]*"
+
+
+class KeywordSetExpr(ExprMixin, AtomicExpr):
+    """
+    `@"if else while"`: an identifier that is one of the keywords, ignoring
+    the case if `ignorecase`. The identifier is matched by a single regex,
+    then looked up in the set of the keywords, so the whole identifier is
+    always matched: `@"if"` doesn't match `iffy`.
+
+    If `identifiers`, the other identifiers match too and the value is
+    ("keyword", word) or ("identifier", word).
+    """
+    def __init__(self, keywords, ignorecase=False, identifiers=False):
+        ExprMixin.__init__(self, keywords, ignorecase, identifiers)
+        self.words = tuple(keywords)
+        if ignorecase:
+            keywords = [k.lower() for k in keywords]
+        self.keywords = frozenset(keywords)
+        self.ignorecase = ignorecase
+        self.identifiers = identifiers
+        self.re = re.compile(IDENTIFIER)
+
+    def classify(self, word):
+        "The value of the identifier `word`, None if it doesn't match"
+        key = word.lower() if self.ignorecase else word
+        if key in self.keywords:
+            if self.identifiers:
+                return ("keyword", word)
+            return word
+        if self.identifiers:
+            return ("identifier", word)
+        return None
+
+    def __call__(self, parser):
+        self.debug(parser, "KeywordSetExpr")
+        m = self.re.match(parser.input, parser.pos)
+        value = None
+        if m is not None:
+            value = self.classify(m.group())
+        if value is None:
+            parser.p_nomatch(self.id)
+            return parser.NoMatch
+        parser.pos = m.end()
+        return value
+
+    def as_grammar(self, atomic=False):
+        flags = ""
+        if self.ignorecase:
+            flags += "i"
+        if self.identifiers:
+            flags += "n"
+        return '@"{}"{}'.format(" ".join(self.words), flags)
+
+
 class SeqExpr(ExprMixin):
     def __init__(self, *exprs, **kwargs):
         ExprMixin.__init__(self, *exprs, **kwargs)
@@ -116,17 +179,27 @@ class ChoiceExpr(ExprMixin):
     def __init__(self, *exprs, **kwargs):
         ExprMixin.__init__(self, *exprs, **kwargs)
         self.exprs = exprs
+        # the cuts of an alternative commit the choice, unless it's the last
+        for expr in exprs[:-1]:
+            for cut in getattr(expr, "exprs", [expr]):
+                if isinstance(cut, CutExpr):
+                    cut.commits = True
 
     def __call__(self, parser):
         self.debug(parser, "ChoiceExpr")
         parser._debug_indent += 1
         parser.p_save()
+        backtrack = parser._p_backtrack
         for expr in self.exprs:
+            backtrack.append(parser.pos)
             res = expr(parser)
+            committed = backtrack.pop() is None
             if res is not parser.NoMatch:
                 parser._debug_indent -= 1
                 parser.p_discard()
                 return res
+            if committed:
+                break
         parser._debug_indent -= 1
         parser.p_restore()
         parser.p_nomatch(self.id)
@@ -139,15 +212,99 @@ class ChoiceExpr(ExprMixin):
         return g
 
 
-class AnyCharExpr(ExprMixin, AtomicExpr):
+class FactoredChoiceExpr(ExprMixin):
+    """
+    A choice whose alternatives start with the same expressions (see
+    fastidious.compilers.optimize). The common `prefix` is matched once,
+    then `choice`, whose alternatives get the prefix values from PrefixExpr.
+    """
+    def __init__(self, prefix, choice):
+        ExprMixin.__init__(self, prefix, choice)
+        self.exprs = tuple(prefix) + (choice, )
+
+    @property
+    def prefix(self):
+        return self.exprs[:-1]
+
+    @property
+    def choice(self):
+        return self.exprs[-1]
+
     def __call__(self, parser):
-        self.debug(parser, "AnyCharExpr")
+        self.debug(parser, "FactoredChoiceExpr")
+        parser._debug_indent += 1
         parser.p_save()
-        n = parser.p_next()
-        if n is not None:
+        prefixes = parser._p_prefixes
+        # a recursive call of the choice shadows the values
+        saved = [prefixes.get(expr.id) for expr in self.prefix]
+        result = None
+        for expr in self.prefix:
+            result = expr(parser)
+            if result is parser.NoMatch:
+                break
+            prefixes[expr.id] = result
+        if result is not parser.NoMatch:
+            result = self.choice(parser)
+        for expr, value in zip(self.prefix, saved):
+            prefixes[expr.id] = value
+        parser._debug_indent -= 1
+        if result is parser.NoMatch:
+            parser.p_restore()
+            parser.p_nomatch(self.id)
+        else:
             parser.p_discard()
-            return n
-        parser.p_restore()
+        return result
+
+    def as_grammar(self, atomic=False):
+        return self.choice.as_grammar(atomic)
+
+
+class PrefixExpr(ExprMixin, AtomicExpr):
+    """
+    The value of the expression `prefix`, already matched by the enclosing
+    FactoredChoiceExpr
+    """
+    def __init__(self, prefix):
+        ExprMixin.__init__(self, prefix)
+        # not a child: it's matched by the FactoredChoiceExpr
+        self.prefix = prefix
+
+    def __call__(self, parser):
+        self.debug(parser, "PrefixExpr")
+        return parser._p_prefixes[self.prefix.id]
+
+    def as_grammar(self, atomic=False):
+        return self.prefix.as_grammar(atomic)
+
+
+class CutExpr(ExprMixin, AtomicExpr):
+    """
+    `^`: commit to the current alternative of the enclosing choice, and
+    release the packrat entries that can't be used any more
+    """
+    def __init__(self):
+        ExprMixin.__init__(self)
+        # set by the enclosing ChoiceExpr
+        self.commits = False
+
+    def __call__(self, parser):
+        self.debug(parser, "CutExpr")
+        if self.commits:
+            parser._p_backtrack[-1] = None
+        parser.p_cut()
+        return ""
+
+    def as_grammar(self, atomic=False):
+        return "^"
+
+
+class AnyCharExpr(ExprMixin, AtomicExpr):
+    def __call__(self, parser):
+        self.debug(parser, "AnyCharExpr")
+        pos = parser.pos
+        if pos < len(parser.input):
+            parser.pos = pos + 1
+            return parser.input[pos]
         parser.p_nomatch(self.id)
         return parser.NoMatch
 
@@ -191,15 +348,14 @@ class CharRangeExpr(ExprMixin, AtomicExpr):
     def __init__(self, chars, terminal=False):
         ExprMixin.__init__(self, chars, terminal=terminal)
         self.chars = chars
+        self.charset = frozenset(chars)
 
     def __call__(self, parser):
         self.debug(parser, "CharRangeExpr `{}`".format(self.chars))
-        parser.p_save()
-        n = parser.p_next()
-        if n is not None and n in self.chars:
-            parser.p_discard()
-            return n
-        parser.p_restore()
+        pos = parser.pos
+        if pos < len(parser.input) and parser.input[pos] in self.charset:
+            parser.pos = pos + 1
+            return parser.input[pos]
         parser.p_nomatch(self.id)
         return parser.NoMatch
 
@@ -225,7 +381,9 @@ class OneOrMoreExpr(ExprMixin):
         parser.p_save()
         results = []
         while 42:
+            parser._p_backtrack.append(parser.pos)
             r = self.expr(parser)
+            parser._p_backtrack.pop()
             if r is not parser.NoMatch:
                 results.append(r)
             else:
@@ -255,7 +413,9 @@ class ZeroOrMoreExpr(ExprMixin):
         parser._debug_indent += 1
         results = []
         while 42:
+            parser._p_backtrack.append(parser.pos)
             r = self.expr(parser)
+            parser._p_backtrack.pop()
             if r is not parser.NoMatch:
                 results.append(r)
             else:
@@ -269,6 +429,59 @@ class ZeroOrMoreExpr(ExprMixin):
         return "{}*".format(self.expr.as_grammar(True))
 
 
+class SeparatedExpr(ExprMixin):
+    """
+    `item ** separator`, `item ++ separator` if `at_least_one`: the items
+    separated by the separators. The value is the flat list of the items,
+    the values of the separators are dropped.
+    """
+    def __init__(self, item, separator, at_least_one=False):
+        ExprMixin.__init__(self, item, separator, at_least_one)
+        self.exprs = (item, separator)
+        self.at_least_one = at_least_one
+
+    @property
+    def item(self):
+        return self.exprs[0]
+
+    @property
+    def separator(self):
+        return self.exprs[1]
+
+    def __call__(self, parser):
+        self.debug(parser, "SeparatedExpr")
+        parser._debug_indent += 1
+        parser.p_save()
+        backtrack = parser._p_backtrack
+        results = []
+        backtrack.append(parser.pos)
+        r = self.item(parser)
+        backtrack.pop()
+        while r is not parser.NoMatch:
+            results.append(r)
+            here = parser.pos
+            backtrack.append(here)
+            r = self.separator(parser)
+            if r is not parser.NoMatch:
+                r = self.item(parser)
+            backtrack.pop()
+            if r is parser.NoMatch:
+                # the separator isn't followed by an item
+                parser.pos = here
+        parser._debug_indent -= 1
+        if self.at_least_one and not results:
+            parser.p_restore()
+            parser.p_nomatch(self.id)
+            return parser.NoMatch
+        parser.p_discard()
+        return results
+
+    def as_grammar(self, atomic=False):
+        return "{} {} {}".format(self.item.as_grammar(True),
+                                 "++" if self.at_least_one else "**",
+                                 self.separator.as_grammar(True))
+
+
 class RuleExpr(ExprMixin, AtomicExpr):
     def __init__(self, rulename):
         ExprMixin.__init__(self, rulename)
@@ -284,22 +497,6 @@ class RuleExpr(ExprMixin, AtomicExpr):
     def as_grammar(self, atomic=False):
         return self.rulename
 
-    def memoize(self, code):
-        pk = hash(self.as_grammar())
-        return"""
-start_pos_{2}= self.pos
-if ({0}, start_pos_{2}) in self._p_memoized:
-    result, self.pos = self._p_memoized[({0}, self.pos)]
-else:
-{1}
-    self._p_memoized[({0}, start_pos_{2})] = result, self.pos
-        """.format(
-            pk,
-            self._indent(code, 1),
-            self.id,
-            repr(self.rulename)
-        )
-
 
 class MaybeExpr(ExprMixin):
     def __init__(self, expr):
@@ -309,7 +506,9 @@ class MaybeExpr(ExprMixin):
     def __call__(self, parser):
         self.debug(parser, "MaybeExpr")
         parser._debug_indent += 1
+        parser._p_backtrack.append(parser.pos)
         result = self.expr(parser)
+        parser._p_backtrack.pop()
         parser._debug_indent -= 1
         if result is parser.NoMatch:
             result = ""
@@ -328,12 +527,16 @@ class LookAhead(ExprMixin):
         self.debug(parser, "LookAhead")
         parser._debug_indent += 1
         parser.p_save()
-        if self.expr(parser) is not parser.NoMatch:
+        parser._p_backtrack.append(parser.pos)
+        matched = self.expr(parser) is not parser.NoMatch
+        parser._p_backtrack.pop()
+        # the failures are reported at the start position
+        parser.p_restore()
+        if matched:
             result = ""
         else:
             parser.p_nomatch(self.id)
             result = parser.NoMatch
-        parser.p_restore()
         parser._debug_indent -= 1
         return result
 
@@ -350,12 +553,15 @@ class Not(ExprMixin):
         self.debug(parser, "Not")
         parser._debug_indent += 1
         parser.p_save()
-        if self.expr(parser) is not parser.NoMatch:
+        parser._p_backtrack.append(parser.pos)
+        matched = self.expr(parser) is not parser.NoMatch
+        parser._p_backtrack.pop()
+        parser.p_restore()
+        if matched:
             parser.p_nomatch(self.id)
             result = parser.NoMatch
         else:
             result = ""
-        parser.p_restore()
         parser._debug_indent -= 1
         return result
 
@@ -372,9 +578,10 @@ class LabeledExpr(ExprMixin, AtomicExpr):
     def __call__(self, parser):
         self.debug(parser, "LabeledExpr `{}`".format(self.name))
         parser._debug_indent += 1
-        rule = getattr(parser, self.rulename)
         result = self.expr(parser)
-        rule.args_stack[-1][self.name] = result
+        # the rule, not its method: the method of a tiered parser may have
+        # been replaced by a generated method since the rule was called
+        self.rule.args_stack[-1][self.name] = result
         parser._debug_indent -= 1
         return result
 
@@ -382,13 +589,122 @@ class LabeledExpr(ExprMixin, AtomicExpr):
         return "{}:{}".format(self.name, self.expr.as_grammar(True))
 
 
+class PrecedenceExpr(ExprMixin):
+    """
+    An operand and its operators, by precedence level. `levels` is the
+    list of (kind, operator) from the lowest precedence to the highest:
+    "left" and "right" are the binary operators of that associativity,
+    "prefix" and "postfix" the unary operators.
+
+    The expression is matched by precedence climbing: the operand is matched
+    once, whatever the number of levels. The action of the rule (`rule`,
+    set by the Rule) reduces each operator node, with the labels `l`, `op`
+    and `r`. The operand of an unary operator is None.
+    """
+    def __init__(self, operand, levels):
+        ExprMixin.__init__(self, operand, levels)
+        self.kinds = tuple([kind for kind, _ in levels])
+        self.exprs = (operand, ) + tuple([expr for _, expr in levels])
+        self.rule = None
+
+    @property
+    def operand(self):
+        return self.exprs[0]
+
+    @property
+    def levels(self):
+        "The (level, kind, operator) of the operators"
+        return list(zip(range(len(self.kinds)), self.kinds, self.exprs[1:]))
+
+    def __call__(self, parser):
+        self.debug(parser, "PrecedenceExpr")
+        parser._debug_indent += 1
+        result = self.climb(parser, 0)
+        parser._debug_indent -= 1
+        return result
+
+    def climb(self, parser, level):
+        """
+        Match an operand (or a prefix operator and its operand) followed by
+        the operators of precedence `level` or more
+        """
+        NoMatch = parser.NoMatch
+        backtrack = parser._p_backtrack
+        start = parser.pos
+        left = NoMatch
+        for op_level, kind, expr in self.levels:
+            if kind != "prefix":
+                continue
+            backtrack.append(start)
+            op = expr(parser)
+            if op is not NoMatch:
+                right = self.climb(parser, max(op_level, level))
+                if right is not NoMatch:
+                    left = self.reduce(parser, start, [op, right],
+                                       None, op, right)
+            backtrack.pop()
+            if left is not NoMatch:
+                break
+            parser.pos = start
+        else:
+            left = self.operand(parser)
+            if left is NoMatch:
+                return NoMatch
+        while 42:
+            here = parser.pos
+            for op_level, kind, expr in self.levels:
+                if kind == "prefix" or op_level < level:
+                    continue
+                backtrack.append(here)
+                node = op = expr(parser)
+                if op is not NoMatch:
+                    if kind == "postfix":
+                        node = self.reduce(parser, start, [left, op],
+                                           left, op, None)
+                    else:
+                        # the right operand of a left associative operator
+                        # can't contain the operators of its level
+                        if kind == "left":
+                            right = self.climb(parser, op_level + 1)
+                        else:
+                            right = self.climb(parser, op_level)
+                        node = right
+                        if right is not NoMatch:
+                            node = self.reduce(parser, start,
+                                               [left, op, right],
+                                               left, op, right)
+                backtrack.pop()
+                if node is not NoMatch:
+                    left = node
+                    break
+                parser.pos = here
+            else:
+                return left
+
+    def reduce(self, parser, start, value, l, op, r):
+        "The value of an operator node that starts at `start`"
+        if self.rule is None:
+            return value
+        return self.rule.apply(parser, value, start, dict(l=l, op=op, r=r))
+
+    def as_grammar(self, atomic=False):
+        g = " ".join([self.operand.as_grammar()] + [
+            "%{} {}".format(kind, expr.as_grammar())
+            for _, kind, expr in self.levels])
+        if atomic:
+            return "( {} )".format(g)
+        return g
+
+
 class Rule(ExprMixin):
-    def __init__(self, name, expr, action=None, alias=None, terminal=False):
+    def __init__(self, name, expr, action=None, alias=None, terminal=False,
+                 annotations=()):
         ExprMixin.__init__(self, name, expr, action=action, alias=alias,
                            terminal=terminal)
         self.name = name
         self.expr = expr
         self.action = action
+        self.annotations = list(annotations)
         self.args_stack = []
         if alias is not None and not isinstance(
                 alias, six.string_types) and alias.__name__ == "NoMatch":
@@ -399,27 +715,96 @@ class Rule(ExprMixin):
             alias = name
         self.alias = alias
         self.is_syntaxic_terminal = terminal
+        # the rule calls itself at the left edge (set by the compiler)
+        self.left_recursive = False
+        if isinstance(expr, PrecedenceExpr):
+            # the action reduces the operator nodes
+            expr.rule = self
+
+    def __get__(self, parser, klass=None):
+        if parser is None:
+            return self
+        return MethodType(self, parser)
 
     def __call__(self, parser):
+        if self.left_recursive:
+            return self.grow(parser)
+        return self.match(parser)
+
+    def grow(self, parser):
+        """
+        Match a left recursive rule by growing a seed (Warth et al., "Packrat
+        parsers can support left recursion"): the first match doesn't use
+        the recursive call, that fails. The rule is matched again, the
+        recursive call returning the previous match, while the matches get
+        longer. The seeds are stored in `parser._p_seeds` as (value, end),
+        by (rule id, position)
+        """
+        NoMatch = parser.NoMatch
+        seeds = parser._p_seeds
+        start = parser.pos
+        key = (self.id, start)
+        seed = seeds.get(key)
+        if seed is None:
+            seeds[key] = seed = (NoMatch, -1)
+            while True:
+                parser.pos = start
+                result = self.match(parser, seed[1])
+                if result is NoMatch:
+                    break
+                seeds[key] = seed = (result, parser.pos)
+            del seeds[key]
+        result, end = seed
+        if result is NoMatch:
+            parser.pos = start
+            parser.p_nomatch(self.id)
+        else:
+            parser.pos = end
+        return result
+
+    def match(self, parser, longer_than=None):
+        """
+        Match the body of the rule and return the value of its action. The
+        match fails if it doesn't end after `longer_than`
+        """
         self.args_stack.append({})
+        start = parser.pos
         result = self.expr(parser)
         args = self.args_stack.pop()
-
-        if result is not parser.NoMatch:
-            if self.action is not None:
-                if callable(self.action):
-                    return self.action(parser, result, **args)
-                if isinstance(self.action, six.string_types):
-                    if self.action.startswith("@"):
-                        return args.get(self.action[1:])
-                    action = getattr(parser, self.action)
-                    return action(result, **args)
-                return self.action(parser, result, **args)
-            else:
-                return result
-        parser.p_nomatch(self.id)
+        if longer_than is not None:
+            # grow reports the failure of the seed
+            if result is parser.NoMatch or parser.pos <= longer_than:
+                return parser.NoMatch
+        elif result is parser.NoMatch:
+            parser.p_nomatch(self.id)
+            return result
+        if isinstance(self.expr, PrecedenceExpr):
+            return result
+        result = self.apply(parser, result, start, args)
+        if result is parser.NoMatch:
+            # the action rejects the match: the rule fails without
+            # consuming any input
+            parser.pos = start
         return result
 
+    def apply(self, parser, result, start, args):
+        """
+        Return the value of the action for the match `result`, from `start`
+        to the parser position
+        """
+        if self.action is None:
+            return result
+        if self.action == "$" or getattr(self.action, "captures_text", False):
+            return parser.input[start:parser.pos]
+        if callable(self.action):
+            return self.action(parser, result, **args)
+        if isinstance(self.action, six.string_types):
+            if self.action.startswith("@"):
+                return args.get(self.action[1:])
+            action = getattr(parser, self.action)
+            return action(result, **args)
+        return self.action(parser, result, **args)
+
     def _attach_to(self, parser):
         if six.PY3:
             m = self
@@ -445,7 +830,8 @@ class Rule(ExprMixin):
             action = " {%s}" % self.action
         else:
             action = ""
-        return "{} <- {}{}".format(
+        return "{}{} <- {}{}".format(
+            "".join(["@%s " % a for a in self.annotations]),
             self.name,
             self.expr.as_grammar(),
             action
@@ -1,21 +1,39 @@
 """
 Fastidious parser compiler and utils.
 """
+import ast
 import sys
 import re
 import string
 import inspect
+import itertools
+import linecache
+from collections import deque
 
 import six
 
-from fastidious.expressions import CharRangeExpr, AnyCharExpr, ExprMixin
+from fastidious.expressions import (CharRangeExpr, AnyCharExpr, ExprMixin,
+                                    LiteralExpr, PrecedenceExpr)
 from fastidious.compiler.astutils import Visitor, Mutator
 from fastidious.compilers import check_rulenames, check_left_recursion
-from fastidious.compiler.action.pyclass import SimplePyAction
-from fastidious.compiler.pyutils import indent
+from fastidious.compilers.closures import build_closures
+from fastidious.compilers.vm import build_vm
+from fastidious.compilers.analysis import (can_fail, can_consume, has_cut,
+                                           has_label, case_variants,
+                                           label_names, bound_labels,
+                                           FirstSets, PRECEDENCE_LABELS)
+from fastidious.compilers.memo import MemoPlan, memoized_rules
+from fastidious.compilers.optimize import (left_factor, inlined_rules,
+                                           capture_texts)
+from fastidious.compilers.regular import regular_fragment
+from fastidious.compiler.action.pyclass import (SimplePyAction,
+                                                _SimplePyArgAction,
+                                                _SimplePyExprAction)
+from fastidious.compiler.pyutils import (indent, template, stmts, expression,
+                                         constant, set_lines, listing,
+                                         unparse, gc_paused, UNPARSE)
 
 if six.PY3:
-    from types import FunctionType
     UPPERCASE = string.ascii_uppercase
     LOWERCASE = string.ascii_lowercase
 else:
@@ -26,17 +44,18 @@ else:
 
 class _RuleNameToCaptures(Visitor):
     def __init__(self, rules):
-        self.rulename = None
+        self.rule = None
         for r in rules:
             self.visit(r)
 
     def visit_rule(self, node):
-        self.rulename = node.name
+        self.rule = node
         self.visit(node.expr)
 
     def visit_labeledexpr(self, node):
         if not hasattr(node, "rulename"):
-            node.rulename = self.rulename
+            node.rulename = self.rule.name
+            node.rule = self.rule
         self.visit(node.expr)
 
 
@@ -51,13 +70,54 @@ class _register_expressions(Visitor):
     def generic_action(self, node):
         self.klass._p_expressions[node.id] = node
 
+    def visit_memoizedexpr(self, node):
+        # rules inherited from an already compiled parser
+        self.visit(node.expr)
+
+
+def _plain_literal(node):
+    "True for the non empty case sensitive literals"
+    if not isinstance(node, LiteralExpr) or node.ignorecase:
+        return False
+    return len(node.lit) > 0
+
 
 class PySetConstants(Visitor):
-    def __init__(self, parser):
+    """
+    Compute the constants used by the generated code. Each constant is
+    registered in `parser._p_py_constants` and is available to the generated
+    methods as a global named `_p_<kind>_<expression id>`
+    """
+    def __init__(self, parser, predict=True, fuse=True):
         self.parser = parser
         self.parser._p_py_constants = dict()
+        self.predict = predict
+        if predict:
+            self.first = FirstSets(parser.__rules__)
+        self.fuse = fuse
         for rule in parser.__rules__:
             self.visit(rule)
+            # the parser the expressions of the rule are prepared for. The
+            # inherited rules are shared with the subclasses
+            rule._py_parser = parser
+
+    def visit(self, node):
+        # the regular fragments are matched by a single regex (see
+        # fastidious.compilers.regular). Their expressions still get their
+        # constants: the fragment is matched expression by expression when
+        # the errors are tracked.
+        node._py_fused = None
+        if not self.fuse:
+            return Visitor.visit(self, node)
+        fragment = regular_fragment(self.parser.__rules__, node)
+        if fragment is None:
+            return Visitor.visit(self, node)
+        regex, node._py_fused = fragment
+        self.node_consts(node)["fused"] = regex
+        self.fuse = False
+        result = Visitor.visit(self, node)
+        self.fuse = True
+        return result
 
     def node_consts(self, node):
         return self.parser._p_py_constants.setdefault(node.id, dict())
@@ -66,392 +126,1110 @@ class PySetConstants(Visitor):
         consts = self.node_consts(node)
         consts["regex"] = re.compile(node._full_regexp())
 
+    def visit_charrangeexpr(self, node):
+        consts = self.node_consts(node)
+        consts["chars"] = frozenset(node.chars)
+
+    def visit_keywordsetexpr(self, node):
+        consts = self.node_consts(node)
+        consts["regex"] = node.re
+        consts["keywords"] = node.keywords
+
+    def visit_choiceexpr(self, node):
+        if not self.predict:
+            return self.generic_visit(node)
+        # the FIRST sets of the alternatives that can't match the empty
+        # string. Testing a literal or a char class is as cheap as its FIRST
+        # set. The labels of a failing alternative are still set, and a cut
+        # may commit the choice before consuming anything, so the
+        # alternatives with labels or cuts are always tried.
+        for expr in node.exprs:
+            self.visit(expr)
+            if isinstance(expr, (LiteralExpr, CharRangeExpr)):
+                continue
+            if has_label(expr) or has_cut(expr):
+                continue
+            nullable, first = self.first(expr)
+            if not nullable and first is not None:
+                self.node_consts(expr)["first"] = first
+        # first char dispatch of the choices of literals
+        literals = [e.lit for e in node.exprs if _plain_literal(e)]
+        if len(node.exprs) > 1 and len(literals) == len(node.exprs):
+            dispatch = {}
+            for lit in literals:
+                dispatch[lit[0]] = dispatch.get(lit[0], ()) + (lit, )
+            self.node_consts(node)["dispatch"] = dispatch
+
+    def visit_literalexpr(self, node):
+        variants = case_variants(node.lit)
+        if node.ignorecase and variants is not None:
+            consts = self.node_consts(node)
+            consts["variants"] = variants
+
+    @classmethod
+    def globals(cls, parser):
+        "Return the constants as a dict of generated code globals"
+        result = {}
+        for id, consts in parser._p_py_constants.items():
+            for kind, value in consts.items():
+                result["_p_%s_%s" % (kind, id)] = value
+        return result
+
 
 class PyCodeGen(Visitor):
-    def __init__(self, debug):
+    """
+    Generate the python code of the parser methods, as python ast: the code
+    of each expression is the list of statements `node._py_ast`, the code
+    of each rule is the definition of its method (see
+    fastidious.compiler.pyutils for the templates of the code).
+
+    The generated methods keep the parser state in local variables: `pos`
+    (the current position), `input` and `NoMatch`. `self.pos` is read at the
+    beginning of the method and written back before returning and before
+    calling another rule method.
+
+    The code of each expression leaves the match (or `NoMatch`) in `result`
+    and, if it fails, restores `pos` to its value before the expression.
+
+    If the grammar has cuts, the start position of each pending alternative,
+    repetition and predicate is pushed on `self._p_backtrack` (see
+    ParserMixin.p_cut).
+
+    The labels the action needs are stored in local variables named
+    `label_<name>`, and given to the action as keyword arguments. If a
+    label may be unset when the rule matches, the labels are stored in the
+    dict `args` instead, and the action gets `**args`.
+
+    The expressions whose value is unused are generated in "void" mode:
+    the sequences and the repetitions only leave "" (or the value of their
+    last expression) in `result` instead of building the lists of values.
+    The value of the body of a rule is unused if its action is `{$}`,
+    `{@label}` or an expression that doesn't use `value`, the value of a
+    predicate is always unused. The labels still get their values.
+    """
+    def __init__(self, debug, inlined=None, compact=False):
         self.debug = debug
-
-    def __call__(self, parser):
-        parser.__rules__ = [self.visit(r) for r in parser.__rules__]
+        # compact code: no docstring, shorter error reports
+        self.compact = compact
+        # name -> rule, the rules whose body replaces their references
+        self.inlined = inlined or {}
+        self.void = False
+
+    def __call__(self, parser, rules=None):
+        "Generate the code of `rules`, all the rules of `parser` by default"
+        self.cuts = any([has_cut(r) for r in parser.__rules__])
+        self.constants = parser._p_py_constants
+        if rules is None:
+            parser.__rules__ = [self.visit(r) for r in parser.__rules__]
+        else:
+            for rule in rules:
+                self.visit(rule)
+
+    def visit(self, node):
+        result = Visitor.visit(self, node)
+        if getattr(node, "_py_fused", None) is not None:
+            # a regular fragment
+            value = constant("")
+            if not self.void:
+                value = ast.parse(node._py_fused, mode="eval").body
+            node._py_ast = template("""
+                if tracking:
+                    CODE
+                else:
+                    m = _p_fused_ID.match(input, pos)
+                    if m:
+                        result = VALUE
+                        pos = m.end()
+                    else:
+                        result = NoMatch
+                """)(CODE=node._py_ast, ID=node.id, VALUE=value)
+            self.uses.add("tracking")
+        return result
+
+    def backtrack(self, code):
+        "Wrap the code of an expression the parser may backtrack from"
+        if not self.cuts:
+            return code
+        self.uses.add("backtrack")
+        return template("""
+            bt.append(pos)
+            CODE
+            bt.pop()
+            """)(CODE=code)
 
     def report_error(self, id):
-        return """
-if self._p_error_stack:
-    head = self._p_error_stack[0]
-else:
-    head = (0, 0)
-if self.pos <= head[0]:
-    self._p_error_stack.append((self.pos, {0}))
-elif self.pos > head[0]:
-    self._p_error_stack = [(self.pos, {0})]
-# print self._p_error_stack
-        """.format(id).strip()
+        self.uses.add("tracking")
+        if self.compact:
+            # `report` is self.p_nomatch, looked up once per call
+            self.uses.add("report")
+            return template("""
+                if tracking:
+                    report(ID, pos)
+                """)(ID=id)
+        return template("""
+            if tracking:
+                self.p_nomatch(ID, pos)
+            """)(ID=id)
 
     def _action(self, action):
-        from fastidious.compiler.action.pyclass import SimplePyAction
+        "The statements of `action`, None if there's no action"
         if action is not None:
             if isinstance(action, SimplePyAction):
-                return action.as_code()
-        return "pass"
+                # the code of the user is not a template
+                if self.labels is None:
+                    return ast.parse(action.as_code()).body
+                return ast.parse(action.as_code(self.labels)).body
+        return None
+
+    def _labels(self, node):
+        """
+        Return the labels of the rule `node` stored as local variables, or
+        None to store them all in `args`
+        """
+        action = node.action
+        if not isinstance(action, SimplePyAction) or getattr(
+                action, "captures_text", False):
+            return []
+        if isinstance(action, _SimplePyArgAction):
+            labels = [action.argname]
+        elif isinstance(action, _SimplePyExprAction):
+            labels = action.labels
+        else:
+            labels = label_names(node.expr)
+        if not set(labels) <= bound_labels(node.expr):
+            return None
+        return labels
+
+    def _void_body(self, node):
+        "True if the value of the body of the rule `node` is unused"
+        action = node.action
+        if getattr(action, "captures_text", False):
+            return True
+        if isinstance(action, _SimplePyArgAction):
+            return True
+        if isinstance(action, _SimplePyExprAction):
+            return not action.uses_value
+        return False
+
+    def visit_void(self, node, void=True):
+        "Visit `node`. If `void` is True, its value is unused"
+        saved = self.void
+        self.void = void
+        self.visit(node)
+        self.void = saved
 
     def visit_rule(self, node):
-        self.visit(node.expr)
-        code = """    '''{3}'''
-    # -- self.p_debug("{0}({5})")
-    # -- self._debug_indent += 1
-    args = dict()
-{1}
-    # -- self._debug_indent -= 1
-    if result is not self.NoMatch:
-        {2}
-        # -- self.p_debug("{0}({5}) -- MATCH " + repr(result) )
-    else:
-{4}
-        # -- self.p_debug("{0}({5}) -- NO MATCH")
-    return result
-        """.format(node.name,
-                   indent(node.expr._py_code, 1),
-                   self._action(node.action),
-                   node.as_grammar().replace("'", "\\'"),
-                   indent(self.report_error(node.id), 2),
-                   node.id,
-                   )
-        defline = "def {}(self):".format(node.name)
-        code = "\n".join([defline, code])
-        if self.debug:
-            code = code.replace("# -- ", "")
+        # the optional local variables used by the rule body
+        self.uses = set()
+        self.rule = node
+        self.labels = self._labels(node)
+        self.visit_void(node.expr, self._void_body(node))
+        error = self.report_error(node.id)
+        action = self._action(node.action)
+        if isinstance(node.expr, PrecedenceExpr):
+            # the action reduces the operator nodes
+            action = None
+        captures_text = getattr(node.action, "captures_text", False)
+        # the action may reject the match: the rule fails, without
+        # consuming any input
+        rejects = action is not None and not captures_text
+        action = action or []
+        # the variables of a match of the body
+        match_prologue = []
+        if captures_text or rejects and not node.left_recursive:
+            match_prologue.extend(stmts("start_pos = pos"))
+        prologue = []
+        if "memo" in self.uses:
+            prologue.extend(stmts("memo = self._p_memo"))
+        if "backtrack" in self.uses:
+            prologue.extend(stmts("bt = self._p_backtrack"))
+        if "tracking" in self.uses:
+            prologue.extend(stmts("tracking = self._p_tracking"))
+        if "report" in self.uses:
+            prologue.extend(stmts(
+                "report = self.p_nomatch if tracking else None"))
+        if self.labels is None:
+            match_prologue.extend(stmts("args = dict()"))
+        body = node.expr._py_ast
+        if node.left_recursive:
+            if rejects:
+                # the seed grows no more
+                action.extend(template("""
+                    if result is NoMatch:
+                        break
+                    """)())
+            body = self._grow(node, body, match_prologue, action)
+            action = []
         else:
-            lines = code.splitlines(True)
-            code = ""
-            for line in lines:
-                if line.strip().startswith("# --"):
-                    continue
+            prologue = match_prologue[:1] + prologue + match_prologue[1:]
+            if rejects:
+                action.extend(template("""
+                    if result is NoMatch:
+                        self.pos = start_pos
+                    """)())
+        debug = dict(ENTER=[], LEAVE=[], MATCH=[], NOMATCH=[])
+        if self.debug:
+            call = "%s(%s)" % (node.name, node.id)
+            debug = dict(
+                ENTER=template("""
+                    self.p_debug(CALL)
+                    self._debug_indent += 1
+                    """)(CALL=constant(call)),
+                LEAVE=stmts("self._debug_indent -= 1"),
+                MATCH=stmts("self.p_debug(CALL + repr(result))",
+                            CALL=constant(call + " -- MATCH ")),
+                NOMATCH=stmts("self.p_debug(CALL)",
+                              CALL=constant(call + " -- NO MATCH")),
+            )
+        doc = []
+        if not self.compact:
+            doc.append(ast.Expr(value=constant(node.as_grammar())))
+        node._py_ast = template("""
+            def RULE(self):
+                DOC
+                ENTER
+                pos = self.pos
+                input = self.input
+                NoMatch = self.NoMatch
+                PROLOGUE
+                BODY
+                self.pos = pos
+                LEAVE
+                if result is not NoMatch:
+                    ACTION
+                    MATCH
                 else:
-                    code += line
-        node._py_code = code.strip()
+                    ERROR
+                    NOMATCH
+                return result
+            """)(RULE=node.name, DOC=doc, PROLOGUE=prologue, BODY=body,
+                 ACTION=action, ERROR=error, **debug)[0]
         return node
 
+    def _grow(self, node, body, prologue, action):
+        """
+        The code that grows the match of the left recursive rule `node`
+        (see Rule.grow). `prologue` sets the variables of each match of its
+        `body`. It leaves the value of the rule in `result`, the action is
+        already applied
+        """
+        return template("""
+            seeds = self._p_seeds
+            seed_pos = pos
+            seed_key = (ID, pos)
+            seed = seeds.get(seed_key)
+            if seed is None:
+                # grow the seed while the matches get longer
+                seeds[seed_key] = seed = (NoMatch, -1)
+                while True:
+                    pos = seed_pos
+                    PROLOGUE
+                    BODY
+                    if result is NoMatch or pos <= seed[1]:
+                        break
+                    self.pos = pos
+                    ACTION
+                    seeds[seed_key] = seed = (result, pos)
+                del seeds[seed_key]
+            result, pos = seed
+            if result is NoMatch:
+                pos = seed_pos
+            """)(ID=node.id, PROLOGUE=prologue, BODY=body, ACTION=action)
+
     def visit_ruleexpr(self, node):
-        code = "result = self.{}()".format(node.rulename).strip()
-        node._py_code = code.strip()
+        rule = self.inlined.get(node.rulename)
+        if rule is not None:
+            # the rule still reports its failure, for its alias
+            self.visit(rule.expr)
+            node._py_ast = template("""
+                CODE
+                if result is NoMatch:
+                    ERROR
+                """)(CODE=rule.expr._py_ast,
+                     ERROR=self.report_error(rule.id))
+            return
+        code = template("""
+            self.pos = pos
+            result = self.RULE()
+            pos = self.pos
+            """)(RULE=node.rulename)
+        recursive = node.rulename == self.rule.name
+        if recursive and self.rule.left_recursive and not self.debug:
+            # at the position of the seed, the recursive call would return
+            # the seed being grown
+            code = template("""
+                if pos == seed_pos:
+                    result = seed[0]
+                    if result is NoMatch:
+                        ERROR
+                    else:
+                        pos = seed[1]
+                else:
+                    CALL
+                """)(ERROR=self.report_error(self.rule.id), CALL=code)
+        node._py_ast = code
+
+    def visit_memoizedexpr(self, node):
+        # the memo tables are shared by all the references to a rule
+        self.visit_void(node.expr, False)
+        self.uses.add("memo")
+        node._py_ast = template("""
+            memo_ID = memo[INDEX]
+            end = memo_ID[pos]
+            if end is None:
+                start_pos_ID = pos
+                CODE
+                memo_ID[start_pos_ID] = pos
+                memo_ID[~start_pos_ID] = result
+            else:
+                result = memo_ID[~pos]
+                pos = end
+            """)(ID=node.id, INDEX=node.index, CODE=node.expr._py_ast)
 
     def visit_regexexpr(self, node):
-        code = """
-# {0}
-regex = self._p_py_constants[{2}]["regex"]
-m = regex.match(self.p_suffix())
-if m:
-    result = self.p_suffix(m.end())
-    self.pos += m.end()
-else:
-{1}
-    result = self.NoMatch
-        """.format(
-            node.as_grammar(),
-            indent(self.report_error(node.id), 1),
-            node.id,
-        )
-        node._py_code = code.strip()
+        node._py_ast = template("""
+            m = _p_regex_ID.match(input, pos)
+            if m:
+                result = m.group()
+                pos = m.end()
+            else:
+                ERROR
+                result = NoMatch
+            """)(ID=node.id, ERROR=self.report_error(node.id))
+        node._py_test = expression("_p_regex_ID.match(input, pos)", ID=node.id)
+
+    def visit_keywordsetexpr(self, node):
+        word = "m.group()"
+        if node.ignorecase:
+            word = "m.group().lower()"
+        if node.identifiers:
+            test = expression("m")
+            value = template("""
+                result = m.group()
+                if WORD in _p_keywords_ID:
+                    result = ("keyword", result)
+                else:
+                    result = ("identifier", result)
+                """)(ID=node.id,
+                     WORD=expression(word.replace("m.group()", "result")))
+        else:
+            test = expression("m and WORD in _p_keywords_ID", ID=node.id,
+                              WORD=expression(word))
+            value = stmts("result = m.group()")
+        node._py_ast = template("""
+            m = _p_regex_ID.match(input, pos)
+            if TEST:
+                VALUE
+                pos = m.end()
+            else:
+                ERROR
+                result = NoMatch
+            """)(ID=node.id, TEST=test, VALUE=value,
+                 ERROR=self.report_error(node.id))
 
     def visit_seqexpr(self, node):
+        # A failure only needs to restore the position if one of the
+        # preceding expressions may have consumed some input.
+        consumed = False
+        savepoint = False
+        # (code, store, restore) of each expression. The next expressions
+        # are matched after the store
+        exprs = []
+        # the values are kept in locals, the list is built on match
+        items = []
+        last = len(node.exprs) - 1
+        for i, expr in enumerate(node.exprs):
+            self.visit(expr)
+            if self.void:
+                # the value of the sequence is the value of its last
+                # expression, or NoMatch
+                store = []
+            elif i < last:
+                items.append("item_{}_{}".format(node.id, i))
+                store = stmts("ITEM = result", ITEM=items[-1])
+            else:
+                store = stmts("result = ITEMS", ITEMS=ast.List(
+                    elts=[ast.Name(id=item, ctx=ast.Load())
+                          for item in items + ["result"]],
+                    ctx=ast.Load()))
+            restore = None
+            if can_fail(expr):
+                restore = []
+                if consumed:
+                    restore = stmts("pos = pos_ID", ID=node.id)
+                    savepoint = True
+            exprs.append((expr._py_ast, store, restore))
+            consumed = consumed or can_consume(expr)
+        code = []
+        for expr_code, store, restore in reversed(exprs):
+            if restore is None:
+                code = expr_code + store + code
+                continue
+            code = expr_code + template("""
+                if result is NoMatch:
+                    RESTORE
+                    ERROR
+                else:
+                    STORE
+                    NEXT
+                """)(RESTORE=restore, ERROR=self.report_error(node.id),
+                     STORE=store, NEXT=code)
+        if not exprs:
+            code = stmts('result = ""' if self.void else "result = []")
+        if savepoint:
+            code = stmts("pos_ID = pos", ID=node.id) + code
+        node._py_ast = code
+
+    def visit_factoredchoiceexpr(self, node):
+        # the prefix values are kept in locals named after the prefix
+        # expressions
+        exprs = []
+        savepoint = False
+        consumed = False
+        for expr in node.exprs:
+            self.visit(expr)
+            store = []
+            if expr is not node.choice:
+                store = stmts("prefix_ID = result", ID=expr.id)
+            restore = []
+            if consumed:
+                restore = stmts("pos = pos_ID", ID=node.id)
+                savepoint = True
+            exprs.append((expr._py_ast, store, restore))
+            consumed = consumed or can_consume(expr)
+        code = []
+        for expr_code, store, restore in reversed(exprs):
+            code = expr_code + template("""
+                if result is NoMatch:
+                    RESTORE
+                    ERROR
+                else:
+                    STORE
+                    NEXT
+                """)(RESTORE=restore, ERROR=self.report_error(node.id),
+                     STORE=store, NEXT=code)
+        if savepoint:
+            code = stmts("pos_ID = pos", ID=node.id) + code
+        node._py_ast = code
 
-        def expressions():
-            exprs = []
-            for i, expr in enumerate(node.exprs):
-                self.visit(expr)
-                expr_code = """
-{0}
-if result is self.NoMatch:
-    results_{1} = self.NoMatch
-    self.p_restore()
-{2}
-else:
-    results_{1}.append(result)
-                    """.format(expr._py_code, node.id,
-                               indent(self.report_error(node.id).strip(), 1))
-                exprs.append(indent(expr_code, i))
-            return "\n".join(exprs)
-
-        code = """
-# {0}
-self.p_save()
-results_{1} = []
-{2}
-if results_{1} is not self.NoMatch:
-    self.p_discard()
-result = results_{1}
-        """.format(
-            node.as_grammar(),
-            node.id,
-            expressions()
-        )
-        node._py_code = code.strip()
+    def visit_prefixexpr(self, node):
+        node._py_ast = stmts("result = prefix_ID", ID=node.prefix.id)
 
     def visit_labeledexpr(self, node):
-        self.visit(node.expr)
-        code = """
-# {}
-{}
-args[{}] = result
-        """.format(
-            node.as_grammar(),
-            node.expr._py_code,
-            repr(node.name)
-        )
-        node._py_code = code.strip()
+        if self.labels is None:
+            store = stmts("args[NAME] = result", NAME=constant(node.name))
+        elif node.name in self.labels:
+            store = stmts("LABEL = result", LABEL="label_" + node.name)
+        else:
+            # unused label
+            self.visit(node.expr)
+            node._py_ast = node.expr._py_ast
+            return
+        self.visit_void(node.expr, False)
+        node._py_ast = node.expr._py_ast + store
+
+    def _results(self, node):
+        "The statement that sets the value of a repetition"
+        if isinstance(node.expr, (CharRangeExpr, AnyCharExpr)):
+            return stmts('result = "".join(results_ID)', ID=node.id)
+        return stmts("result = results_ID", ID=node.id)
 
     def visit_oneormoreexpr(self, node):
+        # no savepoint: if there's no match at all, the first (and only)
+        # attempt already restored the position.
         self.visit(node.expr)
-        if isinstance(node.expr, (CharRangeExpr, AnyCharExpr)):
-            result_line = 'result = "".join(results_{})'.format(node.id)
+        if self.void:
+            node._py_ast = template("""
+                matched_ID = False
+                while 42:
+                    CODE
+                    if result is NoMatch:
+                        break
+                    matched_ID = True
+                if matched_ID:
+                    result = ""
+                else:
+                    ERROR
+                """)(ID=node.id, CODE=self.backtrack(node.expr._py_ast),
+                     ERROR=self.report_error(node.id))
+            return
+        node._py_ast = template("""
+            results_ID = []
+            while 42:
+                CODE
+                if result is not NoMatch:
+                    results_ID.append(result)
+                else:
+                    break
+            if not results_ID:
+                ERROR
+                result = NoMatch
+            else:
+                RESULT
+            """)(ID=node.id, CODE=self.backtrack(node.expr._py_ast),
+                 ERROR=self.report_error(node.id), RESULT=self._results(node))
+
+    def visit_separatedexpr(self, node):
+        """
+        A single loop: the separator is matched before each item but the
+        first, and the position is restored if it isn't followed by an item
+        """
+        self.visit(node.item)
+        self.visit_void(node.separator)
+        if self.void:
+            items = "matched_{0}".format(node.id)
+            init, value = constant(False), constant("")
+            append = stmts("ITEMS = True", ITEMS=items)
         else:
-            result_line = 'result = results_{}'.format(node.id)
-        code = """
-# {0}
-self.p_save()
-results_{3} = []
-while 42:
-{1}
-    if result is not self.NoMatch:
-        results_{3}.append(result)
-    else:
-        break
-if not results_{3}:
-    self.p_restore()
-{4}
-    result = self.NoMatch
-else:
-    self.p_discard()
-    {2}
-        """.format(
-            node.as_grammar(),
-            indent(node.expr._py_code, 1),
-            result_line,
-            node.id,
-            indent(self.report_error(node.id), 1)
-        )
-        node._py_code = code.strip()
+            items = "results_{0}".format(node.id)
+            init, value = expression("[]"), ast.Name(id=items, ctx=ast.Load())
+            append = stmts("ITEMS.append(result)", ITEMS=items)
+        iteration = template("""
+            if ITEMS:
+                SEPARATOR
+            else:
+                result = ""
+            if result is not NoMatch:
+                ITEM
+            """)(ITEMS=items, SEPARATOR=node.separator._py_ast,
+                 ITEM=node.item._py_ast)
+        if node.at_least_one:
+            result = template("""
+                if not ITEMS:
+                    ERROR
+                    result = NoMatch
+                else:
+                    result = VALUE
+                """)(ITEMS=items, ERROR=self.report_error(node.id),
+                     VALUE=value)
+        else:
+            result = stmts("result = VALUE", VALUE=value)
+        node._py_ast = template("""
+            ITEMS = INIT
+            pos_ID = pos
+            while 42:
+                ITERATION
+                if result is NoMatch:
+                    pos = pos_ID
+                    break
+                APPEND
+                pos_ID = pos
+            RESULT
+            """)(ID=node.id, ITEMS=items, INIT=init,
+                 ITERATION=self.backtrack(iteration), APPEND=append,
+                 RESULT=result)
 
     def visit_maybeexpr(self, node):
         self.visit(node.expr)
-        code = """
-# {}
-{}
-result = "" if result is self.NoMatch else result
-if result is self.NoMatch:
-    # print self._p_error_stack
-    self._p_error_stack.pop()
-        """.format(node.as_grammar(), node.expr._py_code)
-        node._py_code = code.strip()
+        node._py_ast = template("""
+            CODE
+            if result is NoMatch:
+                result = ""
+            """)(CODE=self.backtrack(node.expr._py_ast))
+
+    def terminal(self, node, test, value, length):
+        """
+        Code of a terminal expression that matches if the python expression
+        `test` (an ast) is true. `value` is the match, `length` its length.
+
+        `test` is stored as `node._py_test`, predicates use it to test the
+        terminal without matching it.
+        """
+        node._py_test = test
+        node._py_ast = template("""
+            if TEST:
+                result = VALUE
+                pos += LENGTH
+            else:
+                ERROR
+                result = NoMatch
+            """)(TEST=test, VALUE=value, LENGTH=length,
+                 ERROR=self.report_error(node.id))
 
     def visit_literalexpr(self, node):
-
-        if node.lit == "":
-            node._py_code = "result = ''"
+        length = len(node.lit)
+        if length == 0:
+            node._py_test = constant(True)
+            node._py_ast = stmts("result = ''")
             return
-        code = """
-# {2}
-result = self.p_startswith({0}, {1})
-if not result:
-{3}
-    result = self.NoMatch
-        """.format(
-            repr(node.lit),
-            repr(node.ignorecase),
-            node.as_grammar(),
-            indent(self.report_error(node.id), 1)
-        )
-        node._py_code = code.strip()
+        source = expression("input[pos:pos + LENGTH]", LENGTH=length)
+        if not node.ignorecase:
+            # return the literal constant rather than a copy of the input
+            test = expression("input.startswith(LITERAL, pos)",
+                              LITERAL=constant(node.lit))
+            value = constant(node.lit)
+        elif case_variants(node.lit) is not None:
+            test = expression("SOURCE in _p_variants_ID", SOURCE=source,
+                              ID=node.id)
+            value = source
+        else:
+            test = expression("SOURCE.lower() == LOWER", SOURCE=source,
+                              LOWER=constant(node.lit.lower()))
+            value = source
+        self.terminal(node, test, value, length)
+
+    def _predicate(self, node, on_match, on_nomatch):
+        self.visit_void(node.expr)
+        test = getattr(node.expr, "_py_test", None)
+        if test is not None:
+            # a terminal: test it, no need to match and restore
+            node._py_ast = template("""
+                if TEST:
+                    ON_MATCH
+                else:
+                    ERROR
+                    ON_NOMATCH
+                """)(TEST=test, ON_MATCH=on_match,
+                     ERROR=self.report_error(node.expr.id),
+                     ON_NOMATCH=on_nomatch)
+            return
+        save = restore = []
+        if can_consume(node.expr):
+            save = stmts("pos_ID = pos", ID=node.id)
+            restore = stmts("pos = pos_ID", ID=node.id)
+        node._py_ast = template("""
+            SAVE
+            CODE
+            RESTORE
+            if result is NoMatch:
+                ON_NOMATCH
+            else:
+                ON_MATCH
+            """)(SAVE=save, CODE=self.backtrack(node.expr._py_ast),
+                 RESTORE=restore, ON_NOMATCH=on_nomatch, ON_MATCH=on_match)
 
     def visit_not(self, node):
-        self.visit(node.expr)
-        code = """
-# {1}
-self.p_save()
-{0}
-result = "" if result is self.NoMatch else self.NoMatch
-self.p_restore()
-if result is self.NoMatch:
-{2}
-#else:
-    #print self._p_error_stack
-    #self._p_error_stack.pop()
-        """.format(
-            node.expr._py_code,
-            node.as_grammar(),
-            indent(self.report_error(node.id), 1)
+        self._predicate(
+            node,
+            stmts("result = NoMatch") + self.report_error(node.id),
+            stmts('result = ""'),
+        )
+
+    def visit_lookahead(self, node):
+        self._predicate(
+            node,
+            stmts('result = ""'),
+            stmts("result = NoMatch") + self.report_error(node.id),
         )
-        node._py_code = code.strip()
 
     def visit_charrangeexpr(self, node):
-        code = """
-# {0}
-self.p_save()
-n = self.p_next()
-if n is not None and n in {1}:
-    self.p_discard()
-    result = n
-else:
-    self.p_restore()
-{2}
-    result = self.NoMatch
-        """.format(
-            node.as_grammar(),
-            repr(node.chars),
-            indent(self.report_error(node.id), 1)
+        # at the end of the input, the empty slice is not in the set
+        self.terminal(
+            node,
+            expression("input[pos:pos + 1] in _p_chars_ID", ID=node.id),
+            expression("input[pos]"),
+            1,
         )
-        node._py_code = code.strip()
 
     def visit_zeroormoreexpr(self, node):
         self.visit(node.expr)
-        if isinstance(node.expr, (CharRangeExpr, AnyCharExpr)):
-            result_line = 'result = "".join(results_{})'.format(node.id)
-        else:
-            result_line = 'result = results_{}'.format(node.id)
-        code = """
-# {0}
-results_{3} = []
-while 42:
-{1}
-    if result is not self.NoMatch:
-        results_{3}.append(result)
-    else:
-        break
-# print self._p_error_stack
-{2}
-        """.format(
-            node.as_grammar(),
-            indent(node.expr._py_code, 1),
-            result_line,
-            node.id,
-        )
-        node._py_code = code.strip()
+        if self.void:
+            node._py_ast = template("""
+                while 42:
+                    CODE
+                    if result is NoMatch:
+                        break
+                result = ""
+                """)(CODE=self.backtrack(node.expr._py_ast))
+            return
+        node._py_ast = template("""
+            results_ID = []
+            while 42:
+                CODE
+                if result is not NoMatch:
+                    results_ID.append(result)
+                else:
+                    break
+            RESULT
+            """)(ID=node.id, CODE=self.backtrack(node.expr._py_ast),
+                 RESULT=self._results(node))
 
     def visit_choiceexpr(self, node):
+        # no savepoint: each failing alternative restores the position
         if not node.exprs:
-            node._py_code = "result = self.NoMatch"
+            node._py_ast = stmts("result = NoMatch")
             return
 
-        def expressions():
-            exprs = []
-            for i, expr in enumerate(node.exprs):
-                self.visit(expr)
-                expr_code = """
-{}
-if result is self.NoMatch:
-                """.format(expr._py_code).strip()
-                exprs.append(indent(expr_code, i))
-            exprs.append(indent("pass", i + 1))
-            return "\n".join(exprs)
-
-        code = """
-# {1}
-self.p_save()
-{0}
-if result is self.NoMatch:
-    self.p_restore()
-{2}
-else:
-    self.p_discard()
-        """.format(
-            expressions(),
-            node.as_grammar(),
-            indent(self.report_error(node.id), 1)
-        )
-        node._py_code = code.strip()
+        # without error tracking, skip the alternatives that can't start
+        # with the next char
+        guarded = [
+            "first" in self.constants.get(e.id, {}) for e in node.exprs]
+        if any(guarded):
+            self.uses.add("tracking")
+        char = "char_{0}".format(node.id)
+        alternatives = []
+        for i, expr in enumerate(node.exprs):
+            self.visit(expr)
+            expr_code = expr._py_ast
+            if guarded[i]:
+                expr_code = template("""
+                    if tracking or CHAR in _p_first_ID:
+                        CODE
+                    else:
+                        result = NoMatch
+                    """)(CHAR=char, ID=expr.id, CODE=expr_code)
+            alternatives.append(expr_code)
+        # each alternative is tried if the previous one fails
+        code = []
+        for i in reversed(range(len(alternatives))):
+            if self.cuts and i < len(alternatives) - 1:
+                # a cut in the alternative sets its backtrack entry
+                # to None
+                self.uses.add("backtrack")
+                code = template("""
+                    bt.append(pos)
+                    CODE
+                    if bt.pop() is not None and result is NoMatch:
+                        NEXT
+                    """)(CODE=alternatives[i], NEXT=code)
+            else:
+                code = template("""
+                    CODE
+                    if result is NoMatch:
+                        NEXT
+                    """)(CODE=alternatives[i], NEXT=code)
+        code = template("""
+            CODE
+            if result is NoMatch:
+                ERROR
+            """)(CODE=code, ERROR=self.report_error(node.id))
+        if any(guarded):
+            code = stmts("CHAR = input[pos:pos + 1]", CHAR=char) + code
+        if "dispatch" in self.constants.get(node.id, {}):
+            # a choice of literals: find the candidates with the next char
+            code = template("""
+                if tracking:
+                    CODE
+                else:
+                    for result in _p_dispatch_ID.get(input[pos:pos + 1], ()):
+                        if input.startswith(result, pos):
+                            pos += len(result)
+                            break
+                    else:
+                        result = NoMatch
+                """)(CODE=code, ID=node.id)
+        node._py_ast = code
+
+    def visit_precedenceexpr(self, node):
+        """
+        The local function `climb_<id>(pos, level)` matches an operand and
+        the operators of precedence `level` or more, and returns (value,
+        end) (see PrecedenceExpr.climb)
+        """
+        rule = node.rule
+        void = rule is not None and self._void_body(rule)
+        action = None
+        if rule is not None and isinstance(rule.action, SimplePyAction):
+            action = rule.action.as_code(PRECEDENCE_LABELS)
+
+        def reduce(labels):
+            "The code that reduces a node from the labels"
+            code = []
+            if not void:
+                code.extend(stmts("result = LABELS", LABELS=ast.List(
+                    elts=[ast.Name(id="label_" + label, ctx=ast.Load())
+                          for label in labels],
+                    ctx=ast.Load())))
+            if action is not None:
+                code.extend(stmts("self.pos = pos"))
+                code.extend(ast.parse(action).body)
+            return code
+
+        for expr in node.exprs:
+            self.visit_void(expr, False)
+        # the operand, or a prefix operator and its operand
+        alternatives = []
+        for level, kind, expr in node.levels:
+            if kind != "prefix":
+                continue
+            alternatives.append(self.backtrack(template("""
+                CODE
+                if result is not NoMatch:
+                    label_op = result
+                    result, pos = climb_ID(pos, max(level, LEVEL))
+                    if result is NoMatch:
+                        pos = start_pos
+                    else:
+                        label_l = None
+                        label_r = result
+                        REDUCE
+                """)(CODE=expr._py_ast, ID=node.id, LEVEL=level,
+                     REDUCE=reduce(["op", "r"]))))
+        unary = template("""
+            CODE
+            if result is NoMatch:
+                return NoMatch, pos
+            """)(CODE=node.operand._py_ast)
+        for alternative in reversed(alternatives):
+            unary = alternative + template("""
+                if result is NoMatch:
+                    UNARY
+                """)(UNARY=unary)
+        # the binary and postfix operators
+        operators = []
+        for level, kind, expr in node.levels:
+            if kind == "prefix":
+                continue
+            if kind == "postfix":
+                operation = template("""
+                    label_l = left
+                    label_r = None
+                    REDUCE
+                    """)(REDUCE=reduce(["l", "op"]))
+            else:
+                operation = template("""
+                    result, pos = climb_ID(pos, LEVEL)
+                    if result is NoMatch:
+                        pos = here
+                    else:
+                        label_l = left
+                        label_r = result
+                        REDUCE
+                    """)(ID=node.id,
+                         LEVEL=level + 1 if kind == "left" else level,
+                         REDUCE=reduce(["l", "op", "r"]))
+            operator = self.backtrack(template("""
+                CODE
+                if result is not NoMatch:
+                    label_op = result
+                    OPERATION
+                """)(CODE=expr._py_ast, OPERATION=operation))
+            if operators:
+                operators.extend(template("""
+                    if result is NoMatch and level <= LEVEL:
+                        OPERATOR
+                    """)(LEVEL=level, OPERATOR=operator))
+            else:
+                operators.extend(template("""
+                    if level <= LEVEL:
+                        OPERATOR
+                    """)(LEVEL=level, OPERATOR=operator))
+        loop = stmts("return result, pos")
+        if operators:
+            loop = template("""
+                while 42:
+                    left = result
+                    here = pos
+                    result = NoMatch
+                    OPERATORS
+                    if result is NoMatch:
+                        return left, here
+                """)(OPERATORS=operators)
+        node._py_ast = template("""
+            def climb_ID(pos, level):
+                start_pos = pos
+                UNARY
+                LOOP
+            result, pos = climb_ID(pos, 0)
+            """)(ID=node.id, UNARY=unary, LOOP=loop)
+
+    def visit_cutexpr(self, node):
+        commit = []
+        if node.commits:
+            commit = stmts("bt[-1] = None")
+        node._py_ast = template("""
+            COMMIT
+            self.pos = pos
+            self.p_cut()
+            result = ""
+            """)(COMMIT=commit)
 
     def visit_anycharexpr(self, node):
-        code = """
-# .
-self.p_save()
-n = self.p_next()
-if n is not None:
-    self.p_discard()
-    result = n
-else:
-    self.p_restore()
-{}
-    result = self.NoMatch
-        """.format(indent(self.report_error(node.id), 1))
-        node._py_code = code.strip()
-
-    def visit_lookahead(self, node):
-        self.visit(node.expr)
-        code = """
-# {1}
-self.p_save()
-{0}
-result = result if result is self.NoMatch else ""
-self.p_restore()
-if result is self.NoMatch:
-{2}
-        """.format(
-            node.expr._py_code,
-            node.as_grammar(),
-            indent(self.report_error(node.id), 1)
-        )
-        node._py_code = code.strip()
+        self.terminal(node, expression("pos < len(input)"),
+                      expression("input[pos]"), 1)
 
 
 class MemoizedExpr(ExprMixin):
-    def __init__(self, expr, debug):
+    """
+    A rule reference whose matches are stored in the packrat table number
+    `index`
+    """
+    def __init__(self, expr, index):
         self.expr = expr
-        self.debug = debug
+        self.index = index
 
     @property
-    def _py_code(self):
-        PyCodeGen(self.debug).visit(self.expr)
-        pk = hash(self.expr.as_grammar())
-        code = """
-start_pos_{2}= self.pos
-if ({0}, start_pos_{2}) in self._p_memoized:
-    result, self.pos = self._p_memoized[({0}, self.pos)]
-else:
-{1}
-    self._p_memoized[({0}, start_pos_{2})] = result, self.pos
-    """.format(
-            pk,
-            indent(self.expr._py_code, 1),
-            self.expr.id,
-        )
-        return code.strip()
+    def id(self):
+        return self.expr.id
 
     def as_grammar(self, *args, **kwargs):
         return self.expr.as_grammar(*args, **kwargs)
 
+    def __call__(self, parser):
+        # the interpreted rules of a tiered parser don't memoize
+        return self.expr(parser)
+
 
 class Memoizer(Mutator):
-    def __init__(self, debug):
+    """
+    Wrap the references to the rules named in `rulenames` in MemoizedExpr.
+    Each memoized rule gets a small integer index, its packrat table number
+    """
+    def __init__(self, debug, rulenames):
         self.debug = debug
+        self.rulenames = rulenames
 
     def __call__(self, parser):
+        self.indexes = {}
         parser.__rules__ = [self.visit(r) for r in parser.__rules__]
+        parser._p_memo_rules = tuple(
+            sorted(self.indexes, key=self.indexes.get))
+
+    def visit_rule(self, node):
+        self.rule = node
+        return self.generic_visit(node)
 
     def visit_ruleexpr(self, node):
-        self.generic_visit(node)
-        return MemoizedExpr(node, self.debug)
+        if node.rulename not in self.rulenames:
+            return node
+        if self.rule.left_recursive and node.rulename == self.rule.name:
+            # the recursive calls return the seed being grown, they must
+            # not be memoized
+            return node
+        index = self.indexes.setdefault(node.rulename, len(self.indexes))
+        return MemoizedExpr(node, index)
+
+    def visit_memoizedexpr(self, node):
+        # rules inherited from an already compiled parser
+        return self.visit_ruleexpr(node.expr)
+
+
+def _register_listing(module, filename):
+    """
+    Register the listing of the generated `module` in linecache, for the
+    tracebacks. It's printed from the ast when it's first read (python
+    3.9+)
+    """
+    if not UNPARSE:
+        return
+    linecache.cache[filename] = (lambda: "".join(listing(module.body)), )
+    _listings.append(filename)
+    if len(_listings) > MAX_LISTINGS:
+        linecache.cache.pop(_listings.popleft(), None)
+
+
+# the number of generated modules whose listing stays available
+MAX_LISTINGS = 2048
+_listings = deque()
+_modules = itertools.count()
 
 
 class MethodBuilder(Visitor):
-    def __init__(self, parser):
+    """
+    Add the methods of `rules` (all the rules by default) to the parser.
+    Their code is generated by PyCodeGen, the methods are compiled as one
+    module
+    """
+    def __init__(self, parser, rules=None):
         self.parser = parser
-        parser.__rules__ = [self.visit(r) for r in parser.__rules__]
+        # all the methods of the parser share the same globals, that look
+        # like the globals of the parser module
+        self.globals = PySetConstants.globals(parser)
+        self.globals["__name__"] = parser.__module__
+        self.globals["__builtins__"] = six.moves.builtins
+        # the builtins used by the python expression actions
+        self.globals["_p_builtins"] = six.moves.builtins
+        if rules is None:
+            self.build(parser.__rules__)
+        elif rules:
+            self.build(rules)
+
+    def build(self, rules):
+        "Compile the methods of `rules` and add them to the parser"
+        module = ast.parse("")
+        module.body = [r._py_ast for r in rules]
+        set_lines(module.body)
+        filename = "fastidious:%s.%s:%d" % (
+            self.parser.__module__, self.parser.__name__, next(_modules))
+        exec(compile(module, filename, "exec"), self.globals)
+        _register_listing(module, filename)
+        for rule in rules:
+            self.visit(rule)
 
     def visit_rule(self, node):
-        locals_ = dict()
-        exec(node._py_code, None, locals_)
-        new_method = locals_[node.name]
+        new_method = self.globals.pop(node.name)
+        if new_method.__doc__ is None:
+            # compact code
+            new_method.__doc__ = node.as_grammar()
         if six.PY3:
-            new_method.__name__ = node.name
-            meth = FunctionType(new_method.__code__, globals(), node.name)
+            new_method.__qualname__ = "%s.%s" % (self.parser.__name__,
+                                                 node.name)
+            meth = new_method
         else:
-            new_method._code = node._py_code  # noqa
-            new_method.func_name = node.name  # noqa
             meth = UnboundMethodType(new_method, None, self.parser)  # noqa
         setattr(self.parser, node.name, meth)
         return node
 
 
+class TieredMethods(object):
+    """
+    The methods of a tiered parser. The rules start interpreted, and their
+    methods count their calls. After `threshold` calls, the code of the rule
+    is generated and its method is replaced by the generated method.
+
+    The constants of the generated code are computed at the first promotion.
+    """
+    def __init__(self, parser, compiler, threshold):
+        self.parser = parser
+        self.compiler = compiler
+        self.threshold = threshold
+        # names of the rules that have a generated method
+        self.promoted = set()
+        parser._p_tiers = self
+        for rule in parser.__rules__:
+            self.attach(rule)
+
+    def attach(self, rule):
+        "Set the interpreted method of `rule`"
+        calls = [0]
+        threshold = self.threshold
+        promote = self.promote
+
+        def method(parser):
+            calls[0] += 1
+            if calls[0] < threshold:
+                return rule(parser)
+            return promote(rule)(parser)
+        method.__name__ = rule.name
+        method.__doc__ = rule.as_grammar()
+        if six.PY3:
+            method.__qualname__ = "%s.%s" % (self.parser.__name__, rule.name)
+        else:
+            method = UnboundMethodType(method, None, self.parser)  # noqa
+        setattr(self.parser, rule.name, method)
+
+    def prepare(self):
+        """
+        Compute the constants of the generated code, unless they are already
+        computed. A subclass that inherits the rules computes its own
+        constants, they are then computed again
+        """
+        parser = self.parser
+        rules = parser.__rules__
+        if all([getattr(r, "_py_parser", None) is parser for r in rules]):
+            return
+        compiler = self.compiler
+        PySetConstants(parser, predict=compiler.optimize >= 1,
+                       fuse=compiler.optimize >= 1)
+        Memoizer(compiler.debug, compiler.memoized_rules(rules))(parser)
+        inlined = {}
+        if compiler.optimize >= 1:
+            inlined = inlined_rules(rules, compiler.inline_threshold)
+        self.codegen = PyCodeGen(compiler.debug, inlined,
+                                 compact=compiler.optimize >= 1)
+        self.builder = MethodBuilder(parser, ())
+
+    def promote(self, rule):
+        "Replace the method of `rule` by a generated method and return it"
+        if rule.name not in self.promoted:
+            self.prepare()
+            with gc_paused():
+                self.codegen(self.parser, [rule])
+                self.builder.build([rule])
+            self.promoted.add(rule.name)
+        return getattr(self.parser, rule.name)
+
+
 class MethodWriter(Visitor):
     def __init__(self, output, indent=1):
         self.output = output
@@ -462,7 +1240,7 @@ class MethodWriter(Visitor):
             self.visit(r)
 
     def visit_rule(self, node):
-        self.output.write(indent(node._py_code, self.indent))
+        self.output.write(indent(unparse(node._py_ast), self.indent))
         self.output.write("\n\n")
 
 
@@ -475,6 +1253,8 @@ def _repr(obj):
     if isinstance(obj, dict):
         return "{%s}" % (", ".join("%s: %s" % (_repr(k), _repr(v))
                                    for k, v in obj.items()))
+    elif isinstance(obj, frozenset):
+        return "frozenset(%s)" % _repr(sorted(obj))
     elif isinstance(obj, _SRE_Pattern):
         return "re.compile(%r, %s)" % (obj.pattern, obj.flags)
     else:
@@ -482,42 +1262,117 @@ def _repr(obj):
 
 
 class FastidiousCompiler(object):
-    def __init__(self, gen_code=True, memoize=True, debug=False):
-        self.gen_code = gen_code
+    """
+    Compile the rules of a parser class into methods.
+
+    `memoize` is True to memoize the rules chosen by the memoization policy
+    (see fastidious.compilers.memo), "all" to memoize every rule and False
+    to disable memoization. `memo_plan` is a MemoPlan, or the name of a file
+    written by MemoPlan.save, that overrides the policy.
+
+    `optimize` is the optimization level:
+
+    - 0: compile the grammar as written,
+    - 1: predict the alternatives of the choices from their FIRST sets and
+      match the regular fragments with a single regex,
+    - 2: also left-factor the choices (see fastidious.compilers.optimize).
+
+    From level 1, the rules whose body has at most `inline_threshold` nodes,
+    once their own calls are inlined, are inlined in the generated code, if
+    they have no action.
+
+    `backend` chooses how the rules are run:
+
+    - "codegen": generate and compile the python code of the methods,
+    - "closures": compile the expressions into python closures, without
+      generating code (see fastidious.compilers.closures),
+    - "vm": lower the grammar to instructions run by a parsing machine,
+      without python recursion (see fastidious.compilers.vm),
+    - "interpreted": call the expression objects,
+    - "tiered": start interpreted, and generate the method of each rule
+      called `tier_threshold` times (see TieredMethods).
+
+    It defaults to "codegen", or "interpreted" if `gen_code` is False.
+    """
+    backends = ("codegen", "closures", "vm", "interpreted", "tiered")
+
+    def __init__(self, gen_code=True, memoize=True, debug=False,
+                 memo_plan=None, optimize=1, inline_threshold=8,
+                 backend=None, tier_threshold=100):
+        if backend is None:
+            backend = "codegen" if gen_code else "interpreted"
+        if backend not in self.backends:
+            raise ValueError("Unknown backend `%s`" % backend)
+        self.backend = backend
+        self.gen_code = backend == "codegen"
         self.memoize = memoize
         self.debug = debug
+        self.optimize = optimize
+        self.inline_threshold = inline_threshold
+        self.tier_threshold = tier_threshold
+        if isinstance(memo_plan, six.string_types):
+            memo_plan = MemoPlan.load(memo_plan)
+        self.memo_plan = memo_plan
+
+    def memoized_rules(self, rules):
+        if self.memoize == "all":
+            return set([r.name for r in rules])
+        if self.memoize:
+            return memoized_rules(rules, self.memo_plan)
+        return set()
 
     def __call__(self, parser):
         rules = parser.__rules__
         # sanity check. Any compiler should
         check_rulenames(rules)
-        check_left_recursion(rules)
+        left_recursive = check_left_recursion(rules)
+        for rule in rules:
+            rule.left_recursive = rule.name in left_recursive
 
         # set the default rule
         if parser.__default__ is None and rules:
             parser.__default__ = rules[0].name
 
+        if self.optimize >= 2:
+            left_factor(rules)
+
         # for error reporting, register all expressions on the parser
         _register_expressions(parser)
 
         # parse the actions
         SimplePyAction.update_rules(parser)
-
-        # add the methods to the class
-        if self.gen_code:
-            # add constants to the class (pre-compile regexes, ...)
-            PySetConstants(parser)
-            # generate the python code
-            if self.memoize:
-                Memoizer(self.debug)(parser)
-            PyCodeGen(self.debug)(parser)
-            # add the methods
-            MethodBuilder(parser)
-        else:
+        if self.optimize >= 1:
+            capture_texts(rules)
+
+        if self.backend in ("interpreted", "tiered"):
+            # the captures must know their parent rule name
+            _RuleNameToCaptures(rules)
+            if self.backend == "tiered":
+                TieredMethods(parser, self, self.tier_threshold)
+                return parser
             for rule in parser.__rules__:
-                # the captures must know their parent rule name
-                _RuleNameToCaptures(rules)
                 rule._attach_to(parser)
+            return parser
+
+        # add constants to the class (pre-compile regexes, ...)
+        PySetConstants(parser, predict=self.optimize >= 1,
+                       fuse=self.optimize >= 1)
+        Memoizer(self.debug, self.memoized_rules(rules))(parser)
+        inlined = {}
+        if self.optimize >= 1:
+            inlined = inlined_rules(rules, self.inline_threshold)
+        # add the methods to the class
+        if self.backend == "closures":
+            build_closures(parser, inlined, self.debug)
+        elif self.backend == "vm":
+            build_vm(parser, inlined, self.debug)
+        else:
+            with gc_paused():
+                # generate the python code
+                PyCodeGen(self.debug, inlined,
+                          compact=self.optimize >= 1)(parser)
+                # add the methods
+                MethodBuilder(parser)
         return parser
 
     def _get_expr_kwargs(self, e):
@@ -544,12 +1399,24 @@ More info at https://github.com/lisael/fastidious
 """
 '''.format(cmd))
         out.write("""
+import heapq
 import re
+import sys
+from collections import OrderedDict
 
 if not hasattr(__builtins__, 'basestring'):
     basestring = str
 
+try:
+    import builtins as _p_builtins
+except ImportError:
+    import __builtin__ as _p_builtins
+
 """)
+        # print the constants used by the generated methods
+        constants = PySetConstants.globals(parser)
+        for name in sorted(constants):
+            out.write("%s = %s\n" % (name, _repr(constants[name])))
 
         out.write("""
 class _Expr:
@@ -559,6 +1426,14 @@ class _Expr:
 
 
 """)
+        # print the runtime helpers of the parser mixin
+        from fastidious.parser_base import (
+            _SparseMemoTable, _MemoTables, MemoBudget, _BoundedMemoTable,
+            _LRUMemoTable, _BoundedMemoTables)
+        for helper in (_SparseMemoTable, _MemoTables, MemoBudget,
+                       _BoundedMemoTable, _LRUMemoTable, _BoundedMemoTables):
+            out.write(inspect.getsource(helper))
+            out.write("\n\n")
         # print the user's methods
         _, body = inspect.getsource(parser).split("\n", 1)
         out.write("class %s(object):\n" % parser.__name__)
@@ -566,14 +1441,12 @@ class _Expr:
         out.write("    class ParserError(Exception):\n        pass\n\n")
         out.write(body)
 
-        # print _p_py_constants
-        out.write("    _p_py_constants = %s\n" % _repr(parser._p_py_constants))
-
         # print parsr methods and attributes
         from fastidious.parser_base import ParserMixin
         _, mixin_body = inspect.getsource(ParserMixin).split("\n", 1)
         mixin_body = mixin_body.replace("ParserError", "self.ParserError")
         out.write(mixin_body)
+        out.write("    _p_memo_rules = %r\n\n" % (parser._p_memo_rules, ))
 
         # print the fastidious methods
         MethodWriter(out)(parser)
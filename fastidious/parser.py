@@ -24,7 +24,11 @@ class FastidiousParser(Parser, _FastidiousParserMixin):
     __grammar__ = r"""
         grammar <- __ rules:( rule __ )+
 
-        rule "RULE" <- terminal:"`"? name:identifier_name __ ( :alias _ )? "<-" __ expr:expression code:( __ code_block )? EOS
+        rule "RULE" <- annotations:( annotation __ )* terminal:"`"? name:identifier_name __ ( :alias _ )? "<-" __ expr:expression levels:( __ precedence_level )* code:( __ code_block )? EOS
+
+        precedence_level "PRECEDENCE_LEVEL" <- "%" kind:( "left" / "right" / "prefix" / "postfix" ) !identifier_part __ expr:choice_expr
+
+        annotation "ANNOTATION" <- "@" name:identifier_name {@name}
 
         code_block "CODE_BLOCK" <- "{" code:code "}" {@code}
         code <- ( ( ![{}] source_char )+ / ( "{" code "}" ) )* {p_flatten}
@@ -33,11 +37,13 @@ class FastidiousParser(Parser, _FastidiousParserMixin):
 
         expression "EXPRESSION" <- choice_expr
         choice_expr <- first:seq_expr rest:( __ "/" __ seq_expr )*
-        primary_expr <- regexp_expr / lit_expr / char_range_expr / any_char_expr / rule_expr / sub_expr
+        primary_expr <- regexp_expr / keyword_set_expr / lit_expr / char_range_expr / any_char_expr / cut_expr / rule_expr / sub_expr
         sub_expr <- "(" __ expr:expression __ ")" {@expr}
 
         regexp_expr <- "~" lit:string_literal flags:[iLmsux]*
 
+        keyword_set_expr <- "@" lit:string_literal flags:[in]*
+
         lit_expr <- lit:string_literal ignore:"i"?
 
         string_literal <- ( '"' content:double_string_char* '"' ) / ( "'" content:single_string_char* "'" ) {@content}
@@ -48,6 +54,8 @@ class FastidiousParser(Parser, _FastidiousParserMixin):
 
         any_char_expr <- "."
 
+        cut_expr <- "^"
+
         rule_expr <- name:identifier_name !( __ (string_literal __ )? "<-" )
 
         seq_expr <- first:labeled_expr rest:( __ labeled_expr )*
@@ -56,7 +64,8 @@ class FastidiousParser(Parser, _FastidiousParserMixin):
 
         prefixed_expr <- prefix:( prefix __ )? expr:suffixed_expr
         suffixed_expr <- expr:primary_expr suffix:( __ suffix )?
-        suffix <- [?+*]
+        suffix <- separated_suffix / [?+*]
+        separated_suffix "SEPARATOR" <- op:( "**" / "++" ) __ separator:primary_expr
         prefix <- [!&]
 
         char_range_expr <- "[" content:( class_char_range / class_char )* "]" ignore:"i"?
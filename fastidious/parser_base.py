@@ -1,22 +1,31 @@
+import heapq
 import re
 import string
+import sys
+from collections import OrderedDict
 
 import six
 
 
+from fastidious.compilers.analysis import has_label
 from fastidious.expressions import (
     AnyCharExpr,
     CharRangeExpr,
     ChoiceExpr,
+    CutExpr,
+    IDENTIFIER,
+    KeywordSetExpr,
     LabeledExpr,
     LiteralExpr,
     LookAhead,
     MaybeExpr,
     Not,
     OneOrMoreExpr,
+    PrecedenceExpr,
     RegexExpr,
     Rule,
     RuleExpr,
+    SeparatedExpr,
     SeqExpr,
     ZeroOrMoreExpr
 )
@@ -37,33 +46,346 @@ class ParserError(Exception):
     pass
 
 
+def _release_positions(table, start, end):
+    "Positions in [start, end) that may have a match in a sparse table"
+    if len(table) // 2 < end - start:
+        return [pos for pos in table if start <= pos < end]
+    return range(start, end)
+
+
+class _SparseMemoTable(dict):
+    """
+    Packrat table of a rule, for large inputs. Same layout as the dense
+    table (a list): `table[pos]` is the end position of the memoized match
+    at `pos` (None if there's none), `table[~pos]` is the match.
+    """
+    __slots__ = ()
+
+    def __missing__(self, pos):
+        return None
+
+
+class _MemoTables(dict):
+    """
+    Packrat tables, indexed by memoized rule number. The tables are created
+    on first use: dense lists for small inputs, sparse dicts otherwise.
+    """
+    __slots__ = ("size", )
+
+    def __init__(self, input_length, dense_limit):
+        dict.__init__(self)
+        if input_length > dense_limit:
+            self.size = None
+        else:
+            self.size = 2 * (input_length + 1)
+
+    def __missing__(self, index):
+        if self.size is None:
+            table = self[index] = _SparseMemoTable()
+        else:
+            table = self[index] = [None] * self.size
+        return table
+
+    def p_release(self, start, end):
+        "Forget the matches that start in [start, end)"
+        for table in self.values():
+            if self.size is None:
+                for pos in _release_positions(table, start, end):
+                    table.pop(pos, None)
+                    table.pop(~pos, None)
+            else:
+                table[start:end] = [None] * (end - start)
+                table[self.size - end:self.size - start] = [None] * (
+                    end - start)
+
+
+class MemoBudget(object):
+    """
+    Bound on the packrat memory of a parser.
+
+    `entries` caps the number of memoized matches, `size` their approximate
+    size in bytes. When a cap is exceeded, the `lru` policy evicts the least
+    recently used matches, the `window` policy evicts the matches that start
+    the farthest behind. With the `window` policy, the matches that start
+    more than `window` chars before the end of the farthest memoized match
+    are evicted too.
+
+    The last `ghosts` evicted matches are remembered (without their value)
+    to count how many evictions caused a re-parse.
+    """
+    # estimated memory cost of a memoized match, not counting its value
+    entry_size = 200
+
+    def __init__(self, entries=None, size=None, policy=None, window=None,
+                 ghosts=None):
+        if policy is None:
+            policy = "lru" if window is None else "window"
+        if policy not in ("lru", "window"):
+            raise ValueError("Unknown memo eviction policy `%s`" % policy)
+        if window is not None and policy != "window":
+            raise ValueError("A memo window needs the `window` policy")
+        if entries is None and size is None and window is None:
+            raise ValueError("A memo budget needs a bound")
+        self.entries = entries
+        self.size = size
+        self.policy = policy
+        self.window = window
+        if ghosts is None:
+            ghosts = entries or 1 << 16
+        self.ghosts = ghosts
+
+
+class _BoundedMemoTable(dict):
+    """Sparse packrat table of a rule, sharing a MemoBudget"""
+    __slots__ = ("index", "tables")
+
+    def __missing__(self, pos):
+        self.tables.p_missed(self.index, pos)
+        return None
+
+    def __setitem__(self, pos, value):
+        dict.__setitem__(self, pos, value)
+        if pos < 0:
+            # the match is stored after its end position
+            self.tables.p_add(self, ~pos, value)
+
+
+class _LRUMemoTable(_BoundedMemoTable):
+    """Bounded packrat table that records the memo hits"""
+    __slots__ = ()
+
+    def __getitem__(self, pos):
+        if pos >= 0 and dict.__contains__(self, pos):
+            self.tables.p_touch(self.index, pos)
+        return dict.__getitem__(self, pos)
+
+
+class _BoundedMemoTables(dict):
+    """
+    Packrat tables under a MemoBudget, indexed by memoized rule number.
+
+    With the `lru` policy, `order` maps (rule number, position) to the cost
+    of the matches, least recently used first. With the `window` policy, it
+    maps the positions to {rule number: cost} and `starts` is a heap of
+    these positions.
+    """
+    def __init__(self, budget):
+        dict.__init__(self)
+        self.budget = budget
+        self.lru = budget.policy == "lru"
+        self.order = OrderedDict() if self.lru else {}
+        self.starts = []
+        self.ghosts = OrderedDict()
+        self.entries = 0
+        self.bytes = 0
+        self.farthest = 0
+        self.evictions = 0
+        self.reparses = 0
+
+    def __missing__(self, index):
+        if self.lru:
+            table = self[index] = _LRUMemoTable()
+        else:
+            table = self[index] = _BoundedMemoTable()
+        table.index = index
+        table.tables = self
+        return table
+
+    def p_missed(self, index, pos):
+        if pos >= 0 and self.ghosts.pop((index, pos), None):
+            self.reparses += 1
+
+    def p_touch(self, index, pos):
+        key = (index, pos)
+        self.order[key] = self.order.pop(key)
+
+    def p_add(self, table, pos, value):
+        budget = self.budget
+        cost = budget.entry_size + sys.getsizeof(value)
+        self.p_forget(table.index, pos)
+        if self.lru:
+            self.order[(table.index, pos)] = cost
+        else:
+            if budget.window is not None:
+                end = dict.__getitem__(table, pos)
+                self.farthest = max(self.farthest, end)
+                limit = self.farthest - budget.window
+                while self.starts and self.starts[0] < limit:
+                    self.p_evict_oldest()
+                if pos < limit:
+                    self.p_drop(table.index, pos)
+                    return
+            if pos not in self.order:
+                self.order[pos] = {}
+                heapq.heappush(self.starts, pos)
+            self.order[pos][table.index] = cost
+        self.entries += 1
+        self.bytes += cost
+        while self.entries and self.p_over_budget():
+            self.p_evict_oldest()
+
+    def p_over_budget(self):
+        budget = self.budget
+        if budget.entries is not None and self.entries > budget.entries:
+            return True
+        return budget.size is not None and self.bytes > budget.size
+
+    def p_forget(self, index, pos):
+        "Remove the accounting of a match, if any"
+        if self.lru:
+            cost = self.order.pop((index, pos), None)
+        else:
+            cost = self.order.get(pos, {}).pop(index, None)
+        if cost is not None:
+            self.entries -= 1
+            self.bytes -= cost
+
+    def p_release(self, start, end):
+        "Forget the matches that start in [start, end)"
+        for index, table in self.items():
+            for pos in _release_positions(table, start, end):
+                if dict.__contains__(table, pos):
+                    self.p_forget(index, pos)
+                    dict.__delitem__(table, pos)
+                    dict.__delitem__(table, ~pos)
+
+    def p_evict_oldest(self):
+        if self.lru:
+            (index, pos), cost = self.order.popitem(last=False)
+            evicted = [(index, cost)]
+        else:
+            pos = heapq.heappop(self.starts)
+            evicted = self.order.pop(pos, {}).items()
+        for index, cost in evicted:
+            self.entries -= 1
+            self.bytes -= cost
+            self.p_drop(index, pos)
+
+    def p_drop(self, index, pos):
+        "Remove a match from its table and remember it as a ghost"
+        table = self[index]
+        dict.__delitem__(table, pos)
+        dict.__delitem__(table, ~pos)
+        self.evictions += 1
+        self.ghosts[(index, pos)] = True
+        if len(self.ghosts) > self.budget.ghosts:
+            self.ghosts.popitem(last=False)
+
+
 class ParserMixin(object):
     __memoize__ = True
     # __debug___ = True
     __debug___ = False
     __code_gen__ = True
+    # above this input length, packrat tables are dicts instead of lists
+    __memo_dense_limit__ = 1 << 16
+    # default MemoBudget (or max number of memoized matches) of the
+    # instances, None for unbounded packrat tables
+    __memo_budget__ = None
     _p_action_classes = []
+    # names of the memoized rules, by packrat table index (set by the
+    # compiler)
+    _p_memo_rules = ()
 
     class NoMatch(object):
         pass
 
-    def __init__(self, input):
+    def __init__(self, input, memo_budget=None, track_errors=True):
         self.input = input
         self.pos = 0
         self.start = 0
         self.args_stack = {}
         self._debug_indent = 0
         self._p_savepoint_stack = []
-        self._p_memoized = {}
-
-        self._p_error_stack = [(0, 0)]
-
-    def p_nomatch(self, id):
-        head = self._p_error_stack[0]
-        if self.pos <= head[0]:
-            self._p_error_stack.append((self.pos, id))
-        elif self.pos > head[0]:
-            self._p_error_stack = [(self.pos, id)]
+        # start positions of the pending alternatives, repetitions and
+        # predicates. None for the choices committed by a cut
+        self._p_backtrack = []
+        # the packrat entries before this position have been released
+        self._p_cut_floor = 0
+        # values of the prefixes of the factored choices (interpreted
+        # parsers only)
+        self._p_prefixes = {}
+        # the matches of the left recursive rules being grown, by (rule id,
+        # position)
+        self._p_seeds = {}
+        if memo_budget is None:
+            memo_budget = self.__memo_budget__
+        if memo_budget is None:
+            self._p_memo = _MemoTables(len(input),
+                                       self.__memo_dense_limit__)
+        else:
+            if not isinstance(memo_budget, MemoBudget):
+                memo_budget = MemoBudget(entries=memo_budget)
+            self._p_memo = _BoundedMemoTables(memo_budget)
+
+        # error tracking: the expressions that failed at the farthest
+        # position, and the syntaxic terminals that failed since then
+        self._p_tracking = track_errors
+        self._p_error_pos = -1
+        self._p_error_ids = set()
+        self._p_terminal_pos = -1
+        self._p_terminal_ids = set()
+
+    def p_nomatch(self, id, pos=None):
+        "Record the failure of the expression `id` at `pos` (internal use)"
+        if not self._p_tracking:
+            return
+        if pos is None:
+            pos = self.pos
+        if pos > self._p_error_pos:
+            self._p_error_pos = pos
+            self._p_error_ids = set([id])
+            self._p_terminal_pos = -1
+            self._p_terminal_ids = set()
+        elif pos == self._p_error_pos:
+            self._p_error_ids.add(id)
+        expr = getattr(self, "_p_expressions", {}).get(id)
+        if expr is not None and expr.is_syntaxic_terminal:
+            if pos > self._p_terminal_pos:
+                self._p_terminal_pos = pos
+                self._p_terminal_ids = set([id])
+            elif pos == self._p_terminal_pos:
+                self._p_terminal_ids.add(id)
+
+    def p_cut(self, floor=None):
+        """
+        Release the packrat entries of the positions that the parser can't
+        backtrack to. `floor` is the lowest position it can backtrack to,
+        found in `_p_backtrack` if it's None
+        """
+        if floor is None:
+            floor = self.pos
+            for start in self._p_backtrack:
+                if start is not None:
+                    # the stack is ordered by position
+                    floor = start
+                    break
+        if floor > self._p_cut_floor:
+            self._p_memo.p_release(self._p_cut_floor, floor)
+            self._p_cut_floor = floor
+
+    def p_memo_stats(self):
+        """
+        Return the number of memoized matches, the size in bytes of the
+        packrat tables (not counting the memoized values themselves), the
+        number of matches evicted under a memo budget and the number of
+        evictions that caused a re-parse
+        """
+        entries = 0
+        size = sys.getsizeof(self._p_memo)
+        for table in self._p_memo.values():
+            size += sys.getsizeof(table)
+            if isinstance(table, dict):
+                entries += len(table) // 2
+            else:
+                entries += len(table) // 2 - table[:len(table) // 2].count(
+                    None)
+        return dict(
+            entries=entries,
+            size=size,
+            evictions=getattr(self._p_memo, "evictions", 0),
+            reparses=getattr(self._p_memo, "reparses", 0),
+        )
 
     def p_suffix(self, length=None, elipsis=False):
         "Return the rest of the input"
@@ -147,8 +469,9 @@ class ParserMixin(object):
             if i.replace("_", "").isalnum():
                 return i
             return "`%s`" % i
-        expected = set(expected)
-        expected = [prettify(item) for item in expected]
+        # remove the duplicates, keep the order
+        expected = [prettify(item) for i, item in enumerate(expected)
+                    if item not in expected[:i]]
         expected = " or ".join(expected)
         raise ParserError(
             "Syntax error at line %s, col %s:"
@@ -164,13 +487,18 @@ class ParserMixin(object):
         )
 
     def p_startswith(self, st, ignorecase=False):
-        "Return True if the input starts with `st` at current position"
+        """
+        Consume and return the input if it starts with `st` at current
+        position, return False otherwise
+        """
         length = len(st)
-        matcher = result = self.input[self.pos:self.pos + length]
-        if ignorecase:
-            matcher = result.lower()
-            st = st.lower()
-        if matcher == st:
+        if not ignorecase:
+            if self.input.startswith(st, self.pos):
+                self.pos += length
+                return st
+            return False
+        result = self.input[self.pos:self.pos + length]
+        if result.lower() == st.lower():
             self.pos += length
             return result
         return False
@@ -193,54 +521,62 @@ class ParserMixin(object):
         """
         if isinstance(obj, basestring):
             return obj
-        result = ""
-        for i in obj:
-            result += self.p_flatten(i)
-        return result
+        # depth first, with a stack of iterators: no recursion limit and no
+        # quadratic concatenation
+        parts = []
+        stack = [iter(obj)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, basestring):
+                    parts.append(item)
+                else:
+                    stack.append(iter(item))
+                    break
+            else:
+                stack.pop()
+        return "".join(parts)
 
     @classmethod
-    def p_parse(cls, input, methodname=None, parse_all=True):
+    def p_parse(cls, input, methodname=None, parse_all=True,
+                memo_budget=None):
         """
         Parse the `input` using `methodname` as entry point.
 
         If `parse_all` is true, the input MUST be fully consumed at the end of
         the parsing, otherwise p_parse raises an exception.
+
+        `memo_budget` bounds the packrat memory, see `MemoBudget`.
+
+        The errors are not tracked during the parsing. On failure, the input
+        is parsed again, with error tracking, to build the error message.
         """
         if methodname is None:
             methodname = cls.__default__
-        p = cls(input)
+        p = cls(input, memo_budget=memo_budget, track_errors=False)
         result = getattr(p, methodname)()
         if result is cls.NoMatch or parse_all and p.p_peek() is not None:
+            p = cls(input, memo_budget=memo_budget)
+            getattr(p, methodname)()
             p.p_raise()
         return result
 
     def p_raise(self):
         expected = []
-        current_pos = -1
+        current_pos = self._p_error_pos
 
         if self.__debug___:
-            print(self._p_error_stack)
+            print(self._p_error_pos, self._p_error_ids,
+                  self._p_terminal_pos, self._p_terminal_ids)
 
         # check aliased rules
-        for pos, id in self._p_error_stack:
-            if pos < current_pos:
-                break
-            try:
-                expr = self._p_expressions[id]
-            except KeyError:
-                continue
-            else:
-                if expr.is_syntaxic_terminal:
-                    current_pos = pos
-                    expected += expr.expected
+        for id in sorted(self._p_terminal_ids):
+            expected += self._p_expressions[id].expected
+        if expected:
+            current_pos = self._p_terminal_pos
 
         # none found, fallback to default tips
         if not expected:
-            current_pos = -1
-            for pos, id in self._p_error_stack:
-                if current_pos > -1 and pos < current_pos:
-                    continue
-                current_pos = pos
+            for id in sorted(self._p_error_ids):
                 try:
                     expr = self._p_expressions[id]
                 except KeyError:
@@ -249,30 +585,66 @@ class ParserMixin(object):
                     if hasattr(expr, "expr") or hasattr(expr, "exprs"):
                         continue
                     expected += expr.expected
-        self.pos = current_pos
+        if current_pos >= 0:
+            self.pos = current_pos
         return self.p_syntax_error(*expected)
 
 
 class _FastidiousParserMixin(object):
     """Parser actions of a fastidious PEG grammar parser"""
 
-    def on_rule(self, value, name, expr, code, alias=None, terminal=False):
+    # known rule annotations (`@name` before the rule name)
+    _p_annotations = ("memo", "nomemo")
+
+    def on_rule(self, value, name, expr, code, alias=None, terminal=False,
+                annotations=(), levels=()):
         terminal = terminal == '`'
+        annotations = [a[0] for a in annotations]
+        for annotation in annotations:
+            if annotation not in self._p_annotations:
+                self.p_parse_error("Unknown annotation `@%s` on rule `%s`"
+                                   % (annotation, name))
+        if levels:
+            levels = [l[1] for l in levels]
+            if any([has_label(e) for e in [expr] + [e for _, e in levels]]):
+                # the action gets the labels of the operator nodes
+                self.p_parse_error(
+                    "Labels can't be used in the operand and the operators "
+                    "of rule `%s`" % name)
+            expr = PrecedenceExpr(expr, levels)
         if code:
-            r = Rule(name, expr, code[1], alias=alias, terminal=terminal)
+            r = Rule(name, expr, code[1], alias=alias, terminal=terminal,
+                     annotations=annotations)
         else:
-            r = Rule(name, expr, alias=alias, terminal=terminal)
+            r = Rule(name, expr, alias=alias, terminal=terminal,
+                     annotations=annotations)
         return r
 
+    def on_precedence_level(self, value, kind, expr):
+        return kind, expr
+
     def on_regexp_expr(self, content, lit, flags):
         return RegexExpr(self.p_flatten(lit), flags)
 
+    def on_keyword_set_expr(self, content, lit, flags):
+        keywords = self.p_flatten(lit).split()
+        if not keywords:
+            self.p_parse_error("A keyword set can't be empty")
+        for keyword in keywords:
+            if not re.match("%s$" % IDENTIFIER, keyword):
+                self.p_parse_error("The keyword `%s` isn't an identifier"
+                                   % keyword)
+        return KeywordSetExpr(keywords, "i" in flags, "n" in flags)
+
     def on_grammar(self, value, rules):
         return [r[0] for r in rules]
 
     def on_any_char_expr(self, value):
         return AnyCharExpr()
 
+    def on_cut_expr(self, value):
+        return CutExpr()
+
     def on_choice_expr(self, value, first, rest):
         if not rest:
             # only one choice ? not a choice
@@ -313,6 +685,9 @@ class _FastidiousParserMixin(object):
         if not suffix:
             return expr
         suffix = suffix[1]
+        if isinstance(suffix, tuple):
+            op, separator = suffix
+            return SeparatedExpr(expr, separator, op == "++")
         if suffix == "?":
             return MaybeExpr(expr)
         elif suffix == "+":
@@ -320,6 +695,9 @@ class _FastidiousParserMixin(object):
         elif suffix == "*":
             return ZeroOrMoreExpr(expr)
 
+    def on_separated_suffix(self, value, op, separator):
+        return op, separator
+
     def on_lit_expr(self, value, lit, ignore):
         return LiteralExpr(self.p_flatten(lit), ignore == "i")
 
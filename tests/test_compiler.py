@@ -1,11 +1,76 @@
-from unittest import TestCase
+import ast
+import sys
+from math import factorial
+from unittest import TestCase, skipUnless
+
+import six
 
 from fastidious.parser import parse_grammar, Parser
+from fastidious.parser_base import MemoBudget, ParserError
+from fastidious.expressions import (ChoiceExpr, FactoredChoiceExpr,
+                                    LiteralExpr)
+from fastidious.fastidious_compiler import FastidiousCompiler
+from fastidious.compilers.memo import (memoized_rules, train_memo_plan,
+                                       MemoPlan)
 from fastidious.compilers import check_rulenames, gendot
+from fastidious.compilers.analysis import FirstSets, bound_labels
+from fastidious.compiler.action.base import ActionError
+from fastidious.compilers.optimize import inlined_rules
+from fastidious.compilers.regular import FUSE_REGEXES
+from fastidious.compilers.vm import disassemble
+from fastidious.compiler.pyutils import UNPARSE
 from fastidious.compilers.sanitize import (DuplicateRule, UnknownRule,
                                            LeftRecursion)
 
 
+BACKENDS = ("codegen", "interpreted", "closures", "vm", "tiered")
+
+# the tests that read the generated code
+needs_unparse = skipUnless(UNPARSE, "printing the code needs python 3.9+")
+
+
+class BackendsTestMixin(object):
+    """
+    Runs the grammars on every backend, at every optimization level
+    """
+    def backend_parsers(self, grammar, methods=None, **options):
+        options.setdefault("tier_threshold", 2)
+        bases = (Parser, ) if methods is None else (methods, Parser)
+        for backend in BACKENDS:
+            for optimize in (0, 1, 2):
+                compiler = FastidiousCompiler(backend=backend,
+                                              optimize=optimize, **options)
+                yield type("%s%d" % (backend.title(), optimize), bases,
+                           dict(__grammar__=grammar, p_compiler=compiler))
+
+    def assertSameParses(self, grammar, sources, entry=None, methods=None,
+                         **options):
+        """
+        Parse the sources from `entry` with p_parse, and by calling the rule
+        with and without error tracking. Every parser must get the values,
+        the positions and the error messages of the unoptimized codegen
+        parser. Returns its p_parse results, or error messages.
+        """
+        expected = None
+        for klass in self.backend_parsers(grammar, methods, **options):
+            methodname = entry or klass.__default__
+            results = []
+            for source in sources:
+                try:
+                    parsed = klass.p_parse(source, methodname)
+                except ParserError as e:
+                    parsed = str(e)
+                calls = []
+                for track_errors in (True, False):
+                    p = klass(source, track_errors=track_errors)
+                    calls.append((getattr(p, methodname)(), p.pos))
+                results.append((parsed, calls))
+            if expected is None:
+                expected = results
+            self.assertEqual(results, expected, klass.__name__)
+        return [parsed for parsed, calls in expected]
+
+
 class TestRulesChecker(TestCase):
     def test_good_check(self):
         grammar = """
@@ -35,12 +100,70 @@ class TestRulesChecker(TestCase):
             check_rulenames(rules)
 
 
-class LeftRecursionTest(TestCase):
-    def test_direct_left_recursion_detection(self):
+class LeftRecursionTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    expr <- l:expr _ op:[-+] _ r:term / term {on_binop}
+    term <- l:term _ op:[*/] _ r:factor / factor {on_binop}
+    factor <- ( "(" _ fact:expr _ ")" ) / fact:number {@fact}
+    number <- [0-9]+ {int(value)}
+    _ <- " "*
+    """
+
+    class Methods(object):
+        def on_binop(self, value, l=None, op=None, r=None):
+            if op is None:
+                return value
+            return {"+": l + r, "-": l - r, "*": l * r, "/": l // r}[op]
+
+    def test_direct_left_recursion(self):
+        sources = ["10-2-3", "8/2/2", "1 + 2 * 3 - (4 - 1) * 2", "7", "(1)",
+                   "1-", "1+*2", "", "(1-2", "1 2"]
+        results = self.assertSameParses(self.grammar, sources,
+                                        methods=self.Methods)
+        self.assertEqual(results[:5], [5, 2, 1, 7, 1])
+
+    def test_rejecting_action(self):
+        # a rejected match doesn't grow the seed, a rejected first match
+        # fails the rule
+        class Methods(object):
+            def on_sub(self, value):
+                if not isinstance(value, list):
+                    return value if value < 5 else self.NoMatch
+                l, _, r = value
+                return l - r if l >= r else self.NoMatch
+
+        results = self.assertSameParses(r"""
+        sub <- sub "-" num / num {on_sub}
+        num <- [0-9]+ {int(value)}
+        """, ["4-3-1", "3", "4-3-2", "7", "7-1", ""], methods=Methods)
+        self.assertEqual(results[:2], [0, 3])
+        self.assertIn("col 5", results[2])
+        self.assertIn("col 1", results[3])
+
+    @needs_unparse
+    def test_seed_call(self):
+        # at the position of the seed, the recursive call returns the seed
+        # without calling the method
+        class Calc(self.Methods, Parser):
+            __grammar__ = self.grammar
+        code = dict([(r.name, r._py_code) for r in Calc.__rules__])
+        self.assertIn("if pos == seed_pos:", code["term"])
+        self.assertEqual(Calc.p_parse("(2-1) * 3 - 2 * (1+1)"), -1)
+
+    def test_seed_without_base(self):
+        class Bs(Parser):
+            __grammar__ = """
+            a <- a 'b'
+            """
+        with self.assertRaisesRegexp(ParserError, "Got `bb`"):
+            Bs.p_parse("bb")
+
+    def test_mixed_left_recursion_detection(self):
         with self.assertRaises(LeftRecursion):
             class Broken(Parser):
                 __grammar__ = """
-                a <- a 'b'
+                a <- a 'x' / b
+                b <- a 'y'
                 """
 
     def test_indirect_left_recursion_detection(self):
@@ -63,6 +186,138 @@ class LeftRecursionTest(TestCase):
                 """
 
 
+class PrecedenceTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    expr <- atom
+        %left _ "+" _ / _ "-" _
+        %left _ "*" _ / _ "/" _
+        %right _ "^" _
+        %prefix "-" _
+        %postfix "!" {on_node}
+    atom <- v:number / "(" _ v:expr _ ")" {@v}
+    number <- [0-9]+ {int(value)}
+    _ <- " "*
+    """
+
+    class Methods(object):
+        def on_node(self, value, l, op, r):
+            op = self.p_flatten(op).strip()
+            if l is None:
+                return -r
+            if r is None:
+                return factorial(l)
+            return {"+": l + r, "-": l - r, "*": l * r,
+                    "/": l // r, "^": l ** r}[op]
+
+    def test_precedence(self):
+        sources = ["10 - 2 - 3", "2 ^ 3 ^ 2", "-2 * 3 + 1", "2 * 3!",
+                   "1 + 2 * 3", "(1 + 2) * 3", "-2 ^ 2", "2 ^ -1 * 4",
+                   "1 +", "1 + * 2", "", "(1 - 2", "1 2", "3!!", "-3!"]
+        results = self.assertSameParses(self.grammar, sources,
+                                        methods=self.Methods)
+        self.assertEqual(results[:4], [5, 512, -5, 12])
+
+    def test_nodes(self):
+        class Tree(Parser):
+            __grammar__ = r"""
+            expr <- [a-z] %left "+" %right "^" %prefix "-" %postfix "!"
+            """
+        self.assertEqual(Tree.p_parse("a"), "a")
+        self.assertEqual(Tree.p_parse("a+b+c"), [["a", "+", "b"], "+", "c"])
+        self.assertEqual(Tree.p_parse("a^b^c"), ["a", "^", ["b", "^", "c"]])
+        self.assertEqual(Tree.p_parse("-a!"), ["-", ["a", "!"]])
+
+    def test_labels(self):
+        with self.assertRaisesRegexp(ParserError, "Labels can't be used"):
+            class Broken(Parser):
+                __grammar__ = r"""
+                expr <- n:[0-9] %left "+" {on_node}
+                """
+
+    def test_left_recursion(self):
+        with self.assertRaises(LeftRecursion):
+            class Broken(Parser):
+                __grammar__ = r"""
+                expr <- expr / [0-9] %left "+"
+                """
+
+
+class SeparatedTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    list <- "[" _ items:( item ** ( _ "," _ ) ) _ "]" {@items}
+    item <- call / [a-z]+
+    call <- name:[a-z]+ "(" ^ args:( item ++ "," ) ")" {on_call}
+    _ <- " "*
+    """
+
+    class Methods(object):
+        def on_call(self, value, name, args):
+            return (name, args)
+
+    def test_flat_lists(self):
+        sources = ["[a, b(c,d) ,e]", "[]", "[a,]", "[,a]", "[a b]",
+                   "[f()]", "[f(a,)]"]
+        results = self.assertSameParses(self.grammar, sources,
+                                        methods=self.Methods)
+        self.assertEqual(results[:2], [["a", ("b", ["c", "d"]), "e"], []])
+
+    def test_void(self):
+        class Text(Parser):
+            __grammar__ = r"""
+            text <- ( [a-z] ++ "," ) ";" {$}
+            """
+        self.assertEqual(Text.p_parse("a,b;"), "a,b;")
+        with self.assertRaisesRegexp(ParserError, "Got `;` expected"):
+            Text.p_parse("a,b,;")
+
+    def test_program(self):
+        class Lists(Parser):
+            p_compiler = FastidiousCompiler(backend="vm")
+            __grammar__ = r"""
+            items <- "a" ** ","
+            """
+        self.assertIn("DROP", disassemble(Lists._p_vm_code))
+
+
+class KeywordSetTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    stmts <- stmts:( stmt ++ ( _ ";" _ ) ) _ !. {@stmts}
+    stmt <- test / word
+    test <- kw:@"if while"i _ cond:word {on_test}
+    word <- @"if while"in
+    _ <- " "*
+    """
+
+    class Methods(object):
+        def on_test(self, value, kw, cond):
+            return (kw.lower(), cond)
+
+    def test_backends(self):
+        sources = ["if x; y", "if x", "IF iffy; while_ ;If whiles", "iffy",
+                   "if if", "x;", "while1"]
+        results = self.assertSameParses(self.grammar, sources,
+                                        methods=self.Methods)
+        self.assertEqual(results[0], [("if", ("identifier", "x")),
+                                      ("identifier", "y")])
+
+    def test_boundary(self):
+        class Keywords(Parser):
+            __grammar__ = r"""
+            kw <- @"in int"
+            """
+        self.assertEqual(Keywords.p_parse("int"), "int")
+        with self.assertRaisesRegexp(ParserError, "Got `into`"):
+            Keywords.p_parse("into")
+
+    def test_program(self):
+        class Keywords(Parser):
+            p_compiler = FastidiousCompiler(backend="vm")
+            __grammar__ = r"""
+            kw <- @"in int"
+            """
+        self.assertIn("KEYWORD", disassemble(Keywords._p_vm_code))
+
+
 class TestGendot(TestCase):
     def test_gendot(self):
         grammar = """
@@ -112,3 +367,930 @@ class TestGendot(TestCase):
   node_9 -> node_11
 }
 """)
+
+
+class PyCodeGenTest(TestCase, BackendsTestMixin):
+    @needs_unparse
+    def test_local_savepoints(self):
+        class Backtrack(Parser):
+            __grammar__ = r"""
+            a <- ( "x" b "y" ) / ( "x" b "z" ) / ( !"x" . )
+            b <- "b"+
+            """
+        self.assertEqual(Backtrack.p_parse("xbbz"), ["x", ["b", "b"], "z"])
+        self.assertEqual(Backtrack.p_parse("q"), ["", "q"])
+        p = Backtrack("xbw")
+        self.assertIs(p.a(), p.NoMatch)
+        self.assertEqual(p.pos, 0)
+        self.assertEqual(p._p_savepoint_stack, [])
+        for rule in Backtrack.__rules__:
+            self.assertNotIn("p_save", rule._py_code)
+            self.assertNotIn("_p_py_constants", rule._py_code)
+
+    @needs_unparse
+    def test_terminals(self):
+        class Terminals(Parser):
+            __grammar__ = r"""
+            a <- !"x" &[a-c] "ab"i "keyword"i "q" . !.
+            """
+        self.assertEqual(Terminals.p_parse("aBKEYwordq!"),
+                         ["", "", "aB", "KEYword", "q", "!", ""])
+        self.assertRaises(ParserError, Terminals.p_parse, "aBKEYwordq")
+        self.assertRaises(ParserError, Terminals.p_parse, "xb")
+        rule = Terminals.__rules__[0]
+        code = rule._py_code
+        # the predicates on terminals don't save the position
+        for predicate in rule.expr.exprs[:2]:
+            self.assertNotIn("pos_", predicate._py_code)
+        self.assertIn("input.startswith('q', pos)", code)
+        self.assertIn("_p_variants_", code)
+        self.assertIn("_p_chars_", code)
+
+    def test_ignorecase(self):
+        # like str.lower: the kelvin sign is a "k", the long s isn't a "s"
+        sources = [u"\u212aiss", u"ki\u017fs", u"KIss ok", u"kiss o\u212a"]
+        results = self.assertSameParses(r"""
+        words <- "kiss"i ( " " "ok"i )* {$}
+        """, sources)
+        self.assertEqual(results[0], sources[0])
+        self.assertIn("expected", results[1])
+        self.assertEqual(results[2:], sources[2:])
+
+
+class FirstSetsTest(TestCase):
+    grammar = r"""
+    value <- _ ( constant / number / list ) _
+    constant <- "true" / "false" / "null"
+    list <- "[" _ ( value ( "," value )* )? "]"
+    number <- "-"? ~"[0-9]+(\\.[0-9]*)?"
+    _ <- [ \t]*
+    """
+
+    def test_first_sets(self):
+        rules = parse_grammar(self.grammar)
+        first = FirstSets(rules)
+        value, constant, lst, number, blank = [r.expr for r in rules]
+        self.assertEqual(first(blank), (True, frozenset(" \t")))
+        self.assertEqual(first(number), (False, frozenset("-0123456789")))
+        self.assertEqual(first(lst), (False, frozenset("[")))
+        self.assertEqual(first(constant), (False, frozenset("tfn")))
+        nullable, chars = first(value)
+        self.assertFalse(nullable)
+        self.assertEqual(chars, frozenset(" \t-0123456789[tfn"))
+        self.assertEqual(first(parse_grammar("a <- .")[0].expr),
+                         (False, None))
+
+    @needs_unparse
+    def test_dispatch(self):
+        class Values(Parser):
+            __grammar__ = self.grammar
+        code = "".join(r._py_code for r in Values.__rules__)
+        self.assertIn("_p_first_", code)
+        self.assertIn("_p_dispatch_", code)
+        source = " [true, -1.5,[] ,null]"
+        for tracking in (True, False):
+            p = Values(source, track_errors=tracking)
+            first, rest = p.value()[1][2]
+            self.assertEqual(first[1], "true")
+            self.assertEqual(rest[0][1][1], ["-", "1.5"])
+            self.assertEqual(p.pos, len(source))
+        expected = '`"true"` or `"false"` or `"null"`'
+        with self.assertRaisesRegexp(ParserError, expected):
+            Values.p_parse("[tru]")
+
+    def test_labels(self):
+        class Labels(Parser):
+            __grammar__ = r"""
+            list <- ( "[" n:[0-9] "]" ) / ( "[" "]" ) / ( n:[0-9] "," ) / .
+            """
+
+            def on_list(self, value, n=None):
+                return "NoMatch" if n is self.NoMatch else n
+
+        # the labels of the failing alternatives are set, even when the
+        # errors aren't tracked
+        self.assertEqual(Labels.p_parse("[]"), "NoMatch")
+        self.assertEqual(Labels.p_parse("x"), "NoMatch")
+
+
+class LeftFactoringTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    number <- (int frac exp) / (int exp) / (int frac) / int
+    list <- "x" / ( "[" n:number "]" ) / ( "[" "]" ) {on_list}
+    cut <- ( int ^ "a" ) / ( int "b" )
+    int <- "-"? [0-9]+
+    frac <- "." [0-9]+
+    exp <- "e" [0-9]+
+    """
+
+    class Methods(object):
+        def on_list(self, value, n=None):
+            return value, n is self.NoMatch
+
+    def parsers(self, gen_code):
+        class Plain(self.Methods, Parser):
+            __grammar__ = self.grammar
+            p_compiler = FastidiousCompiler(gen_code=gen_code)
+
+        class Factored(Plain):
+            __grammar__ = self.grammar
+            p_compiler = FastidiousCompiler(gen_code=gen_code, optimize=2)
+        return Plain, Factored
+
+    @needs_unparse
+    def test_factored(self):
+        Plain, Factored = self.parsers(True)
+        rules = dict([(r.name, r.expr) for r in Factored.__rules__])
+        self.assertIsInstance(rules["number"], FactoredChoiceExpr)
+        self.assertEqual([e.__class__ for e in rules["list"].exprs],
+                         [LiteralExpr, FactoredChoiceExpr])
+        # choices with cuts aren't factored
+        self.assertIsInstance(rules["cut"], ChoiceExpr)
+        self.assertIn("prefix_", "".join(
+            [r._py_code for r in Factored.__rules__]))
+
+    def test_same_values(self):
+        self.assertSameParses(self.grammar, ["1", "-1.5", "1e5", "1.5e3",
+                                             "1.", "1e"],
+                              methods=self.Methods)
+        results = self.assertSameParses(self.grammar,
+                                        ["x", "[1.5]", "[]", "[x", "[1"],
+                                        "list", methods=self.Methods)
+        self.assertEqual(results[0], ("x", False))
+        self.assertEqual(results[1], (["[", [["", "1"], [".", "5"]], "]"],
+                                      False))
+
+
+class RegularFragmentsTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    items <- ( item _ )*
+    item <- number / word / peg / lookahead / ( !"%" . )
+    number <- "-"? ( ( [1-9] digits ) / "0" ) ( "." digits )?
+    digits <- digit+
+    digit <- ~"[0-9]"
+    word <- [a-z]i [a-z0-9_]* pairs?
+    pairs <- ( "@a" / "@b"i )+
+    peg <- ( "p" / "pq" ) "r" / "q"* "q"
+    lookahead <- &"y" "yy"
+    _ <- [ \t]*
+    """
+    sources = ["-12.5 0 Ab_1@a@B pqr y yy q", "12 . z", "pr ; qq"]
+    errors = ["-1.%", "ab@%", "pq%", "%", "y %"]
+
+    def parsers(self):
+        class Plain(Parser):
+            p_compiler = FastidiousCompiler(optimize=0)
+            __grammar__ = self.grammar
+
+        class Fused(Parser):
+            __grammar__ = self.grammar
+        return Plain, Fused
+
+    @needs_unparse
+    def test_fragments(self):
+        Plain, Fused = self.parsers()
+        code = "".join([r._py_code for r in Fused.__rules__])
+        self.assertNotIn("_p_fused_", "".join(
+            [r._py_code for r in Plain.__rules__]))
+        if not FUSE_REGEXES:
+            self.assertNotIn("_p_fused_", code)
+            return
+        fused = dict([(r.name, r.expr._py_fused) for r in Fused.__rules__])
+        self.assertEqual(fused["digits"], "list(m.group('g1'))")
+        self.assertEqual(fused["pairs"],
+                         "[t[i:i + 2] for t in [m.group('g1')] "
+                         "for i in range(0, len(t), 2)]")
+        # not regular: the repetition of items
+        self.assertIs(fused["items"], None)
+
+    def test_same_values(self):
+        results = self.assertSameParses(self.grammar,
+                                        self.sources + self.errors)
+        for error in results[len(self.sources):]:
+            self.assertIn("Syntax error", error)
+
+
+class InliningTest(TestCase):
+    grammar = r"""
+    pairs <- pair ( "," pair )*
+    pair <- key "=" value
+    key "KEY" <- [a-z]+
+    value <- number / "-" value
+    number <- [0-9]+ {on_number}
+    """
+
+    def parsers(self, threshold):
+        class Pairs(Parser):
+            p_compiler = FastidiousCompiler(inline_threshold=threshold)
+            __grammar__ = self.grammar
+
+            def on_number(self, value):
+                return int(value)
+        return Pairs
+
+    @needs_unparse
+    def test_inlined(self):
+        Pairs = self.parsers(8)
+        code = dict([(r.name, r._py_code) for r in Pairs.__rules__])
+        self.assertNotIn("self.key()", code["pair"])
+        self.assertNotIn("self.pair()", code["pairs"])
+        # rules with actions and recursive rules are called
+        self.assertIn("self.number()", code["value"])
+        self.assertIn("self.value()", code["value"])
+        self.assertEqual(Pairs.p_parse("a=1,b=--2"),
+                         [["a", "=", 1], [[",", ["b", "=", ["-", ["-", 2]]]]]])
+        self.assertEqual(Pairs.p_parse("ab", "key"), "ab")
+
+    @needs_unparse
+    def test_threshold(self):
+        Pairs = self.parsers(0)
+        code = dict([(r.name, r._py_code) for r in Pairs.__rules__])
+        self.assertIn("self.key()", code["pair"])
+        self.assertEqual(Pairs.p_parse("a=1"), [["a", "=", 1], []])
+
+    def test_transitive_size(self):
+        # the size of `a` counts the nodes of `b` and `c` inlined in it
+        rules = parse_grammar(r"""
+        a <- b "1"
+        b <- c c "2"
+        c <- "x" "y"
+        d <- "p" "q" "r" "s" "t" "u" "v" "w"
+        """)
+        self.assertEqual(sorted(inlined_rules(rules, 8)), ["b", "c"])
+
+    def test_growth(self):
+        # inlining `b` would add 12 nodes to a grammar of 9 nodes
+        rules = parse_grammar(r"""
+        a <- b b b b
+        b <- "x" "y" "z"
+        """)
+        self.assertNotIn("b", inlined_rules(rules, 100))
+
+    def test_alias(self):
+        for threshold in (0, 8):
+            Pairs = self.parsers(threshold)
+            with self.assertRaisesRegexp(ParserError, "expected KEY"):
+                Pairs.p_parse("a=1,=2")
+
+
+class TextCaptureTest(TestCase):
+    grammar = r"""
+    items <- item ( "," item )*
+    item <- call / name / quoted
+    name <- [a-z] [a-z0-9_]* {p_flatten}
+    quoted <- '"' text:[a-z ]* '"' {@text}
+    call <- name "(" ( call / name / " " )* ")" {$}
+    nested <- ( "(" nested ")" / [a-z] )+ {p_flatten}
+    unquoted <- quoted+ {p_flatten}
+    """
+
+    def parsers(self):
+        parsers = []
+        for compiler in (FastidiousCompiler(optimize=0),
+                         FastidiousCompiler(),
+                         FastidiousCompiler(gen_code=False)):
+            class Items(Parser):
+                p_compiler = compiler
+                __grammar__ = self.grammar
+            parsers.append(Items)
+        return parsers
+
+    @needs_unparse
+    def test_captures(self):
+        Plain, Optimized, Interpreted = self.parsers()
+        rules = dict([(r.name, r) for r in Optimized.__rules__])
+        code = rules["name"]._py_code
+        self.assertIn("result = input[start_pos:pos]", code)
+        self.assertNotIn("results_", code)
+        self.assertNotIn("p_flatten", rules["nested"]._py_code)
+        # the value of `quoted` isn't its text
+        self.assertIn("p_flatten", rules["unquoted"]._py_code)
+        for Items in (Plain, Optimized, Interpreted):
+            self.assertEqual(Items.p_parse('ab1,"x y",f(a g(b))'),
+                             ["ab1", [[",", "x y"], [",", "f(a g(b))"]]])
+            self.assertEqual(Items.p_parse("(a(b)c)", "nested"), "(a(b)c)")
+            self.assertEqual(Items.p_parse('"a""b"', "unquoted"), "ab")
+
+    def test_flatten(self):
+        parser = Parser("")
+        self.assertEqual(parser.p_flatten(["a", ["b", [], ["c"]], "d"]),
+                         "abcd")
+        self.assertEqual(parser.p_flatten("abc"), "abc")
+        # no recursion
+        deep = "a"
+        for i in range(10000):
+            deep = [deep, "b"]
+        self.assertEqual(parser.p_flatten(deep), "a" + "b" * 10000)
+
+
+class LabelsTest(TestCase):
+    grammar = r"""
+    pair <- key:name "=" value_:( name / "-" ) {on_pair}
+    sign <- ( minus:"-" / "+" ) digits:[0-9]+ {on_sign}
+    first <- ( a:"a" / b:"b" ) {@b}
+    name <- [a-z]+
+    """
+
+    def test_bound_labels(self):
+        rules = dict([(r.name, r) for r in parse_grammar(self.grammar)])
+        self.assertEqual(bound_labels(rules["pair"].expr),
+                         set(["key", "value_"]))
+        self.assertEqual(bound_labels(rules["sign"].expr),
+                         set(["minus", "digits"]))
+        self.assertEqual(bound_labels(rules["first"].expr), set(["a"]))
+
+    @needs_unparse
+    def test_locals(self):
+        class Pairs(Parser):
+            __grammar__ = self.grammar
+
+            def on_pair(self, value, key, value_):
+                return (key, value_)
+
+            def on_sign(self, value, digits, minus=None):
+                return (minus, "".join(digits))
+
+        code = dict([(r.name, r._py_code) for r in Pairs.__rules__])
+        self.assertIn("self.on_pair(result, key=label_key, "
+                      "value_=label_value_)", code["pair"])
+        self.assertNotIn("args", code["pair"])
+        self.assertNotIn("args", code["name"])
+        # `b` isn't set if `a` matches
+        self.assertIn("args['b'] = result", code["first"])
+        self.assertEqual(Pairs.p_parse("ab=-"), ("ab", "-"))
+        self.assertEqual(Pairs.p_parse("-12", "sign"), ("-", "12"))
+        self.assertEqual(Pairs.p_parse("+12", "sign"), (Parser.NoMatch, "12"))
+        self.assertEqual(Pairs.p_parse("b", "first"), "b")
+        with self.assertRaises(KeyError):
+            Pairs.p_parse("a", "first")
+
+
+class ExprActionTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    nums <- first:num rest:( "," num )* { [first] + [r[1] for r in rest] }
+    num <- minus:"-"? digits:[0-9]+ { (-1 if minus else 1) * int(digits) }
+    pair <- ( a:"a" / b:"b" ) { (a, b, self.p_flatten(value)) }
+    """
+
+    def parsers(self):
+        parsers = []
+        for compiler in (FastidiousCompiler(),
+                         FastidiousCompiler(gen_code=False)):
+            class Nums(Parser):
+                p_compiler = compiler
+                __grammar__ = self.grammar
+            parsers.append(Nums)
+        return parsers
+
+    @needs_unparse
+    def test_expressions(self):
+        Nums, Interpreted = self.parsers()
+        code = dict([(r.name, r._py_code) for r in Nums.__rules__])
+        self.assertIn("result = [label_first] + [r[1] for r in label_rest]",
+                      code["nums"])
+        self.assertIn("args.get('b')", code["pair"])
+        for Nums in self.parsers():
+            self.assertEqual(Nums.p_parse("1,-23,4"), [1, -23, 4])
+            self.assertEqual(Nums.p_parse("a", "pair"), ("a", None, "a"))
+
+    def test_scopes(self):
+        # the lambdas and the comprehensions bind their own names, the
+        # locals of the generated methods don't hide the builtins
+        grammar = r"""
+        sort <- d:[0-9]+ { sorted(d, key=lambda d: -int(d)) }
+        odd <- d:[0-9]+ { [d for d in d if int(d) % 2] }
+        pairs <- d:[0-9]+ { dict((k, v) for k, v in zip(d, d[1:])) }
+        builtin <- "x" { [input][0] }
+        """
+        for entry, source, expected in (
+                ("sort", "2913", ["9", "3", "2", "1"]),
+                ("odd", "2913", ["9", "1", "3"]),
+                ("pairs", "123", {"1": "2", "2": "3"}),
+                ("builtin", "x", six.moves.builtins.input)):
+            results = self.assertSameParses(grammar, [source, ""], entry,
+                                            tier_threshold=1)
+            self.assertEqual(results[0], expected)
+
+    def test_errors(self):
+        for action, error in (("int(digits", "Invalid action"),
+                              ("int(digit)", "`digit`: unknown name"),
+                              ("(yield digits)", "`Yield` isn't allowed"),
+                              ("[(yield) for d in digits]", "`Yield`")):
+            with self.assertRaisesRegexp(ActionError, error):
+                class Nums(Parser):
+                    __grammar__ = "num <- digits:[0-9]+ {%s}" % action
+
+
+class MethodBuilderTest(TestCase):
+    class Base(Parser):
+        __grammar__ = r"""
+        words <- word ( " " word )*
+        word <- letters:[a-z]+ { self.check(letters) }
+        """
+
+        def check(self, letters):
+            if letters == "boom":
+                raise ValueError(letters)
+            return letters
+
+    def test_globals(self):
+        Base = self.Base
+        self.assertEqual(Base.word.__module__, __name__)
+        if six.PY3:
+            self.assertEqual(Base.word.__qualname__, "Base.word")
+
+    @needs_unparse
+    def test_compact(self):
+        class Plain(self.Base):
+            p_compiler = FastidiousCompiler(optimize=0)
+            __grammar__ = self.Base.__grammar__
+        compact = self.Base.__rules__[1]
+        self.assertIsNone(ast.get_docstring(compact._py_ast))
+        self.assertNotIn("self.p_nomatch(", compact._py_code)
+        self.assertEqual(ast.get_docstring(Plain.__rules__[1]._py_ast),
+                         "word <- letters:[a-z]+")
+        for P in (Plain, self.Base):
+            self.assertEqual(P.word.__doc__,
+                             "word <- letters:[a-z]+")
+            with self.assertRaisesRegexp(ParserError, "expected `\\[a-z\\]`"):
+                P.p_parse("a 1")
+
+    def test_inherited_code(self):
+        class Child(self.Base):
+            __grammar__ = r"""
+            other <- "x"
+            """
+        # the methods of a class are compiled as one module
+        filename = Child.other.__code__.co_filename
+        self.assertEqual(Child.word.__code__.co_filename, filename)
+        self.assertNotEqual(self.Base.word.__code__.co_filename, filename)
+        self.assertEqual(Child.p_parse("a b", "words"), ["a", [[" ", "b"]]])
+
+    @needs_unparse
+    def test_traceback(self):
+        import traceback
+        try:
+            self.Base.p_parse("a boom")
+        except ValueError as e:
+            lines = [frame[3] for frame in traceback.extract_tb(
+                e.__traceback__ if six.PY3 else sys.exc_info()[2])]
+        else:
+            self.fail("the action didn't raise")
+        self.assertIn("result = self.check(label_letters)", lines)
+
+
+class LivenessTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    call <- name:word _ "(" _ args:( word ( _ "," _ word )* )? _ ")" {@args}
+    pair <- key:word _ "=" _ word { "".join(key).upper() }
+    block <- "{" _ ( word _ )* "}"
+    word <- !keyword [a-z]+
+    keyword <- ( "if" / "else" ) ![a-z]
+    _ <- [ ]*
+    """
+
+    def parsers(self):
+        parsers = []
+        for compiler in (FastidiousCompiler(optimize=0, inline_threshold=0),
+                         FastidiousCompiler(inline_threshold=0),
+                         FastidiousCompiler(gen_code=False)):
+            class Calls(Parser):
+                p_compiler = compiler
+                __grammar__ = self.grammar
+            parsers.append(Calls)
+        return parsers
+
+    @needs_unparse
+    def test_void(self):
+        Calls = self.parsers()[1]
+        code = dict([(r.name, r._py_code) for r in Calls.__rules__])
+        # only `args` is built
+        self.assertEqual(code["call"].count("result = [item_"), 2)
+        self.assertNotIn("result = [item_", code["pair"])
+        self.assertIn("result = [item_", code["block"])
+
+    def test_same_values(self):
+        results = self.assertSameParses(self.grammar, ["f( a , b,c )", "f()",
+                                                       "if()"],
+                                        inline_threshold=0)
+        self.assertEqual(results[:2], [[["", "a"],
+                                        [[" ", ",", " ", ["", "b"]],
+                                         ["", ",", "", ["", "c"]]]], ""])
+        self.assertIn("expected", results[2])
+        results = self.assertSameParses(self.grammar, ["a = b", "a ="],
+                                        "pair", inline_threshold=0)
+        self.assertEqual(results[0], "A")
+        results = self.assertSameParses(self.grammar, ["{ a b }", "{ if }"],
+                                        "block", inline_threshold=0)
+        self.assertEqual(results[0], ["{", " ", [[["", "a"], " "],
+                                                 [["", "b"], " "]], "}"])
+        results = self.assertSameParses(self.grammar, ["ifa", "if"], "word",
+                                        inline_threshold=0)
+        self.assertEqual(results[0], ["", "ifa"])
+
+
+class ClosuresTest(TestCase):
+    backend = "closures"
+    options = {}
+    grammar = r"""
+    items <- _ first:item rest:( _ "," _ item )* _ {on_items}
+    item <- call / pair / name
+    call <- fn:name "(" ^ _ args:( items )? _ ")" {@args}
+    pair <- key:name _ "=" _ val:( number / name ) { (key, val) }
+    name <- [a-z] [a-z0-9_]* {p_flatten}
+    number <- "-"? [0-9]+ ( "." [0-9]+ )? {$}
+    @memo
+    _ <- ( [ \t] / !"," "\n" )*
+    """
+
+    class Methods(object):
+        def on_items(self, value, first, rest):
+            return [first] + [r[3] for r in rest]
+
+    def parsers(self, backend):
+        parsers = []
+        for optimize in (0, 1, 2):
+            class Items(self.Methods, Parser):
+                p_compiler = FastidiousCompiler(backend=backend,
+                                                optimize=optimize,
+                                                **self.options)
+                __grammar__ = self.grammar
+            parsers.append(Items)
+        return parsers
+
+    def test_no_code(self):
+        for Items in self.parsers(self.backend):
+            Items.p_parse("f(a, g(x=1, y = -2.5), h())")
+            self.assertFalse(hasattr(Items.__rules__[0], "_py_ast"))
+
+    def test_state(self):
+        Items = self.parsers(self.backend)[1]
+        p = Items("f(a) ?", track_errors=False)
+        self.assertEqual(p.items(), [["a"]])
+        self.assertEqual(p.pos, 5)
+        self.assertEqual(p._p_backtrack, [])
+        self.assertEqual(p.call(), Items.NoMatch)
+        self.assertEqual(p.pos, 5)
+
+    def test_inheritance(self):
+        Items = self.parsers(self.backend)[1]
+
+        class Child(Items):
+            __grammar__ = r"""
+            name <- [a-z]+ {p_flatten}
+            """
+
+            def on_items(self, value, first, rest):
+                return len(rest) + 1
+
+        self.assertEqual(Child.p_parse("a, b, c", "items"), 3)
+        self.assertEqual(Items.p_parse("a, b, c"), ["a", "b", "c"])
+        self.assertEqual(Items.p_parse("a1"), ["a1"])
+        with self.assertRaisesRegexp(ParserError, "expected"):
+            Child.p_parse("a1", "items")
+
+    def test_unknown_backend(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown backend `jit`"):
+            FastidiousCompiler(backend="jit")
+
+
+class VMTest(ClosuresTest):
+    backend = "vm"
+
+    def test_program(self):
+        Items = self.parsers(self.backend)[1]
+        code = disassemble(Items._p_vm_code)
+        self.assertIn("CALL", code)
+        self.assertIn("MEMO", code)
+        self.assertIn("CUT", code)
+        # the fast program doesn't report the errors
+        self.assertNotIn("PUSHREPORT", code)
+
+    def test_deep_nesting(self):
+        class Lists(Parser):
+            p_compiler = FastidiousCompiler(backend=self.backend)
+            __grammar__ = r"""
+            list <- "[" list? "]" {$}
+            """
+        depth = sys.getrecursionlimit() * 10
+        source = "[" * depth + "]" * depth
+        self.assertEqual(Lists.p_parse(source), source)
+        with self.assertRaisesRegexp(ParserError, "expected"):
+            Lists.p_parse(source[:-1])
+
+
+class TieredTest(ClosuresTest):
+    backend = "tiered"
+    # promote the rules during the parses
+    options = dict(tier_threshold=3)
+
+    def test_no_code(self):
+        Items = self.parsers(self.backend)[1]
+        self.assertEqual(Items._p_tiers.promoted, set())
+        self.assertEqual(Items.p_parse("a"), ["a"])
+        # `_` is called 3 times, `items` once
+        self.assertEqual(Items._p_tiers.promoted, set(["_", "name"]))
+        self.assertFalse(hasattr(Items.__rules__[0], "_py_ast"))
+        # `items` and `call` are promoted while they run
+        self.assertEqual(Items.p_parse("f(g(h(i(a), b)))"),
+                         [[[[["a"], "b"]]]])
+        self.assertIn("items", Items._p_tiers.promoted)
+        self.assertIn("call", Items._p_tiers.promoted)
+        self.assertTrue(hasattr(Items.__rules__[0], "_py_ast"))
+        self.assertEqual(Items.items.__name__, "items")
+
+    def test_threshold(self):
+        for threshold in (0, 1, 1000):
+            class Numbers(Parser):
+                p_compiler = FastidiousCompiler(backend=self.backend,
+                                                tier_threshold=threshold)
+                __grammar__ = r"""
+                numbers <- number ( "," number )*
+                number <- [0-9]+ {$}
+                """
+            self.assertEqual(Numbers.p_parse("1,22,3"),
+                             ["1", [[",", "22"], [",", "3"]]])
+            self.assertEqual(len(Numbers._p_tiers.promoted),
+                             0 if threshold > 3 else 2)
+
+    def test_same_results_across_promotion(self):
+        # the rules return the same results before and after their
+        # promotion, including the matches rejected by their action
+        for grammar, sources, rejecting in (
+                ('item <- small "!" / word "!"' + BackendsTest.small_rules,
+                 ["42!", "4!", "42"], "small"),
+                ('r <- ( a:"a" )? "b" {@a}', ["b", "ab"], "r")):
+            class Rejecting(BackendsTest.Small, Parser):
+                p_compiler = FastidiousCompiler(backend=self.backend,
+                                                tier_threshold=3)
+                __grammar__ = grammar
+            parses = []
+            for i in range(5):
+                results = []
+                for source in sources:
+                    try:
+                        results.append(Rejecting.p_parse(source))
+                    except ParserError as e:
+                        results.append(str(e))
+                    p = Rejecting(source, track_errors=False)
+                    results.append((getattr(p, Rejecting.__default__)(),
+                                    p.pos))
+                parses.append(results)
+            self.assertIn(rejecting, Rejecting._p_tiers.promoted)
+            for results in parses[1:]:
+                self.assertEqual(results, parses[0])
+
+
+class BackendsTest(TestCase, BackendsTestMixin):
+    # `small` matches the numbers, its action rejects those above 9
+    small_rules = r"""
+    small <- d:~"[0-9]+"
+    word <- ~"[0-9a-z]+"
+    """
+
+    class Small(object):
+        def on_small(self, value, d):
+            if int(d) > 9:
+                return self.NoMatch
+            return d
+
+    def test_same_values(self):
+        sources = ["f(a, g(x=1, y = -2.5), h())", "a, b", " k =\t1 ", "a b",
+                   "f(", "f(1)", "x = ", "", "a,\n b", "a\n,b"]
+        # promote the rules of the tiered parsers during the parses too
+        for threshold in (0, 3):
+            results = self.assertSameParses(ClosuresTest.grammar, sources,
+                                            methods=ClosuresTest.Methods,
+                                            tier_threshold=threshold)
+            self.assertEqual(results[0],
+                             [["a", [("x", "1"), ("y", "-2.5")], ""]])
+
+    def test_rejecting_action(self):
+        # an action returning NoMatch makes its rule fail
+        results = self.assertSameParses(r"""
+        a <- b "y"
+        b <- ( l:c )? {@l}
+        c <- &( "x" "z" )
+        """, ["y", "xzy", ""])
+        self.assertIn("Got `y`", results[0])
+        results = self.assertSameParses(r"""
+        a <- !b ""
+        b <- ( l:"x" )? {@l}
+        """, ["", "x"])
+        self.assertEqual(results[0], ["", ""])
+        self.assertIn("Got `x`", results[1])
+        # the action rejects the match after the body consumed some input:
+        # the next alternative starts at the same position
+        results = self.assertSameParses(
+            'item <- small "!" / word "!"' + self.small_rules, ["42!", "4!"],
+            methods=self.Small)
+        self.assertEqual(results, [["42", "!"], ["4", "!"]])
+        # the label isn't set: the action returns NoMatch
+        results = self.assertSameParses(r"""
+        r <- ( a:"a" )? "b" {@a}
+        """, ["b", "ab"])
+        self.assertIn("Got `b` expected `\"a\"`", results[0])
+        self.assertEqual(results[1], "a")
+
+    def test_rejected_matches(self):
+        # the expressions around a rule whose action rejects the match
+        # after the body consumed some input
+        sources = ["42", "4", "4,42", "4x42", "42!"]
+        for item in ('small / word', 'small? word', 'small* word',
+                     '( small "x" )+ word', 'small+ / word', '!small word',
+                     '&small word', 'alias / word', 'small ** "," word',
+                     'small ++ "," / word', '"" small / word',
+                     'small "!" / word "!"'):
+            grammar = "item <- %s\nalias <- small" % item
+            self.assertSameParses(grammar + self.small_rules, sources,
+                                  methods=self.Small)
+            memo = self.small_rules.replace("small <-", "@memo\n    small <-")
+            self.assertSameParses(grammar + memo, sources, methods=self.Small)
+
+    def test_predicate_errors(self):
+        # the interpreted predicates report their failures at their start
+        # position, like the generated ones
+        results = self.assertSameParses(r"""
+        numbers <- number+ EOF
+        number <- [0-9]+ " "* {$}
+        EOF <- !.
+        """, ["1 2)"])
+        self.assertIn("col 3", results[0])
+
+
+class MemoTablesTest(TestCase):
+    class Memoized(Parser):
+        __grammar__ = r"""
+        list <- ( item "," ) / ( item ";" ) / item
+        @memo
+        item <- [a-z]+
+        """
+
+    def test_rule_indexes(self):
+        self.assertEqual(self.Memoized._p_memo_rules, ("item",))
+
+    def test_dense_and_sparse(self):
+        dense = self.Memoized("abc;")
+        self.assertEqual(dense.list(), ["abc", ";"])
+        self.assertIsInstance(dense._p_memo[0], list)
+        self.assertEqual(dense.p_memo_stats()["entries"], 1)
+
+        class Sparse(self.Memoized):
+            __memo_dense_limit__ = 2
+        sparse = Sparse("abc;")
+        self.assertEqual(sparse.list(), ["abc", ";"])
+        self.assertIsInstance(sparse._p_memo[0], dict)
+        self.assertEqual(sparse._p_memo[0], {0: 3, ~0: "abc"})
+        self.assertEqual(sparse.p_memo_stats()["entries"], 1)
+
+
+class MemoBudgetTest(TestCase):
+    class Memoized(Parser):
+        __grammar__ = r"""
+        list <- ( item "," )* ( ( item ";" ) / item )
+        @memo
+        item <- [a-z]+
+        """
+
+    def test_lru(self):
+        p = self.Memoized("a,b,c;", memo_budget=1)
+        self.assertEqual(p.list(), [[["a", ","], ["b", ","]], ["c", ";"]])
+        stats = p.p_memo_stats()
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["reparses"], 0)
+
+    def test_reparse(self):
+        p = self.Memoized("a,b,c", memo_budget=0)
+        self.assertEqual(p.list(), [[["a", ","], ["b", ","]], "c"])
+        stats = p.p_memo_stats()
+        self.assertEqual(stats["entries"], 0)
+        # "c" is parsed again after the failures of `item ","` and
+        # `item ";"`
+        self.assertEqual(stats["reparses"], 2)
+        self.assertEqual(stats["evictions"], 5)
+
+    def test_window(self):
+        budget = MemoBudget(window=2)
+        p = self.Memoized("aa,bb,cc", memo_budget=budget)
+        self.assertEqual(p.list()[1], "cc")
+        self.assertEqual(p.p_memo_stats()["entries"], 1)
+        self.assertEqual(sorted(p._p_memo[0]), [~6, 6])
+
+    def test_size(self):
+        budget = MemoBudget(size=MemoBudget.entry_size * 3)
+        p = self.Memoized("a,b,c,d", memo_budget=budget)
+        p.list()
+        self.assertLess(p.p_memo_stats()["entries"], 3)
+
+    def test_defaults(self):
+        class Bounded(self.Memoized):
+            __memo_budget__ = 1
+        self.assertEqual(Bounded.p_parse("a,b", "list")[1], "b")
+        self.assertEqual(Bounded("a,b").p_memo_stats()["evictions"], 0)
+        self.assertEqual(
+            self.Memoized.p_parse("a,b", memo_budget=MemoBudget(entries=1)),
+            [[["a", ","]], "b"])
+
+    def test_bad_budget(self):
+        self.assertRaises(ValueError, MemoBudget)
+        self.assertRaises(ValueError, MemoBudget, 1, policy="fifo")
+        self.assertRaises(ValueError, MemoBudget, 1, policy="lru", window=2)
+
+
+class CutTest(TestCase, BackendsTestMixin):
+    grammar = r"""
+    records <- record*
+    record <- key "=" ^ value "\n" / key ":" value "\n"
+    @memo
+    key <- [a-z]+
+    @memo
+    value <- [0-9]+
+    """
+    source = "a=1\nbb:22\n" * 100
+
+    def test_release_memo(self):
+        for backend in ("codegen", "closures", "vm"):
+            class Records(Parser):
+                p_compiler = FastidiousCompiler(backend=backend)
+                __grammar__ = self.grammar
+                __memo_dense_limit__ = 0
+
+            class NoCut(Records):
+                __grammar__ = self.grammar.replace("^", "")
+
+            p = Records(self.source)
+            self.assertEqual(len(p.records()), 200)
+            # only the entries of the last records are left
+            self.assertLess(p.p_memo_stats()["entries"], 10)
+            self.assertEqual(p._p_backtrack, [])
+            p = NoCut(self.source)
+            self.assertEqual(len(p.records()), 200)
+            self.assertGreater(p.p_memo_stats()["entries"], 400)
+
+    def test_interpreted(self):
+        class Records(Parser):
+            p_compiler = FastidiousCompiler(gen_code=False)
+            __grammar__ = self.grammar
+        p = Records(self.source)
+        self.assertEqual(p.records()[:2],
+                         [["a", "=", "", "1", "\n"],
+                          ["bb", ":", "22", "\n"]])
+        self.assertEqual(p._p_backtrack, [])
+        self.assertEqual(p._p_cut_floor, len(self.source) - 10)
+
+    def test_commit_before_input(self):
+        # the cut commits the choice before the first alternative consumes
+        # anything: the next alternatives are never tried, with or without
+        # error tracking
+        results = self.assertSameParses(r"""
+        a <- "x"? ^ "y" / "z"
+        """, ["xy", "y", "z", "x"])
+        self.assertEqual(results[:2], [["x", "", "y"], ["", "", "y"]])
+        self.assertIn("Got `z`", results[2])
+
+
+class MemoPolicyTest(TestCase):
+    grammar = r"""
+    list <- first:item rest:( sep item )* {@first}
+    @memo
+    sep <- "," / ";"
+    item <- number / word
+    number <- digits "." digits / digits
+    word <- letters ( "-" letters )*
+    digits <- [0-9]+
+    letters <- [a-z]+
+    @nomemo
+    unused <- list list
+    """
+
+    def test_policy(self):
+        rules = parse_grammar(self.grammar)
+        # digits and letters are cheap, number and word are only called
+        # once at the same position
+        self.assertEqual(memoized_rules(rules),
+                         set(["list", "sep", "item"]))
+
+    def test_plan(self):
+        class Items(Parser):
+            __grammar__ = self.grammar
+        plan = train_memo_plan(Items, ["1.5,a-b;2", "x"])
+        self.assertEqual(plan.stats["digits"]["hits"], 3)
+        self.assertTrue(plan.memoize("digits"))
+        self.assertFalse(plan.memoize("item"))
+        self.assertIs(plan.memoize("unused"), None)
+
+        out = six.StringIO()
+        plan.save(out)
+        out.seek(0)
+        plan = MemoPlan.load(out)
+        self.assertEqual(
+            memoized_rules(Items.__rules__, plan),
+            set(["list", "sep", "digits"]))
+
+        class PlannedItems(Parser):
+            p_compiler = FastidiousCompiler(memo_plan=plan)
+            __grammar__ = self.grammar
+        self.assertEqual(PlannedItems._p_memo_rules,
+                         ("sep", "digits", "list"))
+        self.assertEqual(PlannedItems.p_parse("1.5,a-b;2"), ["1", ".", "5"])
@@ -5,18 +5,45 @@ from fastidious import ParserError
 
 
 class ErrorHandlingTests(TestCase):
+    class Simple(Parser):
+        __grammar__ = r"""
+        calc <- num _ operator _ num EOF
+        num "NUMBER" <-  frac / "-"? int
+        int <- ~"[0-9]+"
+        frac <- int "." int
+        operator "OPERATOR" <- '+' / '-'
+        _ <- [ \t\r]*
+        EOF <- !.
+        """
+
     def test_error(self):
-        class Simple(Parser):
-            __grammar__ = r"""
-            calc <- num _ operator _ num EOF
-            num "NUMBER" <-  frac / "-"? int
-            int <- ~"[0-9]+"
-            frac <- int "." int
-            operator "OPERATOR" <- '+' / '-'
-            _ <- [ \t\r]*
-            EOF <- !.
-            """
+        Simple = self.Simple
         Simple.p_parse("1 + 1")
         with self.assertRaisesRegexp(ParserError,
                                      "Got `! 1` expected OPERATOR"):
             Simple.p_parse("1 ! 1")
+
+    def test_error_tracking(self):
+        p = self.Simple("1 ! 1", track_errors=False)
+        self.assertIs(p.calc(), p.NoMatch)
+        self.assertEqual(p._p_error_pos, -1)
+        self.assertEqual(p._p_error_ids, set())
+
+        p = self.Simple("1 ! 1")
+        self.assertIs(p.calc(), p.NoMatch)
+        self.assertEqual(p._p_error_pos, 2)
+        self.assertEqual(p._p_terminal_pos, 2)
+        with self.assertRaisesRegexp(ParserError, "expected OPERATOR"):
+            p.p_raise()
+
+    def test_bounded_tracking(self):
+        class Items(Parser):
+            __grammar__ = r"""
+            items <- ( item ","? )* "."
+            item <- "a" / "b" / "c"
+            """
+        p = Items("a,b," * 1000 + "d")
+        p.items()
+        # the failures are only recorded once per expression
+        self.assertEqual(p._p_error_pos, 4000)
+        self.assertLess(len(p._p_error_ids), 10)
@@ -59,6 +59,42 @@ class RegexExprTest(TestCase, ExprTestMixin):
         self.expect(("a*", "i"), "Aabc", "Aa")
         self.expect(("a+",), "b", self.NoMatch)
 
+    def test_regex_in_place(self):
+        # the regex is matched at the current position, without slicing the
+        # input: lookbehinds see the already consumed input
+        expr = RegexExpr("(?<=b)a+")
+        p = ParserMock("baab")
+        self.assertIs(expr(p), self.NoMatch)
+        p.pos = 1
+        self.assertEqual(expr(p), "aa")
+        self.assertEqual(p.pos, 3)
+
+        class TestParser(Parser):
+            __grammar__ = r"""
+            rule <- "b" ~"(?<=b)a+"
+            """
+        self.assertEqual(TestParser.p_parse("baa"), ["b", "aa"])
+
+
+class KeywordSetExprTest(TestCase, ExprTestMixin):
+    ExprKlass = KeywordSetExpr
+
+    def test_keywords(self):
+        args = (["if", "iff", "else"], )
+        self.expect(args, "if x", "if")
+        self.expect(args, "iff", "iff")
+        self.expect(args, "iffy", self.NoMatch)
+        self.expect(args, "if_", self.NoMatch)
+        self.expect(args, "IF", self.NoMatch)
+        self.expect(args + (True, ), "Else1", self.NoMatch)
+        self.expect(args + (True, ), "Else ", "Else")
+
+    def test_identifiers(self):
+        args = (["if", "else"], False, True)
+        self.expect(args, "if x", ("keyword", "if"))
+        self.expect(args, "iffy", ("identifier", "iffy"))
+        self.expect(args, "1f", self.NoMatch)
+
 
 class CharRangeExprTest(TestCase, ExprTestMixin):
     ExprKlass = CharRangeExpr
@@ -137,6 +173,56 @@ class ChoiceExprTest(TestCase, ExprTestMixin):
         self.expect(choices, "cc aa", self.NoMatch)
 
 
+class CutExprTest(TestCase, ExprTestMixin):
+    ExprKlass = ChoiceExpr
+
+    def test_cut(self):
+        choices = (
+            SeqExpr(LiteralExpr("a"), CutExpr(), LiteralExpr("b")),
+            SeqExpr(LiteralExpr("a"), LiteralExpr("c")),
+            LiteralExpr("d"),
+        )
+        self.expect(choices, "ab", ["a", "", "b"])
+        # committed to the first alternative
+        self.expect(choices, "ac", self.NoMatch)
+        self.expect(choices, "d", "d")
+
+    def test_cut_in_last_alternative(self):
+        choices = (
+            LiteralExpr("b"),
+            SeqExpr(LiteralExpr("a"), CutExpr(), LiteralExpr("b")),
+        )
+        self.expect(choices, "ab", ["a", "", "b"])
+        self.expect(choices, "ac", self.NoMatch)
+
+
+class SeparatedExprTest(TestCase, ExprTestMixin):
+    ExprKlass = SeparatedExpr
+
+    def test_separated(self):
+        args = (CharRangeExpr("ab"), LiteralExpr(","))
+        self.expect(args, "a,b,a", ["a", "b", "a"])
+        self.expect(args, "a,b,", ["a", "b"])
+        self.expect(args, ",a", [])
+        self.expect(args + (True, ), "a", ["a"])
+        self.expect(args + (True, ), ",a", self.NoMatch)
+
+
+class PrecedenceExprTest(TestCase, ExprTestMixin):
+    ExprKlass = PrecedenceExpr
+
+    def test_precedence(self):
+        levels = [("left", LiteralExpr("+")), ("right", LiteralExpr("^")),
+                  ("prefix", LiteralExpr("-"))]
+        args = (CharRangeExpr("ab"), levels)
+        self.expect(args, "a", "a")
+        self.expect(args, "a+b+a", [["a", "+", "b"], "+", "a"])
+        self.expect(args, "a^b^a", ["a", "^", ["b", "^", "a"]])
+        self.expect(args, "-a+b", [["-", "a"], "+", "b"])
+        self.expect(args, "a+", "a")
+        self.expect(args, "+a", self.NoMatch)
+
+
 class AnyCharExprTest(TestCase, ExprTestMixin):
     ExprKlass = AnyCharExpr
 
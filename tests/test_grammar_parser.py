@@ -2,6 +2,7 @@ from unittest import TestCase
 
 from fastidious.bootstrap import _FastidiousParserBootstraper
 from fastidious.parser import FastidiousParser
+from fastidious.parser_base import ParserError
 
 
 class GrammarParserMixin(object):
@@ -46,3 +47,40 @@ class TestFastidiousParserBootstraper(TestCase, GrammarParserMixin):
 
 class TestFastidiousParser(TestCase, GrammarParserMixin):
     klass = FastidiousParser
+
+    def test_cut(self):
+        parser = self.klass("'a' ^ 'b' / 'c'")
+        result = parser.expression()
+        self.assertEqual(result.as_grammar(), '( "a" ^ "b" ) / "c"')
+        self.assertTrue(result.exprs[0].exprs[1].commits)
+
+    def test_precedence(self):
+        parser = self.klass(
+            "expr <- num %left '+' / '-' %right '^' %prefix '-' {on_node}")
+        result = parser.rule()
+        self.assertEqual(result.action, "on_node")
+        self.assertEqual([kind for _, kind, _ in result.expr.levels],
+                         ["left", "right", "prefix"])
+        self.assertEqual(result.expr.as_grammar(),
+                         'num %left "+" / "-" %right "^" %prefix "-"')
+
+    def test_separated(self):
+        parser = self.klass("item ** ( ',' _ ) '.' / item ++ ','")
+        result = parser.expression()
+        self.assertEqual(result.as_grammar(),
+                         '( item ** ( "," _ ) "." ) / item ++ ","')
+        self.assertFalse(result.exprs[0].exprs[0].at_least_one)
+        self.assertTrue(result.exprs[1].at_least_one)
+
+    def test_keyword_set(self):
+        parser = self.klass('@"if  else" / @"select"in')
+        result = parser.expression()
+        self.assertEqual(result.as_grammar(), '@"if else" / @"select"in')
+        self.assertEqual(result.exprs[0].keywords, frozenset(["if", "else"]))
+        self.assertFalse(result.exprs[0].identifiers)
+        self.assertTrue(result.exprs[1].ignorecase)
+        self.assertTrue(result.exprs[1].identifiers)
+        with self.assertRaisesRegexp(ParserError, "can't be empty"):
+            self.klass('@" "').expression()
+        with self.assertRaisesRegexp(ParserError, "`<=` isn't an identifier"):
+            self.klass('@"if <="').expression()